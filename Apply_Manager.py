@@ -1,5 +1,10 @@
 import asyncio
+import time
 from typing import AsyncIterator, Tuple, Dict, Any, List, Callable
+from Wal2Json_Scanner import Normalize_Raw
+from Heartbeat import Is_Heartbeat, Is_Heartbeat_Change
+from Profiler import Profiled
+from Event_Rules import Rule_For
 
 
 '''
@@ -17,13 +22,35 @@ it decides
 '''
 
 
+# the key of 1 change. with include-pk (latest_state=true) it's the primary key for every kind, from the new values
+# for inserts/updates and from oldkeys for deletes (which hold the whole old row with replica identity full).
+# otherwise the replica identity keys, or the whole row for inserts
+def Change_Key(ch):
+    pk = ch.get("pk")
+    values = ch.get("columnvalues")
+    oldkeys = ch.get("oldkeys", {})
+    for names, row in ((ch.get("columnnames"), values), (oldkeys.get("keynames"), oldkeys.get("keyvalues"))):
+        if pk and row is not None:
+            position = {name: i for i, name in enumerate(names)}
+            if all(name in position for name in pk["pknames"]):
+                return [row[position[name]] for name in pk["pknames"]]
+
+    return oldkeys.get("keyvalues") or values
+
+
 ''' goal: Makes all events uniform, regardless of schema
 - takes 1 wal2json message (which should be multiple wal changes) and splits it into individual events
-- these events have fields like: table, type, pk, commit_lsn, payload_json
+- these events have fields like: table, type, pk, commit_lsn, commit_time, position, payload_json
+- position is the change's place in its transaction (staged chunks start at their change_offset). 1 row changed twice
+  in 1 transaction has the same (table, pk, commit_lsn) for both changes, position tells them apart (Dedup_Filter.py)
 
 return: List[Dict[str, Any]]
 paras: obj: Dict[str, Any] '''
+@Profiled("Normalize_Wal2Json")
 def Normalize_Wal2Json(obj):
+    if "raw_changes" in obj: # payload_mode=passthrough, the changes were never parsed (Wal2Json_Scanner.py)
+        return Normalize_Raw(obj)
+
     out = []
     # wal2json usually provides 'nextlsn' which marks the end of the transaction
     commit_lsn = obj.get("lsn") or obj.get("commit_lsn") or obj.get("nextlsn")
@@ -33,12 +60,22 @@ def Normalize_Wal2Json(obj):
     if not isinstance(changes, list):
         changes = [changes]
 
-    for ch in changes:
+    offset = obj.get("change_offset", 0)
+    for position, ch in enumerate(changes, offset):
+        if Is_Heartbeat_Change(ch): # only there to move the lsn (Heartbeat.py)
+            continue
+        rule = Rule_For(ch.get("schema"), ch.get("table")) # filter/projection/masking (Event_Rules.py)
+        if rule is not None:
+            ch = rule.Apply(ch)
+            if ch is None:
+                continue
         out.append({
             "commit_lsn": commit_lsn,
+            "commit_time": obj.get("timestamp"),  # include-timestamp=1, used for time partitioning
             "type": ch.get("kind"),          # insert, update, delete
             "table": f'{ch.get("schema")}.{ch.get("table")}',
-            "pk": ch.get("oldkeys", {}).get("keyvalues") or ch.get("columnvalues"),
+            "pk": Change_Key(ch),
+            "position": position,
             "payload_json": ch,              # store raw; sinks may shape it
         })
 
@@ -49,60 +86,257 @@ def Normalize_Wal2Json(obj):
 - reads events from the wal source stream (binary)
 - buffers them into a list
 - once a batch is fully made, it calls the function to process the batch
+- batch_controller is optional (Batch_Controller.py). if it's passed in, it picks the batch size instead of batch_size
+- failure_policy, dead_letter, is_poison: what to do with a batch that keeps failing, see Process_Batch
+- stop_event is optional. when it's set (Main sets it on ctrl+c/SIGTERM) the loop drains: it stops reading, sends the
+  partial batch through Process_Batch so its lsn gets saved, then closes the source which stops pg_recvlogical.
+  the drain gets shutdown_deadline_seconds, whatever doesn't make it is replayed on the next start
+- dedup is optional (Dedup_Filter.py). transactions at or below the last saved lsn are dropped here before they're
+  buffered, and Process_Batch drops events that were already applied
+- control is optional (Control_Api.py). its batch_size/max_retries/backoff_seconds replace the ones passed in and are
+  picked up before every read. it can pause reading, and a flush request sends the partial batch through. a change
+  wakes the loop while it's waiting on the source, the read it was waiting on is kept for the next round
 '''
-async def Run_Apply_Loop(source: AsyncIterator[Tuple[str, Dict[str, Any]]], batch_size,
+async def Run_Apply_Loop(source: AsyncIterator[List[Tuple[str, Dict[str, Any]]]], batch_size,
                          apply_batch: Callable[[List[Dict[str, Any]]], "asyncio.Future[None]"],
                          persist_lsn: Callable[[str], None], max_retries,
-                         backoff_seconds):
+                         backoff_seconds, batch_controller=None, failure_policy="halt",
+                         dead_letter=None, is_poison=None, stop_event=None, shutdown_deadline_seconds=10.0,
+                         dedup=None, control=None):
 
     buffer = [] # List[Tuple[str, Dict[str, Any]]]
+    iterator = source.__aiter__()
+    pending_read = None # the read that was waiting on the source when a stop came in
+    stop_wait = asyncio.ensure_future(stop_event.wait()) if stop_event else None
+    stopping = False
+    handle = control.Attach(buffer) if control is not None else None
 
-    # source is a async generator
-    # "async for" handles "await" internally
-    async for lsn, obj in source:
-        buffer.append((lsn, obj))
-        if len(buffer) >= batch_size:
-            await Process_Batch(buffer, apply_batch, persist_lsn, max_retries, backoff_seconds)
-            buffer.clear()
+    async def Flush():
+        events, latency, retries = await Process_Batch(buffer, apply_batch, persist_lsn, max_retries, backoff_seconds,
+                                                       failure_policy, dead_letter, is_poison, dedup)
+        if batch_controller:
+            batch_controller.Record_Batch(events, latency, retries)
+        buffer.clear()
 
-    if buffer:
-        await Process_Batch(buffer, apply_batch, persist_lsn, max_retries, backoff_seconds)
+    try:
+        # source is a async generator
+        # without a stop event this is the same as "async for". with one, each read races the stop event
+        while True:
+            if control is not None: # changes from the control api, between batches
+                batch_size, max_retries, backoff_seconds = control.batch_size, control.max_retries, control.backoff_seconds
+                if control.Take_Flush(handle) and buffer:
+                    await Flush()
+                if not control.running.is_set():
+                    await control.Wait_While_Paused(stop_event, handle)
+                    if stop_event is not None and stop_event.is_set():
+                        stopping = True
+                        break
+                    continue
+
+            if stop_wait is None and control is None:
+                try:
+                    records = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                if pending_read is None:
+                    pending_read = asyncio.ensure_future(iterator.__anext__())
+                waiting = [pending_read] + ([stop_wait] if stop_wait else [])
+                control_wait = asyncio.ensure_future(control.Wait_For_Change(handle)) if control is not None else None
+                if control_wait is not None:
+                    waiting.append(control_wait)
+                await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                if control_wait is not None:
+                    control_wait.cancel()
+                if stop_event is not None and stop_event.is_set():
+                    stopping = True
+                    break
+                if not pending_read.done():
+                    continue # woken by the control api, the read stays pending
+                try:
+                    records = pending_read.result()
+                except StopAsyncIteration:
+                    break
+                pending_read = None
+
+            # the source hands over everything 1 read of pg_recvlogical's output completed
+            for lsn, obj in records:
+                if dedup and dedup.Is_Replayed_Transaction(lsn):
+                    continue
+
+                buffer.append((lsn, obj))
+                limit = batch_controller.batch_size if batch_controller else batch_size
+                # a heartbeat means the database is quiet, flush now so its lsn gets saved instead of waiting for a full batch
+                # a chunk of a staged transaction (Txn_Staging.py) goes out right away too. batch_size counts transactions,
+                # so otherwise batch_size chunks of chunk_rows changes could pile up here
+                if len(buffer) >= limit or Is_Heartbeat(obj) or "change_offset" in obj:
+                    await Flush()
+
+    finally:
+        if stop_wait is not None:
+            stop_wait.cancel()
+
+    if stopping:
+        await Drain_And_Close(buffer, source, pending_read, apply_batch, persist_lsn, max_retries, backoff_seconds,
+                              failure_policy, dead_letter, is_poison, dedup, shutdown_deadline_seconds)
+    elif buffer:
+        await Process_Batch(buffer, apply_batch, persist_lsn, max_retries, backoff_seconds,
+                            failure_policy, dead_letter, is_poison, dedup)
         buffer.clear()
     else:
         print("buffer empty, we must've finished reading the wal data")
 
 
+''' graceful shutdown, called by Run_Apply_Loop once the stop event is set
+1) the partial batch goes through Process_Batch like any other batch, so its lsn is saved and a restart doesn't replay it
+2) then the source is closed. the source's cleanup terminates pg_recvlogical (and kills it if it won't stop in time)
+the whole thing is bounded by shutdown_deadline_seconds
+'''
+async def Drain_And_Close(buffer, source, pending_read, apply_batch, persist_lsn, max_retries, backoff_seconds,
+                          failure_policy, dead_letter, is_poison, dedup, shutdown_deadline_seconds):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + shutdown_deadline_seconds
+    print(f"Shutting down: draining {len(buffer)} buffered transactions...")
+
+    if buffer:
+        try:
+            await asyncio.wait_for(Process_Batch(buffer, apply_batch, persist_lsn, max_retries, backoff_seconds,
+                                                 failure_policy, dead_letter, is_poison, dedup),
+                                   timeout=max(deadline - loop.time(), 0))
+            buffer.clear()
+        except asyncio.TimeoutError:
+            print("Shutdown deadline hit before the last batch was applied, it will be replayed on restart")
+
+    await Close_Source(source, pending_read, max(deadline - loop.time(), 0.1))
+    print("Shutdown complete")
+
+
+# stops a source we're not finished reading. a read that's still waiting gets cancelled, that runs the source's
+# cleanup (which stops pg_recvlogical). otherwise the generator is closed
+async def Close_Source(source, pending_read, timeout):
+    # a read that finished as the stop came in is dropped (it's replayed on the next start), take its result so a
+    # StopAsyncIteration in it isn't reported as never retrieved
+    if pending_read is not None and pending_read.done() and not pending_read.cancelled():
+        pending_read.exception()
+
+    try:
+        if pending_read is not None and not pending_read.done():
+            pending_read.cancel()
+            await asyncio.wait_for(asyncio.gather(pending_read, return_exceptions=True), timeout=timeout)
+        elif hasattr(source, "aclose"):
+            await asyncio.wait_for(source.aclose(), timeout=timeout)
+    except asyncio.TimeoutError:
+        print("Source didn't close before the shutdown deadline")
+
+
 ''' handles retries, backoff, and gives the ok to save the lsn (persist_lsn)
 - calls the sink (apply_batch) to apply the data
 - if batch is fully successfully processed, it then calls the function that saves the last_applied_lsn to the table
 - if batch fails at all, it retries with exponential backoff up to max_retries
 - what backoff means: when a batch fails to process, we don't retry right away. we wait an increasing amount of time before retrying
     this gives the systems / computer time to hopefully fix themselves or whatever caused the issue
+- returns (events applied, seconds the successful apply_batch call took, failed attempts) for the batch controller
+
+failure_policy
+- 'halt': after max_retries the error is raised and the pipeline stops (the original behavior)
+- 'bisect': a batch that fails with a poison error (is_poison(exc) is True, ex bad data) is split in half until the bad
+  events are found, without waiting through the retries. the good events get applied in bulk, the bad ones go to
+  dead_letter(List[(event, exc)]) and the lsn still moves forward. errors that aren't poison (sink down, timeouts) are
+  retried like before, and if they outlast max_retries the batch is bisected anyway (the first half that fails with a
+  non poison error halts)
+  without is_poison nothing is known to be poison, so the sink's errors can't be told from bad data: it halts like 'halt'
+- dedup (optional): events it has already seen applied are dropped before apply_batch
 '''
+@Profiled("Process_Batch")
 async def Process_Batch(buffer: List[Tuple[str, Dict[str, Any]]], apply_batch, persist_lsn, 
-                        max_retries, backoff_seconds):
+                        max_retries, backoff_seconds, failure_policy="halt", dead_letter=None, is_poison=None,
+                        dedup=None):
     
     # normalize and collect events
     last_lsn = None
     events: List[Dict[str, Any]] = []
 
     for lsn, obj in buffer:
-        last_lsn = lsn
+        if lsn: # chunks of a staged transaction have no lsn until its last one (Txn_Staging.py)
+            last_lsn = lsn
         events.extend(Normalize_Wal2Json(obj))
 
+    if dedup:
+        events = dedup.Filter(events)
+
+    latency, attempt = 0.0, 0
+    if events: # a batch of only heartbeats (or only duplicates) just saves its lsn
+        latency, attempt = await Apply_Events(events, apply_batch, max_retries, backoff_seconds, failure_policy,
+                                              dead_letter, is_poison)
+    if last_lsn:
+        persist_lsn(last_lsn)
+    if dedup:
+        dedup.Mark_Applied(events, last_lsn)
+
+    return len(events), latency, attempt
+
+
+# the retry/backoff/bisect part of Process_Batch, for events that are already normalized. the lane scheduler uses it too
+# returns (seconds the successful apply took, failed attempts)
+async def Apply_Events(events, apply_batch, max_retries, backoff_seconds, failure_policy="halt", dead_letter=None,
+                       is_poison=None):
     # retry with backoff; sink must be idempotent
     attempt = 0
     while True:
         try:
+            started = time.perf_counter()
             await apply_batch(events)
-            if last_lsn:
-                persist_lsn(last_lsn)
-
-            return
+            return time.perf_counter() - started, attempt
 
         except Exception as exc:
             attempt += 1
+            poison = is_poison(exc) if is_poison else False
+
+            if failure_policy == "bisect" and is_poison and (poison or attempt > max_retries):
+                started = time.perf_counter()
+                await Bisect_Batch(events, apply_batch, dead_letter, is_poison)
+                return time.perf_counter() - started, attempt
+
             if attempt > max_retries:
-                # in production: send to dead-letter and move on or halt based on policy
                 raise
             await asyncio.sleep(backoff_seconds * attempt)
+
+
+''' finds the events that make a batch fail (failure_policy=bisect)
+- the whole batch already failed, so split it in half and apply each half. halves that work are done, halves that fail
+  get split again. a single event that fails is poison
+- n events with k bad ones takes about 2k*log2(n) sink calls instead of n
+- a transient error in the middle of this (is_poison says no) is raised, we can't tell good data from bad while the sink is down
+- the poison events are handed to dead_letter in 1 call. if that fails it raises, so nothing is lost
+'''
+async def Bisect_Batch(events, apply_batch, dead_letter, is_poison):
+    poison_events = [] # List[Tuple[Dict[str, Any], Exception]]
+
+    async def Apply_Or_Split(part):
+        try:
+            await apply_batch(part)
+            return
+        except Exception as exc:
+            if not is_poison(exc):
+                raise
+            if len(part) == 1:
+                poison_events.append((part[0], exc))
+                return
+
+        middle = len(part) // 2
+        await Apply_Or_Split(part[:middle])
+        await Apply_Or_Split(part[middle:])
+
+    # we already know the whole batch fails, start with the halves
+    if len(events) > 1:
+        middle = len(events) // 2
+        await Apply_Or_Split(events[:middle])
+        await Apply_Or_Split(events[middle:])
+    elif events:
+        await Apply_Or_Split(events)
+
+    if poison_events:
+        print(f"Dead lettering {len(poison_events)} of {len(events)} events")
+        if dead_letter is None:
+            raise Exception(f"{len(poison_events)} poison events and no dead letter store configured")
+        await dead_letter(poison_events)
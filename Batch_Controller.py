@@ -0,0 +1,60 @@
+'''
+adaptive batch sizing for Run_Apply_Loop (adaptive_batching=true in app.env)
+
+a fixed batch_size is only right for 1 sink load and 1 transaction shape. this controller watches how long each
+apply_batch call takes and how many events/sec it moved, then picks the next batch size between batch_size_min
+and batch_size_max
+
+- retries or a batch slower than the target latency: shrink fast (multiplicative), the sink is struggling
+- batch well under the target: grow by 25%, but only while throughput keeps improving. once a bigger batch stops
+  moving more events/sec there's no point making it bigger, it just adds latency
+- in between: hold
+
+batch size here is counted the same way as batch_size: transactions pulled from the source
+'''
+
+
+class Adaptive_Batch_Controller:
+    def __init__(self, initial_size, min_size, max_size, target_latency_seconds):
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.batch_size = min(max(initial_size, self.min_size), self.max_size)
+        self.target_latency_seconds = target_latency_seconds
+        self.last_throughput = None  # smoothed events/sec of recent healthy batches
+
+    # called after every batch. events: events applied, latency_seconds: time of the successful apply_batch call
+    # retries: failed attempts before it worked
+    def Record_Batch(self, events, latency_seconds, retries):
+        if events == 0 and retries == 0:
+            return  # nothing was written, says nothing about the sink
+
+        previous_size = self.batch_size
+        throughput = events / latency_seconds if latency_seconds > 0 else None
+
+        if retries > 0:
+            self.batch_size = previous_size // 4
+            self.last_throughput = None
+
+        elif latency_seconds > self.target_latency_seconds:
+            # scale down to what should fit the target, and at least halve
+            scaled = int(previous_size * self.target_latency_seconds / latency_seconds)
+            self.batch_size = min(previous_size // 2, scaled)
+            self.last_throughput = None
+
+        elif latency_seconds < self.target_latency_seconds * 0.7 and throughput is not None:
+            # single batches are noisy, so compare against a moving average and leave some slack
+            if self.last_throughput is None or throughput >= self.last_throughput * 0.95:
+                self.batch_size = previous_size + max(1, previous_size // 4)
+            elif throughput < self.last_throughput * 0.8:
+                # the last increase made things worse, step back
+                self.batch_size = previous_size - max(1, previous_size // 10)
+
+            if self.last_throughput is None:
+                self.last_throughput = throughput
+            else:
+                self.last_throughput = 0.7 * self.last_throughput + 0.3 * throughput
+
+        self.batch_size = min(max(self.batch_size, self.min_size), self.max_size)
+
+        if self.batch_size != previous_size:
+            print(f"Batch size {previous_size} -> {self.batch_size} (latency {latency_seconds * 1000:.0f}ms, retries {retries})")
@@ -0,0 +1,182 @@
+from datetime import datetime, timezone
+from Offsets import Lsn_To_Int, Int_To_Lsn
+from Sql_Commands import (Create_Cdc_Events_Partition, List_Cdc_Events_Partitions_Sql, Detach_Cdc_Events_Partition,
+                          Drop_Cdc_Events_Partition)
+
+
+'''
+partition manager for the partitioned cdc_events layout (sink_schema_mode=partitioned)
+
+cdc_events is range partitioned by commit lsn or commit time. every partition covers a fixed width (mb of wal or hours),
+so a partition is identified by an integer index: value // width. each partition has its own small primary key index,
+so inserts cost the same no matter how much history has piled up
+
+- before a batch is inserted we make sure the partitions it needs exist, plus partitions_ahead future ones
+- whenever new partitions get created we also expire old ones, keeping retention_partitions of them
+- partition names hold their lower bound so we can rebuild the index from the catalog after a restart
+    lsn:  cdc_events_l00000000c0000000
+    time: cdc_events_t2024010100
+'''
+
+known_partitions = None # set of partition indexes that exist on the sink. None until loaded from the catalog
+
+
+# width of 1 partition. bytes of wal for lsn partitioning, seconds for time partitioning
+def Partition_Width(app_config):
+    if app_config.partition_by == "time":
+        return app_config.partition_interval_hours * 3600
+
+    return app_config.partition_lsn_span_mb * 1024 * 1024
+
+
+# wal2json timestamps look like '2024-01-01 12:00:00.123456+00'. returns unix seconds
+# missing timestamps get now(), the same default the insert sql uses
+def Commit_Time_Seconds(timestamp):
+    if not timestamp:
+        return datetime.now(timezone.utc).timestamp()
+
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+# which partition an event belongs in
+def Partition_Index(app_config, event):
+    if app_config.partition_by == "time":
+        return int(Commit_Time_Seconds(event.get("commit_time")) // Partition_Width(app_config))
+
+    return Lsn_To_Int(event["commit_lsn"]) // Partition_Width(app_config)
+
+
+def Partition_Name(app_config, index):
+    lower = index * Partition_Width(app_config)
+
+    if app_config.partition_by == "time":
+        return f"cdc_events_t{datetime.fromtimestamp(lower, timezone.utc):%Y%m%d%H}"
+
+    return f"cdc_events_l{lower:016x}"
+
+
+# returns None for tables that aren't ours (someone attached their own partition)
+def Partition_Index_From_Name(app_config, name):
+    try:
+        if app_config.partition_by == "time" and name.startswith("cdc_events_t"):
+            lower = datetime.strptime(name[len("cdc_events_t"):], "%Y%m%d%H").replace(tzinfo=timezone.utc)
+            return int(lower.timestamp()) // Partition_Width(app_config)
+
+        if app_config.partition_by == "lsn" and name.startswith("cdc_events_l"):
+            return int(name[len("cdc_events_l"):], 16) // Partition_Width(app_config)
+
+    except ValueError:
+        pass
+
+    return None
+
+
+# sql literals for the FROM/TO bounds of a partition
+def Partition_Bounds_Sql(app_config, index):
+    width = Partition_Width(app_config)
+    lower = index * width
+    upper = lower + width
+
+    if app_config.partition_by == "time":
+        return (f"'{datetime.fromtimestamp(lower, timezone.utc).isoformat()}'",
+                f"'{datetime.fromtimestamp(upper, timezone.utc).isoformat()}'")
+
+    if app_config.lsn_column_type == "bigint":
+        return str(lower), str(upper)
+
+    return f"'{Int_To_Lsn(lower)}'", f"'{Int_To_Lsn(upper)}'"
+
+
+def Load_Known_Partitions(app_config, rows):
+    global known_partitions
+
+    known_partitions = set()
+    for (name,) in rows:
+        index = Partition_Index_From_Name(app_config, name)
+        if index is not None:
+            known_partitions.add(index)
+
+
+def Reset_Known_Partitions():
+    global known_partitions
+    known_partitions = None
+
+
+# works out the ddl this batch needs: missing partitions for the batch plus the future ones, and if anything is
+# being created, the expired partitions to detach/drop. known_partitions isn't changed until Commit_Partition_Plan()
+# this is a set lookup per batch in the normal case, the catalog is only touched when the horizon moves
+# events: List[Dict[str, Any]]
+# returns (sql statements, indexes created, indexes expired)
+def Plan_Partitions(app_config, events):
+    if not events:
+        return [], [], []
+
+    indexes = [Partition_Index(app_config, event) for event in events]
+    oldest, newest = min(indexes), max(indexes)
+
+    needed = set(indexes) | set(range(newest, newest + app_config.partitions_ahead + 1))
+    missing = sorted(needed - known_partitions)
+    if not missing:
+        return [], [], []
+
+    statements = []
+    for index in missing:
+        lower_bound, upper_bound = Partition_Bounds_Sql(app_config, index)
+        statements.append(Create_Cdc_Events_Partition(Partition_Name(app_config, index), lower_bound, upper_bound))
+
+    expired = Expired_Partitions(app_config, oldest, newest)
+    for index in expired:
+        name = Partition_Name(app_config, index)
+        if app_config.retention_action == "drop":
+            statements.append(Drop_Cdc_Events_Partition(name))
+        else:
+            statements.append(Detach_Cdc_Events_Partition(name))
+
+    return statements, missing, expired
+
+
+# records the plan as applied as soon as its ddl ran. if the caller's commit then fails it has to
+# Reset_Known_Partitions() so the next batch reloads the real state from the catalog
+def Commit_Partition_Plan(app_config, created, expired):
+    known_partitions.update(created)
+    for index in expired:
+        known_partitions.discard(index)
+        print(f"Retention: {app_config.retention_action} partition {Partition_Name(app_config, index)}")
+
+
+# sync version, used by Apply_Postgres. returns True if it ran ddl (caller commits it)
+def Ensure_Partitions(cur, app_config, events):
+    if known_partitions is None:
+        cur.execute(List_Cdc_Events_Partitions_Sql())
+        Load_Known_Partitions(app_config, cur.fetchall())
+
+    statements, created, expired = Plan_Partitions(app_config, events)
+    for statement in statements:
+        cur.execute(statement)
+
+    Commit_Partition_Plan(app_config, created, expired)
+    return len(statements) > 0
+
+
+# async version, used by Apply_Postgres_Async
+async def Ensure_Partitions_Async(cur, app_config, events):
+    if known_partitions is None:
+        await cur.execute(List_Cdc_Events_Partitions_Sql())
+        Load_Known_Partitions(app_config, await cur.fetchall())
+
+    statements, created, expired = Plan_Partitions(app_config, events)
+    for statement in statements:
+        await cur.execute(statement)
+
+    Commit_Partition_Plan(app_config, created, expired)
+    return len(statements) > 0
+
+
+# keep retention_partitions partitions up to and including the newest one with data
+# never expires a partition the current batch is writing into (replays can land in old partitions)
+def Expired_Partitions(app_config, oldest_in_batch, newest_in_batch):
+    if app_config.retention_partitions <= 0:
+        return []
+
+    cutoff = min(oldest_in_batch, newest_in_batch - app_config.retention_partitions + 1)
+    return sorted(i for i in known_partitions if i < cutoff)
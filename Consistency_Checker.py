@@ -0,0 +1,274 @@
+"""
+Chunked consistency check between the primary and a copy of its tables (the standby subscriber)
+
+the old way was SELECT * on both sides and diffing in python, which takes hours and reads every row over the network.
+this splits each table into primary key ranges and only ships hashes:
+- for every range both servers return count(*) and an order independent hash of the rows in it (sum of each row's
+  md5), computed where the data is. only 2 numbers per range cross the network
+- all the ranges of a level are hashed at once, --workers threads with their own connections to each server
+- a range whose hash matches is done. a range that differs is split into --fanout smaller ranges and hashed again,
+  until it's --leaf-rows rows or less. only those leaf ranges are compared row by row (key + md5 per row)
+- the result is every key that's missing on the target, extra on the target, or has different values
+
+integer keys are split arithmetically from min/max. other keys (text, uuid, composite) get their first bounds from a
+TABLESAMPLE of the primary, and differing ranges are split at row offsets inside the range
+
+both sides keep changing while this runs, and the standby is always a little behind, so keys changed during the check
+can show up as differences. --recheck-seconds waits and compares just the reported keys again to filter those out
+
+ex) python Consistency_Checker.py --tables public.test_data --workers 8 --ranges 64 --output differences.jsonl
+"""
+
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+import psycopg
+from Sql_Commands import (Get_Primary_Key_Columns_Sql, Key_Range_Hash_Sql, Key_Range_Row_Hashes_Sql,
+                          Integer_Key_Bounds_Sql, Sample_Keys_Sql, Key_At_Offset_Sql, Key_Row_Hash_Sql)
+
+
+INTEGER_KEY_TYPES = ("smallint", "integer", "bigint")
+
+
+# 1 connection per worker thread per server
+class Server:
+    def __init__(self, name, dsn):
+        self.name = name
+        self.dsn = dsn
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def Query(self, sql_command, params=()):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = psycopg.connect(self.dsn, autocommit=True)
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+
+        with conn.cursor() as cur:
+            cur.execute(sql_command, params)
+            return cur.fetchall()
+
+    def Close(self):
+        for conn in self.connections:
+            conn.close()
+
+
+@dataclass
+class Key_Range:
+    lower: Optional[Tuple] # inclusive, None = open
+    upper: Optional[Tuple] # exclusive, None = open
+
+    def Params(self):
+        return tuple(self.lower or ()) + tuple(self.upper or ())
+
+
+@dataclass
+class Table_Report:
+    table: str
+    ranges_hashed: int = 0
+    ranges_differing: int = 0
+    rows_compared: int = 0
+    missing: List = field(default_factory=list)  # on the primary, not on the target
+    extra: List = field(default_factory=list)    # on the target, not on the primary
+    changed: List = field(default_factory=list)  # on both with different values
+
+
+def Range_Hash(server, table, key_columns, key_range):
+    sql_command = Key_Range_Hash_Sql(table, key_columns, key_range.lower is not None, key_range.upper is not None)
+    count, row_hash = server.Query(sql_command, key_range.Params())[0]
+    return count, row_hash
+
+
+def Range_Row_Hashes(server, table, key_columns, key_range):
+    sql_command = Key_Range_Row_Hashes_Sql(table, key_columns, key_range.lower is not None, key_range.upper is not None)
+    return {tuple(row[:-1]): row[-1] for row in server.Query(sql_command, key_range.Params())}
+
+
+# the first level of ranges, covering every key on either side
+def Initial_Ranges(primary, target, table, key_columns, key_types, ranges, sample_percent):
+    if len(key_columns) == 1 and key_types[0] in INTEGER_KEY_TYPES:
+        bounds = [primary.Query(Integer_Key_Bounds_Sql(table, key_columns[0]))[0],
+                  target.Query(Integer_Key_Bounds_Sql(table, key_columns[0]))[0]]
+        lows = [low for low, _ in bounds if low is not None]
+        highs = [high for _, high in bounds if high is not None]
+        if not lows:
+            return [] # empty on both sides
+
+        return Split_Integer_Range(min(lows), max(highs) + 1, ranges)
+
+    sample = primary.Query(Sample_Keys_Sql(table, key_columns), (sample_percent,))
+    step = max(len(sample) // ranges, 1)
+    cut_points = []
+    for row in sample[step::step]:
+        if not cut_points or tuple(row) != cut_points[-1]:
+            cut_points.append(tuple(row))
+
+    edges = [None] + cut_points + [None]
+    return [Key_Range(edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+
+
+def Split_Integer_Range(low, high, parts):
+    width = max((high - low + parts - 1) // parts, 1)
+    return [Key_Range((start,), (min(start + width, high),)) for start in range(low, high, width)]
+
+
+# splits a differing range into about `fanout` ranges. returns [] if it can't be split any further
+def Split_Range(table, key_columns, integer_key, key_range, rows, fanout, bigger_side):
+    if integer_key and key_range.lower is not None and key_range.upper is not None:
+        if key_range.upper[0] - key_range.lower[0] <= 1:
+            return []
+        return Split_Integer_Range(key_range.lower[0], key_range.upper[0], fanout)
+
+    # cut at row offsets, read on whichever side has more rows in the range so every row lands in a sub range
+    sql_command = Key_At_Offset_Sql(table, key_columns, key_range.lower is not None, key_range.upper is not None)
+    cut_points = []
+    for i in range(1, fanout):
+        found = bigger_side.Query(sql_command, key_range.Params() + (rows * i // fanout,))
+        if found and tuple(found[0]) != key_range.lower and (not cut_points or tuple(found[0]) > cut_points[-1]):
+            cut_points.append(tuple(found[0]))
+
+    if not cut_points:
+        return []
+
+    edges = [key_range.lower] + cut_points + [key_range.upper]
+    return [Key_Range(edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+
+
+def Compare_Rows(primary_rows, target_rows, report):
+    for key, row_hash in primary_rows.items():
+        if key not in target_rows:
+            report.missing.append(key)
+        elif target_rows[key] != row_hash:
+            report.changed.append(key)
+
+    report.extra.extend(key for key in target_rows if key not in primary_rows)
+    report.rows_compared += max(len(primary_rows), len(target_rows))
+
+
+def Check_Table(primary, target, table, executor, args):
+    key_info = primary.Query(Get_Primary_Key_Columns_Sql(), (table,))
+    if not key_info:
+        raise Exception(f"{table} has no primary key, it can't be checked in ranges")
+
+    key_columns = [name for name, _ in key_info]
+    key_types = [pg_type for _, pg_type in key_info]
+    integer_key = len(key_columns) == 1 and key_types[0] in INTEGER_KEY_TYPES
+    report = Table_Report(table)
+
+    level = Initial_Ranges(primary, target, table, key_columns, key_types, args.ranges, args.sample_percent)
+    depth = 0
+    while level:
+        # hash every range of this level on both servers at once
+        primary_hashes = [executor.submit(Range_Hash, primary, table, key_columns, r) for r in level]
+        target_hashes = [executor.submit(Range_Hash, target, table, key_columns, r) for r in level]
+
+        next_level = []
+        leaves = []
+        for key_range, primary_future, target_future in zip(level, primary_hashes, target_hashes):
+            report.ranges_hashed += 1
+            primary_count, primary_hash = primary_future.result()
+            target_count, target_hash = target_future.result()
+            if primary_count == target_count and primary_hash == target_hash:
+                continue
+
+            report.ranges_differing += 1
+            rows = max(primary_count, target_count)
+            sub_ranges = []
+            if rows > args.leaf_rows:
+                bigger_side = primary if primary_count >= target_count else target
+                sub_ranges = Split_Range(table, key_columns, integer_key, key_range, rows, args.fanout, bigger_side)
+            if sub_ranges:
+                next_level.extend(sub_ranges)
+            else:
+                leaves.append(key_range)
+
+        # leaf ranges are compared row by row, also all at once
+        primary_rows = [executor.submit(Range_Row_Hashes, primary, table, key_columns, r) for r in leaves]
+        target_rows = [executor.submit(Range_Row_Hashes, target, table, key_columns, r) for r in leaves]
+        for primary_future, target_future in zip(primary_rows, target_rows):
+            Compare_Rows(primary_future.result(), target_future.result(), report)
+
+        depth += 1
+        print(f"{table}: level {depth} hashed {len(level)} ranges, {len(next_level)} to split, {len(leaves)} compared by row")
+        level = next_level
+
+    return report
+
+
+# compares just the reported keys again, keeping the ones that still differ
+def Recheck(primary, target, table, report):
+    key_columns = [name for name, _ in primary.Query(Get_Primary_Key_Columns_Sql(), (table,))]
+    sql_command = Key_Row_Hash_Sql(table, key_columns)
+    still = Table_Report(table)
+    for key in report.missing + report.extra + report.changed:
+        primary_rows = {tuple(row[:-1]): row[-1] for row in primary.Query(sql_command, key)}
+        target_rows = {tuple(row[:-1]): row[-1] for row in target.Query(sql_command, key)}
+        Compare_Rows(primary_rows, target_rows, still)
+
+    still.ranges_hashed = report.ranges_hashed
+    still.ranges_differing = report.ranges_differing
+    still.rows_compared = report.rows_compared
+    return still
+
+
+def Print_Report(report, seconds):
+    print(f"{report.table}: {report.ranges_hashed} ranges hashed, {report.ranges_differing} differed, "
+          f"{report.rows_compared} rows compared by row in {seconds:.1f}s")
+    print(f"{report.table}: {len(report.missing)} missing, {len(report.extra)} extra, {len(report.changed)} changed on the target")
+
+
+def Write_Differences(path, reports):
+    with open(path, "w", encoding="utf-8") as f:
+        for report in reports:
+            for problem, keys in (("missing", report.missing), ("extra", report.extra), ("changed", report.changed)):
+                for key in keys:
+                    f.write(json.dumps({"table": report.table, "key": list(key), "problem": problem}, default=str) + "\n")
+
+
+def Main():
+    parser = argparse.ArgumentParser(description="compare tables on the primary and the standby by primary key ranges")
+    parser.add_argument("--tables", default="public.test_data", help="comma separated schema.table list")
+    parser.add_argument("--target", default="standby", choices=["standby"], help="what to compare the primary against")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent queries per server")
+    parser.add_argument("--ranges", type=int, default=64, help="key ranges per table on the first level")
+    parser.add_argument("--fanout", type=int, default=8, help="sub ranges a differing range is split into")
+    parser.add_argument("--leaf-rows", type=int, default=1000, help="ranges this small are compared row by row")
+    parser.add_argument("--sample-percent", type=float, default=1.0, help="TABLESAMPLE % used to pick bounds for non integer keys")
+    parser.add_argument("--recheck-seconds", type=float, default=0, help="wait this long and recheck the differences, 0 = don't")
+    parser.add_argument("--output", metavar="PATH", help="write the differing keys to PATH as json lines")
+    args = parser.parse_args()
+
+    from Startup_Config import Load_Docker_Env_Config
+    from Test_Data_Generator import Make_Dsn
+
+    primary = Server("primary", Make_Dsn(Load_Docker_Env_Config('Primary.env')))
+    target = Server(args.target, Make_Dsn(Load_Docker_Env_Config('Standby.env')))
+
+    reports = []
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers * 2) as executor:
+            for table in [t.strip() for t in args.tables.split(",") if t.strip()]:
+                started = time.monotonic()
+                report = Check_Table(primary, target, table, executor, args)
+                if args.recheck_seconds > 0 and (report.missing or report.extra or report.changed):
+                    time.sleep(args.recheck_seconds)
+                    report = Recheck(primary, target, table, report)
+                Print_Report(report, time.monotonic() - started)
+                reports.append(report)
+    finally:
+        primary.Close()
+        target.Close()
+
+    if args.output:
+        Write_Differences(args.output, reports)
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit, parse_qsl
+
+
+'''
+local control api for a running pipeline (control_port in app.env, 0 = off)
+
+batch_size, max_retries, backoff_seconds etc are read once from app.env, and changing them used to mean a restart and
+a replay. during an incident we want to slow down or stop writing into a struggling sink in seconds
+
+http on control_host (127.0.0.1 by default, there's no auth so keep it local), json replies
+    GET  /status                         settings, paused, buffered transactions, last saved lsn, batches applied
+    POST /pause                          stop reading from pg_recvlogical (it backs up and wal is held by the slot)
+    POST /resume
+    POST /flush                          send the partial batch through now instead of waiting for a full one
+    POST /set?max_events_per_second=500  any of SETTINGS, several at once is fine. max_events_per_second 0 = no cap
+    ex) curl -X POST "http://127.0.0.1:8765/set?batch_size=200&backoff_seconds=5"
+
+nothing here touches a batch that's in flight. handlers only change fields on Pipeline_Control and wake the apply loop,
+which picks them up between batches: pause before its next read, flush and new batch/retry settings before the next
+batch, the rate cap before the next apply_batch call (Main wraps apply_batch with Throttled, so bisect retries and lanes
+are capped too)
+- with adaptive_batching, batch_size/batch_size_min/batch_size_max/target_batch_latency_ms move the controller and it
+  keeps adapting from there
+- the lane loop (lanes_config_path) supports pause, the rate cap and max_retries/backoff_seconds. lanes have their own
+  batch sizes and flush on linger_seconds, so batch_size and flush don't apply there
+- status_interval_seconds is a pg_recvlogical argument, it only changes with a source restart, so it's not here
+- with decode shards (Slot_Shards.py) there's 1 apply loop per shard. each one attaches, and pause/flush/settings reach
+  all of them
+'''
+
+SETTINGS = {
+    "batch_size": int,
+    "batch_size_min": int,
+    "batch_size_max": int,
+    "target_batch_latency_ms": float,
+    "max_retries": int,
+    "backoff_seconds": float,
+    "max_events_per_second": float,
+}
+
+MAX_REQUEST_LINE = 8192
+
+
+# 1 per apply loop, so a wake or a flush reaches every loop and not just the first one to look
+class Loop_Handle:
+    def __init__(self, buffer):
+        self.buffer = buffer           # the loop's buffer, for /status
+        self.changed = asyncio.Event() # wakes the loop while it's waiting on the source
+        self.flush_requested = False
+
+
+class Pipeline_Control:
+    def __init__(self, batch_size, max_retries, backoff_seconds, batch_controller=None, max_events_per_second=0.0):
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.batch_controller = batch_controller
+        self.max_events_per_second = max_events_per_second
+        self.running = asyncio.Event() # cleared while paused
+        self.running.set()
+        self.loops = []                # Loop_Handle per attached apply loop
+        self.next_free = 0.0           # monotonic time the rate cap lets the next batch start
+        self.last_saved_lsn = None
+        self.batches_applied = 0
+        self.throttled_seconds = 0.0
+
+    def Attach(self, buffer):
+        handle = Loop_Handle(buffer)
+        self.loops.append(handle)
+        return handle
+
+    def Wake(self):
+        for handle in self.loops:
+            handle.changed.set()
+
+    # the apply loop waits on this next to its source read
+    async def Wait_For_Change(self, handle):
+        await handle.changed.wait()
+        handle.changed.clear()
+
+    # returns once it's resumed, stopping, or something else changed for the loop (a flush while paused still goes
+    # through). loops without a handle (lanes) only wake on resume or stop
+    async def Wait_While_Paused(self, stop_event=None, handle=None):
+        waiting = [asyncio.ensure_future(self.running.wait())]
+        if handle is not None:
+            waiting.append(asyncio.ensure_future(self.Wait_For_Change(handle)))
+        if stop_event is not None:
+            waiting.append(asyncio.ensure_future(stop_event.wait()))
+        try:
+            await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in waiting:
+                task.cancel()
+
+    def Take_Flush(self, handle):
+        requested, handle.flush_requested = handle.flush_requested, False
+        return requested
+
+    # paces batches to max_events_per_second. each batch books its share of time, the next one starts after it
+    async def Throttle(self, count):
+        rate = self.max_events_per_second
+        if rate <= 0:
+            return
+
+        now = time.monotonic()
+        start = max(self.next_free, now)
+        self.next_free = start + count / rate
+        if start > now:
+            self.throttled_seconds += start - now
+            await asyncio.sleep(start - now)
+
+    # wraps apply_batch so every sink call (retries and bisect halves too) goes through the rate cap
+    def Throttled(self, apply_batch):
+        async def Apply(events):
+            await self.Throttle(len(events))
+            await apply_batch(events)
+            self.batches_applied += 1
+
+        return Apply
+
+    def Set(self, name, text):
+        value = SETTINGS[name](text)
+        if value < 0:
+            raise ValueError(f"{name} can't be negative")
+
+        controller = self.batch_controller
+        if name == "batch_size":
+            self.batch_size = max(1, value)
+            if controller:
+                controller.batch_size = min(max(self.batch_size, controller.min_size), controller.max_size)
+        elif name == "batch_size_min" and controller:
+            controller.min_size = max(1, value)
+            controller.max_size = max(controller.min_size, controller.max_size)
+        elif name == "batch_size_max" and controller:
+            controller.max_size = max(controller.min_size, value)
+        elif name == "target_batch_latency_ms" and controller:
+            controller.target_latency_seconds = value / 1000
+        elif name in ("batch_size_min", "batch_size_max", "target_batch_latency_ms"):
+            raise ValueError(f"{name} needs adaptive_batching=true")
+        else:
+            setattr(self, name, value)
+
+        if controller:
+            controller.batch_size = min(max(controller.batch_size, controller.min_size), controller.max_size)
+        print(f"Control api: {name} = {value}")
+
+    def Status(self):
+        controller = self.batch_controller
+        status = {
+            "paused": not self.running.is_set(),
+            "buffered_transactions": sum(len(handle.buffer) for handle in self.loops),
+            "last_saved_lsn": self.last_saved_lsn,
+            "batches_applied": self.batches_applied,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+            "batch_size": controller.batch_size if controller else self.batch_size,
+            "max_retries": self.max_retries,
+            "backoff_seconds": self.backoff_seconds,
+            "max_events_per_second": self.max_events_per_second,
+        }
+        if controller:
+            status.update(batch_size_min=controller.min_size, batch_size_max=controller.max_size,
+                          target_batch_latency_ms=controller.target_latency_seconds * 1000)
+
+        return status
+
+    # (http status, reply) for 1 request
+    def Handle(self, method, target):
+        url = urlsplit(target)
+        if method == "GET" and url.path == "/status":
+            return 200, self.Status()
+        if method != "POST":
+            return 405, {"error": "use GET /status or POST"}
+
+        if url.path == "/pause":
+            self.running.clear()
+            print("Control api: paused")
+        elif url.path == "/resume":
+            self.running.set()
+            print("Control api: resumed")
+        elif url.path == "/flush":
+            for handle in self.loops:
+                handle.flush_requested = True
+        elif url.path == "/set":
+            params = parse_qsl(url.query)
+            unknown = [name for name, _ in params if name not in SETTINGS]
+            if not params or unknown:
+                return 400, {"error": f"unknown settings {unknown}, use {sorted(SETTINGS)}"}
+            try:
+                for name, text in params:
+                    self.Set(name, text)
+            except ValueError as e:
+                return 400, {"error": str(e)}
+        else:
+            return 404, {"error": f"no endpoint {url.path}"}
+
+        self.Wake()
+        return 200, self.Status()
+
+    async def Handle_Client(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while True: # headers, nothing in them we need
+                header = await asyncio.wait_for(reader.readline(), timeout=5)
+                if header in (b"\r\n", b"\n", b""):
+                    break
+
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2:
+                code, reply = 400, {"error": "bad request"}
+            else:
+                code, reply = self.Handle(parts[0].upper(), parts[1])
+
+            body = json.dumps(reply).encode("utf-8")
+            writer.write(f"HTTP/1.1 {code} {'OK' if code == 200 else 'Error'}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+# returns the asyncio server, Main closes it at the end
+async def Start_Control_Server(control, host, port):
+    server = await asyncio.start_server(control.Handle_Client, host, port, limit=MAX_REQUEST_LINE)
+    print(f"Control api listening on http://{host}:{port}")
+    return server
@@ -0,0 +1,65 @@
+import json
+import os
+from pathlib import Path
+import psycopg
+from psycopg.types.json import Jsonb
+from Sql_Commands import Create_Dead_Letter_Table, Insert_Into_Dead_Letters
+from Sink_Postgres import Raw_Jsonb
+
+
+'''
+dead letter store for poison events (failure_policy=bisect in app.env)
+
+when Process_Batch finds events the sink will never accept, they're written here with their lsn and the error
+instead of stopping the pipeline. dead_letter_target picks where:
+    file:  1 json object per line in dead_letter_path. it's fsync'd before we return so the lsn can move past them
+    table: cdc_dead_letters on the sink
+
+poison: List[Tuple[Dict[str, Any], Exception]] (event, error)
+'''
+
+
+# create the sink table if it doesn't already exist
+def Create_Dead_Letter_Store(dsn):
+    try:
+        with psycopg.connect(dsn) as cx:
+            with cx.cursor() as cur:
+                cur.execute(Create_Dead_Letter_Table())
+            cx.commit()
+
+    except Exception as e:
+        raise Exception(f"Failed to create dead letter table: {e}")
+
+
+def Write_Dead_Letters_File(path, poison):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(path, "a", encoding="utf-8") as f:
+        for event, error in poison:
+            record = {
+                "table": event.get("table"),
+                "pk": event.get("pk"),
+                "commit_lsn": event.get("commit_lsn"),
+                "error": repr(error),
+                "event": event,
+            }
+            f.write(json.dumps(record, default=str) + "\n")
+
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def Write_Dead_Letters_Table(dsn, poison):
+    insert_sql = Insert_Into_Dead_Letters()
+    rows = [(event.get("table"),
+             event.get("pk") if isinstance(event.get("pk"), str) else json.dumps(event.get("pk"), default=str),
+             event.get("commit_lsn"),
+             repr(error),
+             Raw_Jsonb(event["payload_raw"]) if "payload_raw" in event
+             else Jsonb(event.get("payload_json"), dumps=lambda obj: json.dumps(obj, default=str)))
+            for event, error in poison]
+
+    with psycopg.connect(dsn, connect_timeout=5) as cx:
+        with cx.cursor() as cur:
+            cur.executemany(insert_sql, rows)
+        cx.commit()
@@ -0,0 +1,86 @@
+import json
+from collections import OrderedDict
+from Offsets import Lsn_To_Int
+
+
+'''
+duplicate filter for replayed wal (dedup_enabled=true in app.env)
+
+after a restart pg_recvlogical replays from the saved lsn, and before this every replayed event went through
+normalization, the network and an index probe on the sink before ON CONFLICT DO NOTHING threw it away. 2 layers:
+
+1) transaction floor: the last saved lsn. a transaction whose lsn is at or below it is already in the sink, Run_Apply_Loop
+   drops it before it's even buffered or normalized. the floor moves up every time a batch's lsn is saved
+2) bounded lru set of (table, pk, commit_lsn, position) for events applied above the floor, for replays the floor can't
+   see (ex a source that doesn't give comparable lsn's). capacity bounds the memory, the least recently seen keys
+   (applied or skipped as a repeat) fall out first.
+   position (the change's place in its transaction) keeps 2 changes to 1 row in 1 transaction apart, ex an insert
+   then an update with include-pk, or the same row in 2 chunks of a staged transaction. without it the later change
+   looked like a repeat and was dropped
+
+the sink stays idempotent, this only saves work. a false "not seen" just means the sink drops it like before
+'''
+
+
+# wal2json lsn's are 'X/Y' text. anything else (ex the xid fallback in Source_Pg) can't be compared
+def Comparable_Lsn(lsn):
+    if isinstance(lsn, str) and "/" in lsn:
+        return Lsn_To_Int(lsn)
+
+    return None
+
+
+def Event_Key(event):
+    pk = event.get("pk")
+    if isinstance(pk, list):
+        pk = json.dumps(pk, default=str)
+
+    return (event.get("table"), pk, event.get("commit_lsn"), event.get("position"))
+
+
+class Dedup_Filter:
+    def __init__(self, capacity, floor_lsn=None):
+        self.capacity = capacity
+        self.seen = OrderedDict() # Event_Key -> None, least recently seen first
+        self.floor = Comparable_Lsn(floor_lsn)
+        self.skipped_transactions = 0
+        self.skipped_events = 0
+
+    # layer 1. True if this transaction is at or below the last saved lsn
+    def Is_Replayed_Transaction(self, lsn):
+        value = Comparable_Lsn(lsn)
+        if self.floor is None or value is None or value > self.floor:
+            return False
+
+        self.skipped_transactions += 1
+        return True
+
+    # layer 2. returns the events that haven't been applied yet, also dropping repeats inside the batch
+    def Filter(self, events):
+        fresh = []
+        batch_keys = set()
+        for event in events:
+            key = Event_Key(event)
+            if key in self.seen or key in batch_keys:
+                if key in self.seen:
+                    self.seen.move_to_end(key) # still being replayed, keep it
+                self.skipped_events += 1
+                continue
+            batch_keys.add(key)
+            fresh.append(event)
+
+        return fresh
+
+    # called once the batch is applied and its lsn saved
+    def Mark_Applied(self, events, lsn):
+        for event in events:
+            key = Event_Key(event)
+            self.seen[key] = None
+            self.seen.move_to_end(key)
+
+        while len(self.seen) > self.capacity:
+            self.seen.popitem(last=False)
+
+        value = Comparable_Lsn(lsn)
+        if value is not None and (self.floor is None or value > self.floor):
+            self.floor = value
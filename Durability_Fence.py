@@ -0,0 +1,93 @@
+import asyncio
+import time
+import psycopg
+from Sql_Commands import Set_Durable_Commit_Sql, Durability_Fence_Sql
+
+
+'''
+relaxed durability for the postgres sink (sink_durability=fenced in app.env)
+
+every batch is its own sink transaction, and by default its commit waits for the sink to flush its wal to disk. with
+small batches that flush is most of the batch's time. in fenced mode:
+- the batch transactions commit with synchronous_commit=off. the commit returns as soon as the commit record is in
+  the sink's wal buffers, postgres' wal writer flushes it a moment later
+- Batch_Committed(lsn) is called where the lsn would normally be saved. it only remembers it, until fence_every_batches
+  batches or fence_interval_ms have gone by since the last fence
+- then it starts a fence: 1 tiny durable commit on its own connection, in a worker thread so the event loop keeps
+  going. the wal is flushed in order, so once that commit returns every batch committed before it is on disk, and the
+  newest lsn they cover is handed to on_fenced (Main saves it there)
+
+a sink crash loses at most the batches after the last fence. their lsn's were never saved, so they're replayed, and
+cdc_events' insert is idempotent, so at least once delivery holds
+
+- the interval is checked when a batch finishes. on a quiet stream the last batches wait for the next batch (or
+  heartbeat) or the shutdown, which fences whatever is left
+- 1 fence runs at a time. batches that finish while it's running wait for the next one
+- a failed fence isn't fatal, the lsn just isn't saved yet and the next batch tries again
+'''
+
+
+class Durability_Fence:
+    def __init__(self, dsn, every_batches, interval_seconds, on_fenced):
+        self.dsn = dsn
+        self.every_batches = max(1, every_batches)
+        self.interval_seconds = interval_seconds
+        self.on_fenced = on_fenced # called on the event loop with the lsn a fence covers
+        self.cx = None             # only used from the fence's worker thread
+        self.pending_lsn = None    # newest batch lsn committed since the last fence started
+        self.batches = 0
+        self.last_fence = time.monotonic()
+        self.running = None        # the fence task in flight
+        self.fences = 0
+
+    # called instead of saving the lsn, on the event loop. starts a fence in the background when one is due
+    def Batch_Committed(self, lsn):
+        self.pending_lsn = lsn
+        self.batches += 1
+
+        if self.running is None and (self.batches >= self.every_batches or
+                                     time.monotonic() - self.last_fence >= self.interval_seconds):
+            self.running = asyncio.get_running_loop().create_task(self.Fence())
+
+    # fences the pending lsn, hands it to on_fenced if the durable commit went through
+    async def Fence(self):
+        lsn = self.pending_lsn
+        self.pending_lsn = None
+        self.batches = 0
+        self.last_fence = time.monotonic()
+        try:
+            if lsn is not None and await asyncio.to_thread(self.Durable_Commit):
+                self.fences += 1
+                self.on_fenced(lsn)
+            elif lsn is not None and self.pending_lsn is None:
+                self.pending_lsn = lsn # the next fence covers it
+        finally:
+            self.running = None
+
+    # runs in a worker thread. False if the fence failed
+    def Durable_Commit(self):
+        try:
+            if self.cx is None or self.cx.closed:
+                self.cx = psycopg.connect(self.dsn, connect_timeout=5)
+            with self.cx.cursor() as cur:
+                cur.execute(Set_Durable_Commit_Sql())
+                cur.execute(Durability_Fence_Sql())
+            self.cx.commit()
+        except psycopg.Error as e:
+            print(f"ERROR: durability fence failed, the lsn is saved after the next one: {e}")
+            self.Close_Conn()
+            return False
+
+        return True
+
+    # waits for the fence in flight, then fences whatever is left
+    async def Close(self):
+        if self.running is not None:
+            await self.running
+        await self.Fence()
+        await asyncio.to_thread(self.Close_Conn)
+
+    def Close_Conn(self):
+        if self.cx is not None:
+            self.cx.close()
+            self.cx = None
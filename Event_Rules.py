@@ -0,0 +1,259 @@
+import hashlib
+import json
+from collections import OrderedDict
+
+
+'''
+per table filter/projection/rename/masking rules, applied in Normalize_Wal2Json (rules_config_path in app.env)
+
+without rules every change goes to the sink as wal2json sent it. with a rules file, changes that aren't wanted are
+dropped, and the ones that are keep only the wanted columns, renamed and masked, before anything downstream
+(dedup, the sink, dead letters) holds on to them
+
+like Value_Converters.py, the rules aren't interpreted per event. the first time a table shows up with a column list
+the rule is compiled for that exact column list: column positions are looked up once and python source is generated
+with the predicate, the projection and the masks inlined, so per event it's 1 call to a flat function
+
+rules file (json). tables not listed pass through unchanged
+{
+    "mask_salt": "change me",
+    "tables": {
+        "public.users": {
+            "where": [["status", "=", "active"], ["age", ">=", 18]],
+            "columns": ["id", "email", "name", "ssn"],
+            "rename": {"name": "full_name"},
+            "mask": {"email": "hash", "ssn": "last4"}
+        },
+        "public.audit_log": {"drop": true}
+    }
+}
+- where: all conditions must match. ops: = != < <= > >= in not_in is_null not_null. inserts/updates are checked on
+  their new values. < <= > >= take a number or a string, a value of the other kind (or null) doesn't match, it never
+  stops the pipeline. in/not_in take a list. deletes only have their key columns, they're checked when every where
+  column is a key column and kept otherwise (better a delete the sink ignores than a row it never removes)
+- an update whose new values no longer match where goes out as a delete of its key, so the sink (and the latest_state
+  tables) doesn't keep the row as it was before it left the filter. when oldkeys has every where column (replica
+  identity full) and the old values didn't match either, the sink never had the row and the update is just dropped
+- columns: the columns to keep, in this order. the key columns in oldkeys are always kept so deletes still work
+- mask: redact ('****'), null, hash (sha256 of mask_salt + value, stable so it still joins), last4 ('****1234').
+  masks apply to oldkeys too, so a masked key stays consistent
+'''
+
+MAX_SHAPES_PER_TABLE = 4
+
+table_rules = {} # "schema.table" -> Table_Rule. empty = no rules file
+
+OPERATORS = {"=": "==", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">="}
+ORDERING = ("<", "<=", ">", ">=")
+
+# wal2json sends these as json numbers, everything else that can be ordered comes as a string
+NUMERIC_TYPES = ("smallint", "integer", "bigint", "numeric", "real", "double precision", "int2", "int4", "int8",
+                 "float4", "float8", "oid")
+
+
+def Load_Event_Rules(path):
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    salt = config.get("mask_salt", "")
+    table_rules.clear()
+    for table, rule in config.get("tables", {}).items():
+        table_rules[table] = Table_Rule(table, rule, salt)
+
+    print(f"Loaded event rules for {len(table_rules)} tables from {path}")
+
+
+def Is_Scalar(value):
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
+# the types a where literal can be compared with. bool is an int to python, but true < 5 isn't a sensible rule
+def Comparable_Types(literal):
+    if isinstance(literal, str):
+        return (str,)
+    if isinstance(literal, (int, float)) and not isinstance(literal, bool):
+        return (int, float)
+
+    return None
+
+
+def Check_Condition(table, condition):
+    if not isinstance(condition, list) or len(condition) < 2:
+        raise Exception(f"where condition {condition} in the rule for {table} should be [column, op, value]")
+
+    column, op, *operand = condition
+    if op not in OPERATORS and op not in ("in", "not_in", "is_null", "not_null"):
+        raise Exception(f"unknown where operator '{op}' in the rule for {table}")
+    if op in ("is_null", "not_null"):
+        return
+    if len(operand) != 1:
+        raise Exception(f"where condition {condition} in the rule for {table} needs 1 value")
+
+    literal = operand[0]
+    if op in ORDERING and Comparable_Types(literal) is None:
+        raise Exception(f"where condition {condition} in the rule for {table}: '{op}' needs a number or a string")
+    if op in ("in", "not_in") and not (isinstance(literal, list) and all(Is_Scalar(item) for item in literal)):
+        raise Exception(f"where condition {condition} in the rule for {table}: '{op}' needs a list of values")
+    if op in ("=", "!=") and not Is_Scalar(literal):
+        raise Exception(f"where condition {condition} in the rule for {table}: '{op}' needs a single value")
+
+
+def Mask_Function(kind, salt):
+    if kind == "redact":
+        return lambda value: "****"
+    if kind == "null":
+        return lambda value: None
+    if kind == "hash":
+        return lambda value: hashlib.sha256(f"{salt}{value}".encode("utf-8")).hexdigest()
+    if kind == "last4":
+        return lambda value: "****" + str(value)[-4:]
+
+    raise Exception(f"unknown mask '{kind}', use redact, null, hash or last4")
+
+
+class Table_Rule:
+    def __init__(self, table, rule, salt):
+        self.table = table
+        self.drop = rule.get("drop", False)
+        self.where = rule.get("where", [])
+        self.columns = rule.get("columns")
+        self.rename = rule.get("rename", {})
+        self.masks = {column: Mask_Function(kind, salt) for column, kind in rule.get("mask", {}).items()}
+        self.value_shapes = OrderedDict() # (names, types) -> (out names, out types, compiled function)
+        self.key_shapes = OrderedDict()   # (keynames, keytypes) -> (out names, out types, compiled function)
+
+        for condition in self.where:
+            Check_Condition(table, condition)
+
+    # returns the shaped change, or None if it's dropped
+    def Apply(self, change):
+        if self.drop:
+            return None
+
+        shaped = {"kind": change.get("kind"), "schema": change.get("schema"), "table": change.get("table")}
+
+        values = change.get("columnvalues")
+        if values is not None:
+            names, types, function = self.Compiled(self.value_shapes, change["columnnames"], change.get("columntypes"), True)
+            out = function(values)
+            if out is None:
+                return self.Left_Filter(change) if change.get("kind") == "update" else None
+            shaped["columnnames"], shaped["columntypes"], shaped["columnvalues"] = names, types, out
+
+        oldkeys = change.get("oldkeys")
+        if oldkeys:
+            # keys are only filtered on when there are no new values to filter on (deletes)
+            names, types, function = self.Compiled(self.key_shapes, oldkeys["keynames"], oldkeys.get("keytypes"), values is None)
+            out = function(oldkeys["keyvalues"])
+            if out is None:
+                return None
+            shaped["oldkeys"] = {"keynames": names, "keytypes": types, "keyvalues": out}
+
+        self.Shape_Pk(change, shaped)
+        return shaped
+
+    # include-pk=1. renamed like the columns, Change_Key checks they're still there
+    def Shape_Pk(self, change, shaped):
+        pk = change.get("pk")
+        if pk:
+            shaped["pk"] = {"pknames": [self.rename.get(name, name) for name in pk["pknames"]], "pktypes": pk.get("pktypes")}
+
+    # an update that left the where filter, as a delete of the row's key. None if the row can't have been in the sink,
+    # or there's no key to delete it by
+    def Left_Filter(self, change):
+        oldkeys = change.get("oldkeys")
+        if oldkeys:
+            names, types, values = oldkeys["keynames"], oldkeys.get("keytypes"), oldkeys["keyvalues"]
+        elif change.get("pk"): # no oldkeys, the key didn't change, take it from the new values
+            position = {name: i for i, name in enumerate(change["columnnames"])}
+            names = [name for name in change["pk"]["pknames"] if name in position]
+            if not names:
+                return None
+            types = [change["columntypes"][position[name]] for name in names] if change.get("columntypes") else None
+            values = [change["columnvalues"][position[name]] for name in names]
+        else:
+            return None
+
+        # the where check only runs when the old values have every where column, otherwise it passes
+        _, _, matched_before = self.Compiled(self.key_shapes, names, types, True)
+        if matched_before(values) is None:
+            return None
+
+        out_names, out_types, function = self.Compiled(self.key_shapes, names, types, False)
+        shaped = {"kind": "delete", "schema": change.get("schema"), "table": change.get("table"),
+                  "oldkeys": {"keynames": out_names, "keytypes": out_types, "keyvalues": function(values)}}
+        self.Shape_Pk(change, shaped)
+        return shaped
+
+    def Compiled(self, cache, names, types, filtered):
+        key = (tuple(names), tuple(types or ()), filtered)
+        entry = cache.get(key)
+        if entry is None:
+            entry = cache[key] = self.Compile(list(names), list(types or ()), filtered, cache is self.key_shapes)
+            while len(cache) > MAX_SHAPES_PER_TABLE:
+                cache.popitem(last=False)
+
+        return entry
+
+    # a literal that can't match the column's type is allowed (the type can change under us) but probably a mistake
+    def Warn_Type_Mismatch(self, column, op, literal, column_type):
+        if column_type is None:
+            return
+
+        numeric_column = column_type.split("(")[0].strip() in NUMERIC_TYPES
+        if numeric_column != isinstance(literal, (int, float)):
+            print(f"WARNING: rule for {self.table} compares {column} ({column_type}) {op} {literal!r}, it never matches")
+
+    # generates 'def Shape(v): if not (<where>): return None; return [v[0], m1(v[3]), ...]' for 1 column list
+    # types is empty when wal2json doesn't send them (include-types=0)
+    def Compile(self, names, types, filtered, keys):
+        namespace = {}
+        position = {name: i for i, name in enumerate(names)}
+
+        conditions = []
+        if filtered and (not keys or all(column in position for column, *_ in self.where)):
+            for n, (column, op, *operand) in enumerate(self.where):
+                value = f"v[{position[column]}]" if column in position else "None"
+                namespace[f"w{n}"] = operand[0] if operand else None
+                if op == "is_null":
+                    conditions.append(f"{value} is None")
+                elif op == "not_null":
+                    conditions.append(f"{value} is not None")
+                elif op == "in":
+                    conditions.append(f"{value} in w{n}")
+                elif op == "not_in":
+                    conditions.append(f"{value} not in w{n}")
+                elif op in ("=", "!="):
+                    conditions.append(f"{value} {OPERATORS[op]} w{n}")
+                else:
+                    # a value of another type is no match instead of a TypeError out of Normalize_Wal2Json
+                    namespace[f"t{n}"] = Comparable_Types(operand[0])
+                    conditions.append(f"(isinstance({value}, t{n}) and {value} {OPERATORS[op]} w{n})")
+                    self.Warn_Type_Mismatch(column, op, operand[0], types[position[column]] if types and column in position else None)
+
+        kept = names if keys or self.columns is None else [name for name in self.columns if name in position]
+        parts = []
+        for name in kept:
+            if name in self.masks:
+                namespace[f"m_{position[name]}"] = self.masks[name]
+                parts.append(f"(None if v[{position[name]}] is None else m_{position[name]}(v[{position[name]}]))")
+            else:
+                parts.append(f"v[{position[name]}]")
+
+        source = "def Shape(v):\n"
+        if conditions:
+            source += f"    if not ({' and '.join(conditions)}):\n        return None\n"
+        source += f"    return [{', '.join(parts)}]\n"
+        exec(compile(source, f"<rule {self.table}>", "exec"), namespace)
+
+        out_names = [self.rename.get(name, name) for name in kept]
+        out_types = [types[position[name]] if types else "text" for name in kept]
+        return out_names, out_types, namespace["Shape"]
+
+
+# the rule for a change's table, or None. Normalize_Wal2Json calls this per change
+def Rule_For(schema, table):
+    if not table_rules:
+        return None
+
+    return table_rules.get(f"{schema}.{table}")
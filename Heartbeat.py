@@ -0,0 +1,76 @@
+import asyncio
+from Sql_Commands import Create_Heartbeat_Table_Sql, Touch_Heartbeat_Sql, Emit_Heartbeat_Message_Sql
+
+
+'''
+heartbeat for quiet or filtered databases (heartbeat_mode in app.env)
+
+the saved lsn only moves when a transaction for this database comes through the apply loop. if this database is quiet
+(or everything in it gets filtered out) while other databases on the cluster keep writing, the slot holds on to all of
+their wal and the primary's disk fills up. every heartbeat_interval_seconds this writes a tiny transaction on the
+primary so there's always something recent to save:
+    table:   upserts the 1 row in public.cdc_heartbeat. it's a normal table change, works with every wal2json format.
+             the table has to exist on the standby too (the subscription is FOR ALL TABLES), Main creates it on both
+    message: pg_logical_emit_message with the cdc_heartbeat prefix, no table needed
+
+the apply loop knows these: Normalize_Wal2Json drops heartbeat changes so they never reach the sink, and a heartbeat
+transaction flushes the buffer right away so its lsn is saved even when the batch isn't full
+psycopg is only imported by the functions that write, so the normalizer can use the checks without the driver
+'''
+
+HEARTBEAT_SCHEMA = "public"
+HEARTBEAT_TABLE = "cdc_heartbeat"
+HEARTBEAT_PREFIX = "cdc_heartbeat"
+
+
+def Create_Heartbeat_Table(dsn):
+    import psycopg
+
+    with psycopg.connect(dsn) as cx:
+        with cx.cursor() as cur:
+            cur.execute(Create_Heartbeat_Table_Sql())
+        cx.commit()
+
+
+def Is_Heartbeat_Change(change):
+    if change.get("kind") == "message":
+        return change.get("prefix") == HEARTBEAT_PREFIX
+
+    return change.get("table") == HEARTBEAT_TABLE and change.get("schema") == HEARTBEAT_SCHEMA
+
+
+# True if this transaction is only a heartbeat. they're always 1 change, so anything bigger is skipped cheaply
+def Is_Heartbeat(obj):
+    if "raw_changes" in obj: # passthrough, the change is still text
+        changes = obj["raw_changes"]
+        return len(changes) == 1 and (f'"schema":"{HEARTBEAT_SCHEMA}","table":"{HEARTBEAT_TABLE}"' in changes[0] or
+                                      f'"prefix":"{HEARTBEAT_PREFIX}"' in changes[0])
+
+    changes = obj.get("change")
+    return isinstance(changes, list) and len(changes) == 1 and Is_Heartbeat_Change(changes[0])
+
+
+def Write_Heartbeat(dsn, mode):
+    import psycopg
+
+    with psycopg.connect(dsn, connect_timeout=5, autocommit=True) as cx:
+        with cx.cursor() as cur:
+            if mode == "table":
+                cur.execute(Touch_Heartbeat_Sql())
+            else:
+                cur.execute(Emit_Heartbeat_Message_Sql(), (HEARTBEAT_PREFIX,))
+
+
+# runs until stop_event is set. a failed heartbeat is only logged, the next one tries again
+async def Run_Heartbeat(dsn, mode, interval_seconds, stop_event):
+    while True:
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval_seconds)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+        try:
+            await asyncio.to_thread(Write_Heartbeat, dsn, mode)
+        except Exception as e:
+            print(f"Heartbeat failed: {e}")
@@ -0,0 +1,331 @@
+import asyncio
+import heapq
+import itertools
+import json
+from dataclasses import dataclass, field
+from typing import List
+from Apply_Manager import Normalize_Wal2Json, Apply_Events, Close_Source
+
+
+'''
+priority lanes (lanes_config_path in app.env). replaces Run_Apply_Loop's single fifo buffer
+
+with 1 buffer and 1 batch_size, a bulk backfill on a big table sits in front of every change to small latency critical
+tables. here every table is routed to a lane, and each lane has its own batch size, linger time, sink concurrency
+and priority:
+- the reader normalizes each transaction and splits its events by lane
+- each lane has `concurrency` workers. a worker sends a batch once it has batch_size events or the oldest event has
+  waited linger_ms, so a quiet hot lane still flushes in well under a second
+- all lanes share sink_concurrency sink slots. when they're all busy the waiting lane with the lowest priority number
+  gets the next free one
+- lsn's are saved per transaction in arrival order: a transaction is done when every lane holding part of it has
+  applied that part, and the saved lsn is the newest transaction with everything before it done. so a slow bulk lane
+  holds the saved lsn back (a restart replays more), but it never lets the saved lsn skip unapplied data
+- batches from different lanes, or from 1 lane with concurrency > 1, can reach the sink out of order. cdc_events is
+  keyed by commit_lsn so that's fine for it
+- the async sink has 1 connection and the parquet sink 1 set of open files, so Main runs those with sink_concurrency 1
+  (the lanes still get their own batching and priority). the sync sink connects per batch and can go wider
+
+lanes file (json). "*" matches tables no other lane lists, the last lane is the default if nothing has "*"
+{
+    "sink_concurrency": 4,
+    "lanes": [
+        {"name": "orders", "tables": ["public.orders", "public.order_items"], "batch_size": 50, "linger_ms": 100,
+         "concurrency": 2, "priority": 0},
+        {"name": "bulk", "tables": ["*"], "batch_size": 5000, "linger_ms": 2000, "concurrency": 1, "priority": 10}
+    ]
+}
+'''
+
+
+@dataclass
+class Lane:
+    name: str
+    tables: List[str]
+    batch_size: int = 500
+    linger_seconds: float = 1.0
+    concurrency: int = 1
+    priority: int = 10
+    max_queued: int = 10000          # changes waiting in this lane before the reader has to wait
+    queue: asyncio.Queue = field(default=None, repr=False)
+    queued: int = 0                  # changes in the queue right now
+    has_room: asyncio.Event = field(default=None, repr=False)
+    applied_events: int = 0
+
+
+def Load_Lanes_Config(path):
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    lanes = []
+    for entry in config["lanes"]:
+        lanes.append(Lane(
+            name=entry["name"],
+            tables=entry.get("tables", []),
+            batch_size=int(entry.get("batch_size", 500)),
+            linger_seconds=float(entry.get("linger_ms", 1000)) / 1000,
+            concurrency=max(1, int(entry.get("concurrency", 1))),
+            priority=int(entry.get("priority", 10)),
+            max_queued=int(entry.get("max_queued", 10000)),
+        ))
+
+    if not lanes:
+        raise Exception(f"{path} doesn't define any lanes")
+
+    return lanes, int(config.get("sink_concurrency", sum(lane.concurrency for lane in lanes)))
+
+
+# limits how many batches are at the sink at once. free slots go to the waiting lane with the lowest priority number,
+# ties go first come first served
+class Priority_Gate:
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.active = 0
+        self.waiting = [] # heap of (priority, order, future)
+        self.order = itertools.count()
+
+    async def Acquire(self, priority):
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self.order), future)
+        heapq.heappush(self.waiting, entry)
+        try:
+            await future # Release() hands its slot straight to us
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.Release() # got the slot as we were cancelled, pass it on
+            else:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+            raise
+
+    def Release(self):
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+
+        self.active -= 1
+
+
+# which transactions are done, in arrival order. tells us the newest lsn that's safe to save
+class Lsn_Watermark:
+    def __init__(self):
+        self.pending = {}   # seq -> [lane parts still to apply, lsn]
+        self.next_seq = 0   # oldest seq not yet retired
+
+    def Register(self, seq, lsn, parts):
+        self.pending[seq] = [parts, lsn]
+
+    def Part_Done(self, seq):
+        self.pending[seq][0] -= 1
+
+    # retires finished transactions from the front. returns the lsn of the newest one, or None if nothing moved
+    def Advance(self):
+        lsn = None
+        while self.next_seq in self.pending and self.pending[self.next_seq][0] <= 0:
+            entry_lsn = self.pending.pop(self.next_seq)[1]
+            lsn = entry_lsn or lsn
+            self.next_seq += 1
+
+        return lsn
+
+
+class Lane_Router:
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self.by_table = {}
+        self.default_lane = lanes[-1]
+        for lane in lanes:
+            for table in lane.tables:
+                if table == "*":
+                    self.default_lane = lane
+                else:
+                    self.by_table[table] = lane
+
+    def Lane_For(self, table):
+        return self.by_table.get(table, self.default_lane)
+
+
+''' the lane version of Run_Apply_Loop. same source, apply_batch, persist_lsn, retry and shutdown settings
+(batch_size/batch_controller don't apply, every lane has its own batch size)
+control (Control_Api.py) is optional: pause stops the reader, and its max_retries/backoff_seconds are used per batch
+on a stop the lanes drain like Drain_And_Close: closing the source and the workers' last batches share
+shutdown_deadline_seconds. a batch still running at the deadline is given up, what's left in the queues is skipped,
+and the saved lsn stays before them so they're replayed on restart
+'''
+async def Run_Lane_Apply_Loop(source, lanes, sink_concurrency, apply_batch, persist_lsn, max_retries, backoff_seconds,
+                              failure_policy="halt", dead_letter=None, is_poison=None, stop_event=None,
+                              shutdown_deadline_seconds=10.0, dedup=None, control=None):
+    router = Lane_Router(lanes)
+    gate = Priority_Gate(sink_concurrency)
+    watermark = Lsn_Watermark()
+    for lane in lanes:
+        lane.queue = asyncio.Queue() # bounded by max_queued changes in Queue_Part, not by item count
+        lane.queued = 0
+        lane.has_room = asyncio.Event()
+    drain_deadline = None # loop time the shutdown drain has to finish by, set when the stop is first seen
+
+    # the lsn save happens right after a batch, on the event loop, so only 1 runs at a time
+    def Retire(seqs):
+        for seq in seqs:
+            watermark.Part_Done(seq)
+
+        lsn = watermark.Advance()
+        if lsn:
+            persist_lsn(lsn)
+            if dedup:
+                dedup.Mark_Applied([], lsn)
+
+    def Drain_Deadline():
+        nonlocal drain_deadline
+        if drain_deadline is None and stop_event is not None and stop_event.is_set():
+            drain_deadline = asyncio.get_running_loop().time() + shutdown_deadline_seconds
+
+        return drain_deadline
+
+    # runs 1 lane batch. once the stop comes in the batch only gets what's left of the drain, even if it was already
+    # running. returns False if it was given up at the deadline (cancelled, its lsn isn't saved)
+    async def Apply_Before_Deadline(applying):
+        loop = asyncio.get_running_loop()
+        applying = asyncio.ensure_future(applying)
+        stop_wait = asyncio.ensure_future(stop_event.wait()) if stop_event else None
+        try:
+            if stop_wait is not None:
+                await asyncio.wait((applying, stop_wait), return_when=asyncio.FIRST_COMPLETED)
+                if not applying.done():
+                    await asyncio.wait((applying,), timeout=max(Drain_Deadline() - loop.time(), 0))
+                if not applying.done():
+                    return False
+            await applying
+            return True
+        finally:
+            if stop_wait is not None:
+                stop_wait.cancel()
+            if not applying.done():
+                applying.cancel()
+                await asyncio.gather(applying, return_exceptions=True)
+
+    # a lane holds up to max_queued changes before the reader waits. counted in changes, not transactions, so a staged
+    # chunk or a big transaction takes up its real size. 1 part bigger than the limit still goes into an empty queue
+    async def Queue_Part(lane, item):
+        while lane.queued and lane.queued + len(item[1]) > lane.max_queued:
+            lane.has_room.clear()
+            await lane.has_room.wait()
+
+        lane.queued += len(item[1])
+        lane.queue.put_nowait(item)
+
+    def Took(lane, item):
+        lane.queued -= len(item[1])
+        lane.has_room.set()
+
+    async def Lane_Worker(lane):
+        loop = asyncio.get_running_loop()
+        finished = False
+        while not finished:
+            item = await lane.queue.get()
+            if item is None:
+                break
+            Took(lane, item)
+
+            seqs = [item[0]]
+            events = list(item[1])
+            deadline = loop.time() + lane.linger_seconds
+            while len(events) < lane.batch_size:
+                try:
+                    item = await asyncio.wait_for(lane.queue.get(), timeout=max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    finished = True
+                    break
+                Took(lane, item)
+                seqs.append(item[0])
+                events.extend(item[1])
+
+            if dedup:
+                events = dedup.Filter(events)
+
+            # past the drain deadline the rest of the queue is only taken off so the reader's stop markers get through
+            deadline = Drain_Deadline()
+            if deadline is not None and loop.time() >= deadline:
+                continue
+
+            await gate.Acquire(lane.priority)
+            try:
+                retries, backoff = (control.max_retries, control.backoff_seconds) if control else (max_retries, backoff_seconds)
+                applied = await Apply_Before_Deadline(
+                    Apply_Events(events, apply_batch, retries, backoff, failure_policy, dead_letter, is_poison))
+            finally:
+                gate.Release()
+
+            if not applied:
+                print(f"Shutdown deadline hit before lane {lane.name} applied its last batch, it will be replayed on restart")
+                continue
+
+            lane.applied_events += len(events)
+            if dedup:
+                dedup.Mark_Applied(events, None)
+            Retire(seqs)
+
+    async def Reader():
+        iterator = source.__aiter__()
+        pending_read = None
+        stop_wait = asyncio.ensure_future(stop_event.wait()) if stop_event else None
+        seq = 0
+        try:
+            while True:
+                while control is not None and not control.running.is_set() and not (stop_event and stop_event.is_set()):
+                    await control.Wait_While_Paused(stop_event)
+                pending_read = asyncio.ensure_future(iterator.__anext__())
+                waiting = (pending_read, stop_wait) if stop_wait else (pending_read,)
+                await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                if stop_event is not None and stop_event.is_set():
+                    print("Shutting down: draining lanes...")
+                    deadline = Drain_Deadline()
+                    await Close_Source(source, pending_read, max(deadline - asyncio.get_running_loop().time(), 0.1))
+                    break
+                try:
+                    records = pending_read.result()
+                except StopAsyncIteration:
+                    break
+                pending_read = None
+
+                for lsn, obj in records:
+                    if dedup and dedup.Is_Replayed_Transaction(lsn):
+                        continue
+
+                    parts = {}
+                    for event in Normalize_Wal2Json(obj):
+                        parts.setdefault(router.Lane_For(event["table"]).name, []).append(event)
+
+                    # register before queueing, a fast lane could finish its part before we get to the next line
+                    watermark.Register(seq, lsn, len(parts))
+                    for lane in lanes:
+                        if lane.name in parts:
+                            await Queue_Part(lane, (seq, parts[lane.name]))
+                    if not parts:
+                        Retire([])
+                    seq += 1
+        finally:
+            if stop_wait is not None:
+                stop_wait.cancel()
+
+        # tell every worker there's nothing more coming, they flush what they have and exit
+        for lane in lanes:
+            for _ in range(lane.concurrency):
+                await lane.queue.put(None)
+
+    async with asyncio.TaskGroup() as group:
+        group.create_task(Reader())
+        for lane in lanes:
+            for _ in range(lane.concurrency):
+                group.create_task(Lane_Worker(lane))
+
+    for lane in lanes:
+        print(f"Lane {lane.name}: {lane.applied_events} events applied")
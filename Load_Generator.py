@@ -0,0 +1,347 @@
+"""
+High rate load generator for testing the pipeline (Test_Data_Generator.py does 1 change a second, this does thousands)
+
+- N worker threads, each with its own connection to the primary, all writing to test_data
+- paced to a total target of operations/sec or MB/sec (0 = as fast as it can go)
+- the operation mix is configurable, weights for:
+    single     1 row insert/update/delete
+    bulk       1 multi row INSERT statement (--bulk-rows rows)
+    large_txn  1 transaction made of many bulk inserts (--large-txn-rows rows)
+    wide       1 insert with a big message column (--wide-bytes)
+    hot        update of 1 of a few hot rows (--hot-keys), lots of changes to the same keys
+- --offline PATH writes the same kind of changes as wal2json lines (1 transaction per line, like pg_recvlogical gives
+  Source_Pg) to a file with no database, for feeding the pipeline or benchmarks
+- prints achieved ops/sec, rows/sec and MB/sec every --report-seconds and at the end, so runs can be lined up
+  against the pipeline's own throughput
+
+ex) python Load_Generator.py --workers 8 --ops-per-sec 2000 --duration 60 --mix single=60,bulk=10,large_txn=2,wide=8,hot=20
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from Offsets import Int_To_Lsn
+
+
+OPERATIONS = ["single", "bulk", "large_txn", "wide", "hot"]
+
+TEST_DATA_COLUMNS = ["id", "counter", "message", "value", "created_at", "updated_at"]
+TEST_DATA_TYPES = ["integer", "integer", "text", "numeric(10,2)", "timestamp without time zone", "timestamp without time zone"]
+
+
+# "single=60,bulk=10" -> {"single": 60.0, "bulk": 10.0, ...} missing operations get 0
+def Parse_Mix(mix_text):
+    weights = {operation: 0.0 for operation in OPERATIONS}
+    for part in mix_text.split(","):
+        if not part.strip():
+            continue
+        name, weight = part.split("=")
+        if name.strip() not in weights:
+            raise ValueError(f"unknown operation '{name.strip()}', use {OPERATIONS}")
+        weights[name.strip()] = float(weight)
+
+    if sum(weights.values()) <= 0:
+        raise ValueError("the operation mix needs at least 1 weight above 0")
+
+    return weights
+
+
+# shared counters, updated by every worker
+class Load_Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.ops = 0
+        self.rows = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def Add(self, rows, payload_bytes):
+        with self.lock:
+            self.ops += 1
+            self.rows += rows
+            self.bytes += payload_bytes
+
+    def Add_Error(self):
+        with self.lock:
+            self.errors += 1
+
+    def Snapshot(self):
+        with self.lock:
+            return time.monotonic(), self.ops, self.rows, self.bytes, self.errors
+
+
+def Print_Rates(label, seconds, ops, rows, payload_bytes, errors):
+    seconds = max(seconds, 1e-9)
+    print(f"[{label}] {ops / seconds:10.1f} ops/s  {rows / seconds:10.1f} rows/s  "
+          f"{payload_bytes / seconds / 1024 / 1024:8.2f} MB/s  errors={errors}")
+
+
+# waits between operations so all workers together hit the target rate
+# rate is per worker. ops mode counts 1 per operation, MB mode counts the payload bytes of the operation
+class Pacer:
+    def __init__(self, ops_per_sec, bytes_per_sec):
+        self.ops_per_sec = ops_per_sec
+        self.bytes_per_sec = bytes_per_sec
+        self.next_time = time.monotonic()
+
+    def Wait(self, payload_bytes):
+        if self.bytes_per_sec > 0:
+            self.next_time += payload_bytes / self.bytes_per_sec
+        elif self.ops_per_sec > 0:
+            self.next_time += 1.0 / self.ops_per_sec
+        else:
+            return
+
+        delay = self.next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -1.0:
+            self.next_time = time.monotonic() # fell behind by more than a second, don't try to burst to catch up
+
+
+def Random_Message(rng, size):
+    return "".join(rng.choices("abcdefghijklmnopqrstuvwxyz0123456789 ", k=size))
+
+
+# runs 1 operation against the database. returns (rows changed, approximate payload bytes)
+def Run_Db_Operation(cur, operation, rng, args, hot_ids):
+    if operation == "single":
+        choice = rng.random()
+        message = Random_Message(rng, 32)
+        if choice < 0.6:
+            cur.execute("INSERT INTO test_data (counter, message, value) VALUES (%s, %s, %s)",
+                        (rng.randint(0, 1000), message, round(rng.uniform(10, 1000), 2)))
+        elif choice < 0.9:
+            cur.execute("UPDATE test_data SET message = %s, updated_at = NOW() WHERE id = (SELECT max(id) - %s FROM test_data)",
+                        (message, rng.randint(0, 100)))
+        else:
+            cur.execute("DELETE FROM test_data WHERE id = (SELECT min(id) FROM test_data WHERE id > %s)",
+                        (max(hot_ids) if hot_ids else 0,))
+        return max(cur.rowcount, 0), 80
+
+    if operation == "bulk":
+        cur.execute("""INSERT INTO test_data (counter, message, value)
+                       SELECT g, md5(random()::text), round((random() * 1000)::numeric, 2) FROM generate_series(1, %s) g""",
+                    (args.bulk_rows,))
+        return args.bulk_rows, args.bulk_rows * 80
+
+    if operation == "large_txn":
+        remaining = args.large_txn_rows
+        while remaining > 0:
+            rows = min(remaining, args.bulk_rows)
+            cur.execute("""INSERT INTO test_data (counter, message, value)
+                           SELECT g, md5(random()::text), round((random() * 1000)::numeric, 2) FROM generate_series(1, %s) g""",
+                        (rows,))
+            remaining -= rows
+        return args.large_txn_rows, args.large_txn_rows * 80
+
+    if operation == "wide":
+        cur.execute("INSERT INTO test_data (counter, message, value) VALUES (%s, %s, %s)",
+                    (0, Random_Message(rng, args.wide_bytes), 0))
+        return 1, args.wide_bytes + 48
+
+    # hot
+    cur.execute("UPDATE test_data SET counter = counter + 1, updated_at = NOW() WHERE id = %s", (rng.choice(hot_ids),))
+    return 1, 48
+
+
+def Db_Worker(dsn, worker_id, args, weights, pacer, stats, stop_event, hot_ids):
+    import psycopg
+
+    rng = random.Random(args.seed + worker_id)
+    operations = list(weights)
+    operation_weights = list(weights.values())
+
+    with psycopg.connect(dsn) as conn:
+        while not stop_event.is_set():
+            operation = rng.choices(operations, operation_weights)[0]
+            if operation == "hot" and not hot_ids:
+                operation = "single"
+
+            try:
+                with conn.cursor() as cur:
+                    rows, payload_bytes = Run_Db_Operation(cur, operation, rng, args, hot_ids)
+                conn.commit()
+                stats.Add(rows, payload_bytes)
+
+            except psycopg.OperationalError:
+                raise
+            except Exception as e:
+                conn.rollback()
+                stats.Add_Error()
+                print(f"worker {worker_id}: {operation} failed: {e}")
+                payload_bytes = 0
+
+            pacer.Wait(payload_bytes)
+
+
+# makes sure there are hot_keys rows to hammer, returns their ids
+def Prepare_Hot_Keys(dsn, hot_keys):
+    import psycopg
+
+    with psycopg.connect(dsn) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM test_data ORDER BY id LIMIT %s", (hot_keys,))
+            ids = [row[0] for row in cur.fetchall()]
+            while len(ids) < hot_keys:
+                cur.execute("INSERT INTO test_data (counter, message, value) VALUES (0, 'hot key', 0) RETURNING id")
+                ids.append(cur.fetchone()[0])
+        conn.commit()
+
+    return ids
+
+
+''' builds synthetic wal2json transactions (the same shape pg_recvlogical prints with include-xids/timestamp/lsn)
+used by --offline and by anything else that needs a change stream without a database
+'''
+class Synthetic_Wal2Json:
+    def __init__(self, seed=0, start_lsn=0x1000000, table="test_data", schema="public"):
+        self.rng = random.Random(seed)
+        self.lsn = start_lsn
+        self.xid = 1000
+        self.next_id = 1
+        self.live_ids = []
+        self.table = table
+        self.schema = schema
+
+    def Row(self, row_id, message):
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+        return [row_id, self.rng.randint(0, 1000), message, round(self.rng.uniform(10, 1000), 2), now, now]
+
+    def Insert_Change(self, message):
+        row_id = self.next_id
+        self.next_id += 1
+        self.live_ids.append(row_id)
+        return {"kind": "insert", "schema": self.schema, "table": self.table, "columnnames": TEST_DATA_COLUMNS,
+                "columntypes": TEST_DATA_TYPES, "columnvalues": self.Row(row_id, message)}
+
+    def Update_Change(self, row_id, message):
+        return {"kind": "update", "schema": self.schema, "table": self.table, "columnnames": TEST_DATA_COLUMNS,
+                "columntypes": TEST_DATA_TYPES, "columnvalues": self.Row(row_id, message),
+                "oldkeys": {"keynames": ["id"], "keytypes": ["integer"], "keyvalues": [row_id]}}
+
+    def Delete_Change(self, row_id):
+        return {"kind": "delete", "schema": self.schema, "table": self.table,
+                "oldkeys": {"keynames": ["id"], "keytypes": ["integer"], "keyvalues": [row_id]}}
+
+    # 1 transaction worth of changes for an operation, as a wal2json v1 object
+    def Transaction(self, operation, bulk_rows=100, large_txn_rows=5000, wide_bytes=8192, hot_keys=10):
+        changes = []
+        if operation == "single" or (operation == "hot" and not self.live_ids):
+            choice = self.rng.random()
+            if choice < 0.6 or not self.live_ids:
+                changes.append(self.Insert_Change(Random_Message(self.rng, 32)))
+            elif choice < 0.9:
+                changes.append(self.Update_Change(self.rng.choice(self.live_ids), Random_Message(self.rng, 32)))
+            else:
+                changes.append(self.Delete_Change(self.live_ids.pop(self.rng.randrange(len(self.live_ids)))))
+        elif operation == "bulk":
+            changes = [self.Insert_Change(Random_Message(self.rng, 32)) for _ in range(bulk_rows)]
+        elif operation == "large_txn":
+            changes = [self.Insert_Change(Random_Message(self.rng, 32)) for _ in range(large_txn_rows)]
+        elif operation == "wide":
+            changes.append(self.Insert_Change(Random_Message(self.rng, wide_bytes)))
+        else:
+            changes.append(self.Update_Change(self.rng.choice(self.live_ids[:hot_keys]), "hot"))
+
+        self.xid += 1
+        self.lsn += 0x100 + 0x80 * len(changes)
+        return {"xid": self.xid, "nextlsn": Int_To_Lsn(self.lsn),
+                "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f+00"), "change": changes}
+
+
+def Run_Offline(args, weights):
+    generator = Synthetic_Wal2Json(seed=args.seed)
+    pacer = Pacer(args.ops_per_sec, args.mb_per_sec * 1024 * 1024)
+    stats = Load_Stats()
+    operations = list(weights)
+    operation_weights = list(weights.values())
+    deadline = time.monotonic() + args.duration if args.duration > 0 else None
+    last_report = time.monotonic()
+
+    with open(args.offline, "w", encoding="utf-8") as f:
+        while deadline is None or time.monotonic() < deadline:
+            operation = generator.rng.choices(operations, operation_weights)[0]
+            line = json.dumps(generator.Transaction(operation, args.bulk_rows, args.large_txn_rows, args.wide_bytes, args.hot_keys),
+                              separators=(",", ":"))
+            f.write(line + "\n")
+            stats.Add(line.count('"kind":'), len(line) + 1)
+            pacer.Wait(len(line) + 1)
+
+            if args.max_ops and stats.ops >= args.max_ops:
+                break
+            if time.monotonic() - last_report >= args.report_seconds:
+                last_report = time.monotonic()
+                now, ops, rows, payload_bytes, errors = stats.Snapshot()
+                Print_Rates("offline", now - stats.started, ops, rows, payload_bytes, errors)
+
+    now, ops, rows, payload_bytes, errors = stats.Snapshot()
+    Print_Rates("offline total", now - stats.started, ops, rows, payload_bytes, errors)
+
+
+def Run_Online(args, weights):
+    from Startup_Config import Load_Docker_Env_Config
+    from Test_Data_Generator import Make_Dsn
+
+    dsn = Make_Dsn(Load_Docker_Env_Config('Primary.env'))
+    hot_ids = Prepare_Hot_Keys(dsn, args.hot_keys) if weights["hot"] > 0 else []
+
+    stats = Load_Stats()
+    stop_event = threading.Event()
+    workers = []
+    for worker_id in range(args.workers):
+        pacer = Pacer(args.ops_per_sec / args.workers, args.mb_per_sec * 1024 * 1024 / args.workers)
+        worker = threading.Thread(target=Db_Worker, args=(dsn, worker_id, args, weights, pacer, stats, stop_event, hot_ids), daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    deadline = time.monotonic() + args.duration if args.duration > 0 else None
+    last = stats.Snapshot()
+    try:
+        while (deadline is None or time.monotonic() < deadline) and any(w.is_alive() for w in workers):
+            time.sleep(args.report_seconds)
+            current = stats.Snapshot()
+            Print_Rates("interval", current[0] - last[0], current[1] - last[1], current[2] - last[2], current[3] - last[3], current[4])
+            last = current
+    except KeyboardInterrupt:
+        pass
+
+    stop_event.set()
+    for worker in workers:
+        worker.join()
+
+    now, ops, rows, payload_bytes, errors = stats.Snapshot()
+    Print_Rates("total", now - stats.started, ops, rows, payload_bytes, errors)
+
+
+def Main():
+    parser = argparse.ArgumentParser(description="multi worker load generator for the WAL pipeline")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent connections")
+    parser.add_argument("--ops-per-sec", type=float, default=0, help="total target operations/sec, 0 = unlimited")
+    parser.add_argument("--mb-per-sec", type=float, default=0, help="total target payload MB/sec, overrides --ops-per-sec")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run, 0 = until ctrl+c")
+    parser.add_argument("--max-ops", type=int, default=0, help="offline only: stop after this many transactions")
+    parser.add_argument("--mix", default="single=60,bulk=10,large_txn=2,wide=8,hot=20", help="operation weights")
+    parser.add_argument("--bulk-rows", type=int, default=100)
+    parser.add_argument("--large-txn-rows", type=int, default=5000)
+    parser.add_argument("--wide-bytes", type=int, default=8192)
+    parser.add_argument("--hot-keys", type=int, default=10)
+    parser.add_argument("--report-seconds", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--offline", metavar="PATH", help="write synthetic wal2json lines to PATH instead of using the database")
+    args = parser.parse_args()
+
+    weights = Parse_Mix(args.mix)
+
+    if args.offline:
+        Run_Offline(args, weights)
+    else:
+        Run_Online(args, weights)
+
+
+if __name__ == "__main__":
+    Main()
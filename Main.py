@@ -1,14 +1,28 @@
 import asyncio
 import os
+import signal
 import sys
 from pathlib import Path
 from typing import Dict, Any
 import psycopg
 from Startup_Config import App_Config, Pg_Conn_Info, Load_Docker_Env_Config, Load_App_Env_Config
-from Offsets import Get_Lsn_Table_Conn, Get_Last_Applied_Lsn, Set_Last_Applied_Lsn
+from Offsets import Get_Lsn_Table_Conn, Get_Last_Applied_Lsn, Set_Last_Applied_Lsn, Lsn_To_Int
 from Source_Pg import Check_Publication, Check_Replication_Slot, Check_Subscription, Wal2Json_Via_Pg_Recvlogical, Get_Current_Lsn
+from Source_Supervisor import Supervised_Source, Source_Stats
 from Apply_Manager import Run_Apply_Loop
-from Sink_Postgres import Apply_Postgres, Create_Cdc_Table
+from Lane_Scheduler import Run_Lane_Apply_Loop, Load_Lanes_Config
+from Slot_Shards import Load_Shards_Config, Merge_By_Commit_Lsn
+from Dedup_Filter import Dedup_Filter
+from Heartbeat import Create_Heartbeat_Table, Run_Heartbeat
+from Profiler import Profiler
+from Event_Rules import Load_Event_Rules
+from Control_Api import Pipeline_Control, Start_Control_Server
+from Batch_Controller import Adaptive_Batch_Controller
+from Sink_Postgres import Apply_Postgres, Apply_Postgres_Async, Close_Async_Sink_Conn, Create_Cdc_Table, Is_Poison_Error
+from Sink_Parquet import Parquet_File_Sink
+from Sink_Sqlite import Sqlite_Sink
+from Durability_Fence import Durability_Fence
+from Dead_Letter import Create_Dead_Letter_Store, Write_Dead_Letters_File, Write_Dead_Letters_Table
 from Sql_Commands import Create_Test_Data_Table_Sql
 
 
@@ -93,6 +107,36 @@ def Check_Docker_Connections():
         sys.exit(1)
 
 
+# SIGINT (ctrl+c) and SIGTERM (docker stop, service managers) set the returned event instead of killing the program
+# windows has no loop.add_signal_handler, so there it goes through signal.signal
+def Install_Stop_Handlers():
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+
+    def Request_Stop():
+        if stop_event.is_set():
+            print("Already shutting down, waiting for the drain to finish...")
+            return
+        print("\nStop requested")
+        stop_event.set()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, Request_Stop)
+        except NotImplementedError:
+            signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(Request_Stop))
+
+    return stop_event
+
+
+# SIGUSR1 turns the profiler on/off without a restart. windows has no SIGUSR1, use profiling=true there
+def Install_Profiler_Toggle(profiler):
+    if not hasattr(signal, "SIGUSR1"):
+        return
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profiler.Toggle)
+
+
 async def Main():
     # check folders and load env files. these all close the program if they fail
     Check_Docker_Connections()
@@ -109,53 +153,309 @@ async def Main():
     # check stuff exists or create it
     Check_Test_Data_Table(primary_dsn, 'primary')                                # check publisher/subscriber test_data table exists
     Check_Test_Data_Table(standby_dsn, 'standby')
-    Create_Cdc_Table(sink_dsn)                                                   # create sink table if it doesn't already exist
-    Get_Lsn_Table_Conn(app_config.offsets_path)                                  # make sqllite lsn table if it doesn't exist
+    if app_config.sink_type == "postgres":
+        Create_Cdc_Table(sink_dsn, app_config)                                   # create sink table if it doesn't already exist
+    if app_config.failure_policy == "bisect" and app_config.dead_letter_target == "table":
+        Create_Dead_Letter_Store(sink_dsn)                                       # poison events go to cdc_dead_letters
+    if app_config.heartbeat_mode == "table":
+        Create_Heartbeat_Table(primary_dsn)                                      # the subscription copies it, so the standby needs it too
+        Create_Heartbeat_Table(standby_dsn)
+    if app_config.sink_type == "sqlite":
+        Get_Lsn_Table_Conn(app_config.sqlite_path)                               # the sqlite sink saves the lsn in its own database
+    else:
+        Get_Lsn_Table_Conn(app_config.offsets_path)                              # make sqllite lsn table if it doesn't exist
     Check_Publication(primary_dsn, app_config.publication_name)                  # check the publication is still up. if not create one on primary
     Check_Subscription(standby_dsn, primary_config, app_config)                  # check subscription is still up. if not then create it
-    Check_Replication_Slot(primary_dsn, app_config.slot_name, app_config.plugin) # cleck for a slot, if not create one
+
+    # decode shards, 1 slot per group of tables (slot_shards.py). the main slot isn't created then, nothing would read it
+    shards, shards_ordered = [], False
+    if app_config.shards_config_path:
+        shards, shards_ordered = Load_Shards_Config(app_config.shards_config_path, app_config.slot_name)
+        if shards_ordered and (app_config.source_format != "v1" or app_config.payload_mode == "passthrough"):
+            raise Exception("ordered shards need source_format=v1 and a payload_mode other than passthrough")
+        for shard in shards:
+            Check_Replication_Slot(primary_dsn, shard.slot, app_config.plugin)
+    else:
+        Check_Replication_Slot(primary_dsn, app_config.slot_name, app_config.plugin) # cleck for a slot, if not create one
+
+    # per table filter/projection/masking, compiled into normalization
+    if app_config.rules_config_path:
+        Load_Event_Rules(app_config.rules_config_path)
 
     # get the most recent lsn that we successfully processed
-    most_recent_successful_lsn = Get_Last_Applied_Lsn(app_config.slot_name) # returns none if the table is blank
+    def Start_Lsn(slot):
+        lsn = Get_Last_Applied_Lsn(slot) # returns none if the table is blank
 
-    if most_recent_successful_lsn == None and app_config.start_from_beginning == False:
-        most_recent_successful_lsn = Get_Current_Lsn(primary_dsn)
+        if lsn == None and app_config.start_from_beginning == False:
+            lsn = Get_Current_Lsn(primary_dsn)
+
+        return lsn
+
+    # ctrl+c / SIGTERM set this and Run_Apply_Loop drains instead of the process just dying
+    stop_event = Install_Stop_Handlers()
 
     # this variable is a async generator object
     # this is called in a loop in apply_manager.py
-    source = Wal2Json_Via_Pg_Recvlogical(
-        dsn_params=Make_Dsn_Params_Dict(primary_config),
-        slot=app_config.slot_name,
-        publication=app_config.publication_name,
-        start_lsn=most_recent_successful_lsn,
-        status_interval_seconds=app_config.status_interval_seconds
-    )
+    # shard: read that shard's slot and only its tables
+    def Make_Source(start_lsn, exit_info=None, shard=None):
+        return Wal2Json_Via_Pg_Recvlogical(
+            dsn_params=Make_Dsn_Params_Dict(primary_config),
+            slot=shard.slot if shard else app_config.slot_name,
+            publication=app_config.publication_name,
+            start_lsn=start_lsn,
+            status_interval_seconds=app_config.status_interval_seconds,
+            shutdown_deadline_seconds=app_config.shutdown_deadline_seconds,
+            exit_info=exit_info,
+            source_format=app_config.source_format,
+            staging_dir=app_config.staging_dir,
+            spill_rows=app_config.large_txn_spill_rows,
+            chunk_rows=app_config.large_txn_chunk_rows,
+            passthrough=app_config.payload_mode == "passthrough",
+            include_pk=app_config.latest_state,
+            read_bytes=app_config.source_read_kb * 1024,
+            max_record_bytes=app_config.max_record_mb * 1024 * 1024,
+            add_tables=shard.add_tables if shard else None,
+            filter_tables=shard.filter_tables if shard else None
+        )
+
+    # the supervisor restarts pg_recvlogical when it dies instead of letting the program end
+    source_stats = Source_Stats()
+    def Open_Source(slot, shard=None):
+        start_lsn = Start_Lsn(slot)
+        if not app_config.source_restart:
+            return Make_Source(start_lsn, shard=shard)
+
+        return Supervised_Source(
+            make_source=lambda lsn, exit_info: Make_Source(lsn, exit_info, shard),
+            get_resume_lsn=lambda: Get_Last_Applied_Lsn(slot) or start_lsn,
+            stats=source_stats,
+            max_restarts=app_config.source_max_restarts,
+            backoff_seconds=app_config.source_backoff_seconds,
+            backoff_max_seconds=app_config.source_backoff_max_seconds,
+            stop_event=stop_event
+        )
+
+    # psycopg's async connection can't run on the windows ProactorEventLoop, and pg_recvlogical needs that loop
+    # for its subprocess. so windows always uses the sync sink
+    use_async_sink = app_config.sink_mode == "async" and sys.platform != "win32"
+    if app_config.sink_mode == "async" and not use_async_sink:
+        print("sink_mode=async isn't supported on Windows, using the sync sink")
+
+    # file sink. its files are only durable once closed, so it decides when an lsn can be saved (see Persist_Lsn)
+    parquet_sink = None
+    if app_config.sink_type == "parquet":
+        parquet_sink = Parquet_File_Sink(app_config.parquet_dir, app_config.parquet_max_file_mb, app_config.parquet_max_file_seconds)
+
+    # local database sink. the lsn is saved in the same sqlite transaction as the batch (see Persist_Lsn)
+    sqlite_sink = None
+    if app_config.sink_type == "sqlite":
+        sqlite_sink = Sqlite_Sink(app_config.sqlite_path, app_config.sqlite_synchronous, app_config.slot_name)
 
     # send data to the sink
     # choose a sink; test sink or real sink
+    async_sink_lock = asyncio.Lock()
     async def Apply_Batch(data):
         print(f"Processing batch of {len(data)} events...")
-        # Run the synchronous Apply_Postgres in a separate thread to avoid blocking the event loop
-        await asyncio.to_thread(Apply_Postgres, sink_dsn, data)
+        if parquet_sink:
+            await asyncio.to_thread(parquet_sink.Apply, data)
+        elif sqlite_sink:
+            await asyncio.to_thread(sqlite_sink.Apply, data)
+        elif use_async_sink:
+            async with async_sink_lock: # decode shards run 1 apply loop each, the async sink has 1 connection
+                await Apply_Postgres_Async(sink_dsn, data, app_config)
+        else:
+            # Run the synchronous Apply_Postgres in a separate thread to avoid blocking the event loop
+            await asyncio.to_thread(Apply_Postgres, sink_dsn, data, app_config)
         print("Batch applied successfully.")
 
 
+    # where failure_policy=bisect puts the events the sink won't take
+    async def Dead_Letter(poison):
+        if app_config.dead_letter_target == "table":
+            await asyncio.to_thread(Write_Dead_Letters_Table, sink_dsn, poison)
+        else:
+            await asyncio.to_thread(Write_Dead_Letters_File, app_config.dead_letter_path, poison)
+
+
     # function to save the lsn to the table
-    def Persist_Lsn(lsn: str):
-        Set_Last_Applied_Lsn(app_config.slot_name, lsn)
+    # the parquet sink hands back the lsn of its last closed files instead, or None if nothing new is durable yet
+    # the sqlite sink commits the lsn with its open transaction (in a worker thread), nothing left to save here
+    # with sink_durability=fenced the lsn waits for a durability fence, which saves the newest lsn it covers
+    # slots: the slots this apply loop reads for. more than 1 with ordered decode shards, they all save the same lsn
+    fences = [] # each apply loop fences its own batches
+    def Make_Persist_Lsn(slots):
+        def Save_Lsn(lsn):
+            for slot in slots:
+                Set_Last_Applied_Lsn(slot, lsn)
+            control.last_saved_lsn = lsn
+
+        def Saved(lsn):
+            control.last_saved_lsn = lsn
+
+        fence = None
+        if app_config.sink_durability == "fenced":
+            fence = Durability_Fence(sink_dsn, app_config.fence_every_batches, app_config.fence_interval_ms / 1000,
+                                     Save_Lsn)
+            fences.append(fence)
 
+        def Persist_Lsn(lsn: str):
+            if sqlite_sink:
+                sqlite_sink.Batch_Committed(lsn, slots, Saved)
+                return
+
+            if parquet_sink:
+                lsn = parquet_sink.Batch_Committed(lsn)
+                if lsn is None:
+                    return
+
+            if fence:
+                fence.Batch_Committed(lsn) # saved once a fence covers it
+                return
+
+            Save_Lsn(lsn)
+
+        return Persist_Lsn
+
+
+    # optional, lets the batch size follow the sink's latency instead of staying at batch_size
+    batch_controller = None
+    if app_config.adaptive_batching:
+        batch_controller = Adaptive_Batch_Controller(app_config.batch_size, app_config.batch_size_min,
+                                                     app_config.batch_size_max, app_config.target_batch_latency_ms / 1000)
+
+    # pause/resume/flush/rate cap/batch and retry settings while running. the rate cap wraps every sink call
+    control = Pipeline_Control(app_config.batch_size, app_config.max_retries, app_config.backoff_seconds,
+                               batch_controller, app_config.max_events_per_second)
+    apply_batch = control.Throttled(Apply_Batch)
+    control_server = None
+    if app_config.control_port:
+        control_server = await Start_Control_Server(control, app_config.control_host, app_config.control_port)
+
+    # skips replayed transactions/events after a restart, seeded with the last saved lsn
+    # slots: seeded with the lowest lsn they saved, nothing if any of them hasn't saved one yet
+    dedups = []
+    def Make_Dedup(slots):
+        if not app_config.dedup_enabled:
+            return None
+
+        saved = [Get_Last_Applied_Lsn(slot) for slot in slots]
+        floor = None if None in saved else min(saved, key=Lsn_To_Int)
+        dedups.append(Dedup_Filter(app_config.dedup_capacity, floor))
+        return dedups[-1]
+
+    # sampling profiler + tracemalloc, off unless profiling=true or someone sends SIGUSR1
+    profiler = Profiler(app_config.profile_dir, app_config.profile_interval_seconds, app_config.profile_sample_ms / 1000,
+                        app_config.profile_top_n)
+    Install_Profiler_Toggle(profiler)
+    if app_config.profiling:
+        profiler.Start()
+
+    # keeps the saved lsn (and the slot) moving when this database is quiet
+    heartbeat_task = None
+    if app_config.heartbeat_mode != "off":
+        heartbeat_task = asyncio.create_task(Run_Heartbeat(primary_dsn, app_config.heartbeat_mode,
+                                                           app_config.heartbeat_interval_seconds, stop_event))
 
     print("\n")
     # main data loop
     # generator -> batch results -> process batch -> send to sink -> save lsn -> generator
-    await Run_Apply_Loop(
-        source=source,
-        batch_size=app_config.batch_size,
-        apply_batch=Apply_Batch,
-        persist_lsn=Persist_Lsn,
-        max_retries=app_config.max_retries,
-        backoff_seconds=app_config.backoff_seconds
-    )
+    if shards and not shards_ordered:
+        # 1 source and apply loop per shard, side by side. each saves its own slot's lsn
+        print(f"Decoding {len(shards)} shards: {', '.join(shard.slot for shard in shards)}")
+        await asyncio.gather(*(Run_Apply_Loop(
+            source=Open_Source(shard.slot, shard),
+            batch_size=app_config.batch_size,
+            apply_batch=apply_batch,
+            persist_lsn=Make_Persist_Lsn([shard.slot]),
+            max_retries=app_config.max_retries,
+            backoff_seconds=app_config.backoff_seconds,
+            batch_controller=batch_controller,
+            failure_policy=app_config.failure_policy,
+            dead_letter=Dead_Letter,
+            is_poison=Is_Poison_Error if app_config.sink_type == "postgres" else None,
+            stop_event=stop_event,
+            shutdown_deadline_seconds=app_config.shutdown_deadline_seconds,
+            dedup=Make_Dedup([shard.slot]),
+            control=control
+        ) for shard in shards))
+    elif app_config.lanes_config_path:
+        lanes, sink_concurrency = Load_Lanes_Config(app_config.lanes_config_path)
+        if (parquet_sink or sqlite_sink or use_async_sink) and sink_concurrency > 1:
+            print("The async, parquet and sqlite sinks apply 1 batch at a time, using sink_concurrency=1")
+            sink_concurrency = 1
+
+        # same loop split into lanes, see lane_scheduler.py
+        await Run_Lane_Apply_Loop(
+            source=Open_Source(app_config.slot_name),
+            lanes=lanes,
+            sink_concurrency=sink_concurrency,
+            apply_batch=apply_batch,
+            persist_lsn=Make_Persist_Lsn([app_config.slot_name]),
+            max_retries=app_config.max_retries,
+            backoff_seconds=app_config.backoff_seconds,
+            failure_policy=app_config.failure_policy,
+            dead_letter=Dead_Letter,
+            is_poison=Is_Poison_Error if app_config.sink_type == "postgres" else None,
+            stop_event=stop_event,
+            shutdown_deadline_seconds=app_config.shutdown_deadline_seconds,
+            dedup=Make_Dedup([app_config.slot_name]),
+            control=control
+        )
+    else:
+        # ordered shards are merged back into 1 source in commit order, every shard slot saves the same lsn
+        slots = [shard.slot for shard in shards] or [app_config.slot_name]
+        if shards:
+            print(f"Decoding {len(shards)} shards in commit order: {', '.join(slots)}")
+            source = Merge_By_Commit_Lsn([Open_Source(shard.slot, shard) for shard in shards])
+        else:
+            source = Open_Source(app_config.slot_name)
+
+        await Run_Apply_Loop(
+            source=source,
+            batch_size=app_config.batch_size,
+            apply_batch=apply_batch,
+            persist_lsn=Make_Persist_Lsn(slots),
+            max_retries=app_config.max_retries,
+            backoff_seconds=app_config.backoff_seconds,
+            batch_controller=batch_controller,
+            failure_policy=app_config.failure_policy,
+            dead_letter=Dead_Letter,
+            is_poison=Is_Poison_Error if app_config.sink_type == "postgres" else None,
+            stop_event=stop_event,
+            shutdown_deadline_seconds=app_config.shutdown_deadline_seconds,
+            dedup=Make_Dedup(slots),
+            control=control
+        )
+
+    if heartbeat_task:
+        heartbeat_task.cancel()
+
+    if control_server:
+        control_server.close()
+
+    await asyncio.to_thread(profiler.Stop) # writes the last interval if it was on
+
+    if parquet_sink:
+        final_lsn = await asyncio.to_thread(parquet_sink.Close)
+        if final_lsn:
+            Set_Last_Applied_Lsn(app_config.slot_name, final_lsn)
+
+    if sqlite_sink:
+        await sqlite_sink.Close()
+
+    # the batches since the last fence are flushed before their lsn is saved
+    for fence in fences:
+        await fence.Close()
+
+    await Close_Async_Sink_Conn()
+
+    skipped_transactions = sum(dedup.skipped_transactions for dedup in dedups)
+    skipped_events = sum(dedup.skipped_events for dedup in dedups)
+    if skipped_transactions or skipped_events:
+        print(f"Duplicates skipped: {skipped_transactions} transactions, {skipped_events} events")
+
+    if source_stats.restarts:
+        print(f"WAL source restarts: {source_stats.restarts}, downtime {source_stats.downtime_seconds:.1f}s, reasons {source_stats.reasons}")
 
 
 if __name__ == "__main__":
@@ -1,7 +1,7 @@
 import sqlite3
 from pathlib import Path
 from typing import Optional
-from Sql_Commands import Create_LSN_Offset_Table, Get_Last_Applied_Lsn_Sql, Set_Last_Applied_Lsn
+from Sql_Commands import Create_LSN_Offset_Table, Get_Last_Applied_Lsn_Sql, Set_Last_Applied_Lsn_Sql
 
 
 '''
@@ -57,6 +57,18 @@ def Get_Last_Applied_Lsn(slot_name):
 def Set_Last_Applied_Lsn(slot_name, lsn):
     global last_lsn_db_conn
     
-    set_lsn_sql = Set_Last_Applied_Lsn()
+    set_lsn_sql = Set_Last_Applied_Lsn_Sql()
     last_lsn_db_conn.execute(set_lsn_sql, (slot_name, lsn))
     last_lsn_db_conn.commit()
+
+
+# pg prints lsn's as 2 hex numbers 'high/low' (ex '0/16B6C50'). as text they don't sort correctly
+# ('0/9' > '0/10'), so convert to the 64 bit integer pg uses internally when comparing them
+def Lsn_To_Int(lsn):
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+# reverse of Lsn_To_Int. returns pg_lsn text like '0/16B6C50'
+def Int_To_Lsn(value):
+    return f"{value >> 32:X}/{value & 0xFFFFFFFF:X}"
@@ -0,0 +1,194 @@
+import functools
+import inspect
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+
+
+'''
+sampling profiler and allocation tracing for a running pipeline (profiling=on in app.env, or SIGUSR1 to toggle)
+
+when throughput drops we want to see where the time and the memory go without restarting Main.py
+- a background thread looks at the stack of every other thread (the event loop, and the asyncio.to_thread workers the
+  sync/parquet sinks run on) every profile_sample_ms, and counts them as collapsed stacks
+- tracemalloc runs while profiling is on. Normalize_Wal2Json, Process_Batch and the postgres sinks are wrapped with
+  @Profiled, which adds up their calls, time and traced memory growth per section
+- every profile_interval_seconds it writes to profile_dir
+    stacks_<time>_<n>.folded  "thread;outer func;...;inner func count" lines, feed to flamegraph.pl or speedscope
+    alloc_<time>_<n>.txt      top profile_top_n lines by memory allocated since the last dump, plus the section totals
+
+off, the only cost is 1 global check per wrapped call. the section memory numbers are approximate when batches
+overlap (async sink, lanes), tracemalloc counts every thread's allocations
+- SIGUSR1 only flips a flag on the event loop. starting tracemalloc, the snapshots, the diffs and the file writes all
+  happen on the profiler thread
+'''
+
+active_profiler = None # the running Profiler, None when profiling is off
+
+
+class Profiler:
+    def __init__(self, directory, interval_seconds=60.0, sample_seconds=0.01, top_n=25, trace_frames=10):
+        self.directory = Path(directory)
+        self.interval_seconds = interval_seconds
+        self.sample_seconds = sample_seconds
+        self.top_n = top_n
+        self.trace_frames = trace_frames
+        self.stacks = Counter()
+        self.sections = {} # name -> [calls, seconds, traced bytes growth]
+        self.lock = threading.Lock()
+        self.stop_sampling = None
+        self.sampler = None
+        self.last_snapshot = None
+        self.dumps = 0
+
+    # starts the sampler thread, which turns tracemalloc on and takes the first snapshot itself
+    def Start(self):
+        global active_profiler
+        if self.sampler is not None and self.sampler.is_alive():
+            return # on, or still writing its last dump
+
+        self.stop_sampling = threading.Event()
+        self.sampler = threading.Thread(target=self.Sample_Loop, name="profiler", daemon=True)
+        self.sampler.start()
+        active_profiler = self
+
+    # only sets the stop flag, the sampler thread writes the last dump and turns tracemalloc off. safe to call from
+    # the event loop (the SIGUSR1 handler)
+    def Request_Stop(self):
+        global active_profiler
+        if active_profiler is not self:
+            return
+
+        active_profiler = None
+        self.stop_sampling.set()
+
+    # stops and waits for the last dump, for the shutdown (run it with asyncio.to_thread)
+    def Stop(self):
+        self.Request_Stop()
+        if self.sampler is not None:
+            self.sampler.join()
+
+    def Toggle(self):
+        if active_profiler is self:
+            self.Request_Stop()
+        elif self.sampler is not None and self.sampler.is_alive():
+            print("Profiler is still writing its last dump, try again in a moment")
+        else:
+            self.Start()
+
+    def Sample_Loop(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.trace_frames)
+        self.last_snapshot = tracemalloc.take_snapshot()
+        print(f"Profiling on, writing to {self.directory} every {self.interval_seconds:g}s")
+
+        own_id = threading.get_ident()
+        next_dump = time.monotonic() + self.interval_seconds
+        while not self.stop_sampling.wait(self.sample_seconds):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            samples = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    samples.append(Collapse_Stack(names.get(thread_id, str(thread_id)), frame))
+            with self.lock:
+                self.stacks.update(samples)
+
+            if time.monotonic() >= next_dump:
+                self.Dump()
+                next_dump = time.monotonic() + self.interval_seconds
+
+        self.Dump()
+        tracemalloc.stop()
+        self.last_snapshot = None
+        print("Profiling off")
+
+    def Record_Section(self, name, seconds, traced_bytes):
+        with self.lock:
+            section = self.sections.setdefault(name, [0, 0.0, 0])
+            section[0] += 1
+            section[1] += seconds
+            section[2] += traced_bytes
+
+    # writes what was collected since the last dump and starts counting again
+    def Dump(self):
+        self.dumps += 1
+        stamp = f"{time.strftime('%Y%m%d_%H%M%S')}_{self.dumps}"
+        with self.lock:
+            stacks, self.stacks = self.stacks, Counter()
+            sections, self.sections = self.sections, {}
+
+        if stacks:
+            with open(self.directory / f"stacks_{stamp}.folded", "w", encoding="utf-8") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+
+        if not tracemalloc.is_tracing():
+            return
+
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                              tracemalloc.Filter(False, __file__)])
+        growth = snapshot.compare_to(self.last_snapshot, "lineno") if self.last_snapshot else []
+        top = sorted(growth, key=lambda stat: stat.size_diff, reverse=True)[:self.top_n]
+        self.last_snapshot = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+
+        with open(self.directory / f"alloc_{stamp}.txt", "w", encoding="utf-8") as f:
+            f.write(f"traced memory now {current / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB\n\n")
+            f.write("section                      calls    seconds    traced MB growth\n")
+            for name, (calls, seconds, traced_bytes) in sorted(sections.items()):
+                f.write(f"{name:<28} {calls:>6} {seconds:>10.3f} {traced_bytes / 1024 / 1024:>19.2f}\n")
+            f.write(f"\ntop {self.top_n} lines by memory allocated since the last dump\n")
+            for stat in top:
+                f.write(f"{stat}\n")
+
+
+# "thread;outermost (file:line);...;innermost (file:line)" for 1 thread's current stack
+def Collapse_Stack(thread_name, frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+# times a hot path function and the traced memory it grows by, only while profiling is on
+def Profiled(name):
+    def Decorate(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def Async_Wrapper(*args, **kwargs):
+                profiler = active_profiler
+                if profiler is None:
+                    return await function(*args, **kwargs)
+
+                started, traced = time.perf_counter(), tracemalloc.get_traced_memory()[0]
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    profiler.Record_Section(name, time.perf_counter() - started, tracemalloc.get_traced_memory()[0] - traced)
+
+            return Async_Wrapper
+
+        @functools.wraps(function)
+        def Wrapper(*args, **kwargs):
+            profiler = active_profiler
+            if profiler is None:
+                return function(*args, **kwargs)
+
+            started, traced = time.perf_counter(), tracemalloc.get_traced_memory()[0]
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.Record_Section(name, time.perf_counter() - started, tracemalloc.get_traced_memory()[0] - traced)
+
+        return Wrapper
+
+    return Decorate
@@ -0,0 +1,329 @@
+"""
+Fault injection benchmark for crash/restart recovery (no database needed)
+
+the README says a crash never loses data and only replays from the last saved lsn. this puts numbers on that: the real
+Run_Apply_Loop, Process_Batch, Dedup_Filter, Supervised_Source and sqlite Offsets run against a scripted source (a
+stand-in for the slot + pg_recvlogical, fed by Load_Generator's Synthetic_Wal2Json) and an in memory sink that keeps
+every committed (table, pk, commit_lsn) key and charges a fixed cost per batch and per event
+
+scenarios (each runs the same transaction stream from an empty offsets file)
+    none            no fault, the baseline throughput
+    mid_batch       the process dies while the sink is writing a batch, before it commits
+    after_commit    the sink committed, then the process dies before Set_Last_Applied_Lsn
+    during_retries  the sink starts failing (connection errors) and the process dies while Process_Batch is retrying
+    source_exit     pg_recvlogical exits mid stream, Source_Supervisor restarts it (no process crash)
+a crash is an exception the retry code can't catch (like kill -9). the "restart" builds a new pipeline the way Main
+does: the saved lsn from sqlite, a fresh dedup filter seeded with it, a source resuming from it. the slot stand-in
+replays from the resume lsn inclusive, like a slot whose confirmed position is at the saved lsn
+
+measured per scenario
+    events_replayed        events the source handed out again after the fault
+    replayed_txns_skipped  replayed transactions the dedup floor dropped before they were normalized
+    duplicate_writes       events the sink was asked to write that it already had (ON CONFLICT DO NOTHING work)
+    lost_events            events of the stream that never reached the sink, has to be 0
+    recovery_seconds       from the fault until the saved lsn is back past everything read before the fault
+    catch_up_eps           events committed per second from the fault to the end of the stream
+process startup, connecting and pg_recvlogical's own restart aren't modeled, add them to recovery_seconds for an RTO
+
+ex) python Recovery_Benchmark.py --transactions 5000 --crash-after-batches 10 --output recovery.json
+"""
+
+import argparse
+import asyncio
+import bisect
+import json
+import os
+import tempfile
+import time
+from Load_Generator import Synthetic_Wal2Json, Parse_Mix
+from Offsets import Get_Lsn_Table_Conn, Get_Last_Applied_Lsn, Set_Last_Applied_Lsn, Lsn_To_Int
+from Apply_Manager import Run_Apply_Loop, Normalize_Wal2Json
+from Source_Supervisor import Supervised_Source, Source_Stats
+from Dedup_Filter import Dedup_Filter, Event_Key
+
+
+SCENARIOS = ["none", "mid_batch", "after_commit", "during_retries", "source_exit"]
+SLOT = "recovery_benchmark"
+
+
+# not an Exception, so Apply_Events/Process_Batch can't retry it away. it ends the run like the process dying
+class Injected_Crash(BaseException):
+    pass
+
+
+# where and when the scenario's fault fires, and what the pipeline looked like at that moment
+class Fault_Plan:
+    def __init__(self, scenario, at_batch, slot, sink):
+        self.scenario = scenario
+        self.at_batch = at_batch
+        self.slot = slot
+        self.sink = sink
+        self.sink_calls = 0
+        self.persist_calls = 0
+        self.fired = False
+        self.fault_time = None
+        self.fault_high_water = None  # furthest lsn the source had handed out when the fault hit
+        self.fault_committed = 0      # events the sink had committed when the fault hit
+        self.recovered_time = None
+
+    def Fire(self):
+        self.fired = True
+        self.fault_time = time.perf_counter()
+        self.fault_high_water = self.slot.high_water
+        self.fault_committed = self.sink.committed_events
+
+    # sink call, before the write starts. during_retries fails from here
+    def Before_Write(self):
+        self.sink_calls += 1
+        if self.scenario != "during_retries" or self.sink_calls < self.at_batch:
+            return
+        if not self.fired:
+            self.Fire()
+            raise ConnectionError("injected: sink connection lost")
+        if self.sink_calls == self.at_batch + 1:
+            raise ConnectionError("injected: sink still down")
+        if self.sink_calls == self.at_batch + 2:
+            raise Injected_Crash("crashed while retrying")
+
+    # halfway through the sink's write, before its commit
+    def Mid_Write(self):
+        if self.scenario == "mid_batch" and not self.fired and self.sink_calls >= self.at_batch:
+            self.Fire()
+            raise Injected_Crash("crashed mid batch")
+
+    def Before_Persist(self):
+        self.persist_calls += 1
+        if self.scenario == "after_commit" and not self.fired and self.persist_calls >= self.at_batch:
+            self.Fire()
+            raise Injected_Crash("crashed after the sink commit, before the lsn was saved")
+
+    def After_Persist(self, lsn):
+        if self.fired and self.recovered_time is None and Lsn_To_Int(lsn) >= self.fault_high_water:
+            self.recovered_time = time.perf_counter()
+
+
+''' stand-in for the replication slot + pg_recvlogical
+Make_Source(start_lsn, exit_info) has Source_Pg's signature and yields lists of (lsn, transaction) like it does,
+records_per_read transactions per list. when the script runs out it sets the run's stop event (so the supervisor
+doesn't restart it and the apply loop drains) and ends
+'''
+class Scripted_Slot:
+    def __init__(self, transactions, records_per_read):
+        self.transactions = transactions
+        self.lsn_values = [Lsn_To_Int(lsn) for lsn, _ in transactions]
+        self.event_counts = [len(obj["change"]) for _, obj in transactions]
+        self.records_per_read = records_per_read
+        self.high_water = -1
+        self.replayed_events = 0
+        self.exit_after_reads = None # source_exit: end the stream like pg_recvlogical dying after this many reads
+        self.on_exit = None
+        self.stop_event = None
+
+    async def Make_Source(self, start_lsn, exit_info=None):
+        index = bisect.bisect_left(self.lsn_values, Lsn_To_Int(start_lsn)) if start_lsn else 0
+        reads = 0
+        while index < len(self.transactions):
+            end = min(index + self.records_per_read, len(self.transactions))
+            for i in range(index, end):
+                if self.lsn_values[i] <= self.high_water:
+                    self.replayed_events += self.event_counts[i]
+                else:
+                    self.high_water = self.lsn_values[i]
+            yield self.transactions[index:end]
+            index = end
+            reads += 1
+            await asyncio.sleep(0)
+
+            if self.exit_after_reads is not None and reads >= self.exit_after_reads:
+                self.exit_after_reads = None
+                if self.on_exit:
+                    self.on_exit()
+                if exit_info is not None:
+                    exit_info.update(returncode=1, stderr=["pg_recvlogical: error: server closed the connection unexpectedly"])
+                return
+
+        if exit_info is not None:
+            exit_info.update(returncode=0, stderr=[])
+        self.stop_event.set()
+
+
+# in memory sink. a batch is all or nothing, like the postgres sink's transaction
+class Scripted_Sink:
+    def __init__(self, seconds_per_batch, seconds_per_event):
+        self.seconds_per_batch = seconds_per_batch
+        self.seconds_per_event = seconds_per_event
+        self.keys = set()
+        self.committed_events = 0
+        self.duplicate_writes = 0
+
+    async def Apply(self, events, fault):
+        fault.Before_Write()
+        cost = self.seconds_per_batch + self.seconds_per_event * len(events)
+        await asyncio.sleep(cost / 2)
+        fault.Mid_Write()
+        await asyncio.sleep(cost / 2)
+
+        for event in events:
+            key = Event_Key(event)
+            if key in self.keys:
+                self.duplicate_writes += 1
+            else:
+                self.keys.add(key)
+        self.committed_events += len(events)
+
+
+# 1 process lifetime, wired like Main. raises Injected_Crash if the fault kills it
+async def Run_Pipeline(slot, sink, fault, args):
+    saved_lsn = Get_Last_Applied_Lsn(SLOT)
+    stop_event = asyncio.Event()
+    slot.stop_event = stop_event
+    dedup = None if args.no_dedup else Dedup_Filter(args.dedup_capacity, saved_lsn)
+
+    source = Supervised_Source(
+        make_source=slot.Make_Source,
+        get_resume_lsn=lambda: Get_Last_Applied_Lsn(SLOT),
+        stats=Source_Stats(),
+        backoff_seconds=args.restart_backoff_seconds,
+        backoff_max_seconds=args.restart_backoff_seconds,
+        stop_event=stop_event
+    )
+
+    async def Apply_Batch(events):
+        await sink.Apply(events, fault)
+
+    def Persist_Lsn(lsn):
+        fault.Before_Persist()
+        Set_Last_Applied_Lsn(SLOT, lsn)
+        fault.After_Persist(lsn)
+
+    try:
+        await Run_Apply_Loop(
+            source=source,
+            batch_size=args.batch_size,
+            apply_batch=Apply_Batch,
+            persist_lsn=Persist_Lsn,
+            max_retries=args.max_retries,
+            backoff_seconds=args.backoff_seconds,
+            stop_event=stop_event,
+            shutdown_deadline_seconds=30,
+            dedup=dedup
+        )
+    except Injected_Crash:
+        await source.aclose()
+        raise
+
+    return dedup.skipped_transactions if dedup else 0
+
+
+async def Run_Scenario(scenario, transactions, expected_keys, args):
+    slot = Scripted_Slot(transactions, args.records_per_read)
+    sink = Scripted_Sink(args.sink_ms_per_batch / 1000, args.sink_us_per_event / 1_000_000)
+    fault = Fault_Plan(scenario, args.crash_after_batches, slot, sink)
+    if scenario == "source_exit":
+        slot.exit_after_reads = max(1, args.crash_after_batches * args.batch_size // args.records_per_read)
+        slot.on_exit = fault.Fire
+
+    skipped = 0
+    restarts = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        Get_Lsn_Table_Conn(os.path.join(tmp, "offsets.sqlite"))
+        started = time.perf_counter()
+        while True:
+            try:
+                skipped += await Run_Pipeline(slot, sink, fault, args)
+                break
+            except Injected_Crash as e:
+                restarts += 1
+                print(f"  {scenario}: {e}, restarting from {Get_Last_Applied_Lsn(SLOT) or 'the beginning'}")
+        finished = time.perf_counter()
+
+    report = {
+        "scenario": scenario,
+        "restarts": restarts,
+        "events_replayed": slot.replayed_events,
+        "replayed_txns_skipped": skipped,
+        "duplicate_writes": sink.duplicate_writes,
+        "lost_events": len(expected_keys - sink.keys),
+        "recovery_seconds": None,
+        "catch_up_eps": None,
+        "total_seconds": round(finished - started, 3),
+        "events_per_second": round(sink.committed_events / (finished - started), 1),
+    }
+    if fault.fired:
+        if fault.recovered_time is not None:
+            report["recovery_seconds"] = round(fault.recovered_time - fault.fault_time, 4)
+        report["catch_up_eps"] = round((sink.committed_events - fault.fault_committed) / (finished - fault.fault_time), 1)
+
+    return report
+
+
+def Make_Transactions(args):
+    generator = Synthetic_Wal2Json(seed=args.seed)
+    weights = Parse_Mix(args.mix)
+    operations, operation_weights = list(weights), list(weights.values())
+    transactions = []
+    for _ in range(args.transactions):
+        operation = generator.rng.choices(operations, operation_weights)[0]
+        obj = generator.Transaction(operation, args.bulk_rows, args.large_txn_rows, args.wide_bytes, args.hot_keys)
+        transactions.append((obj["nextlsn"], obj))
+
+    return transactions
+
+
+def Print_Report(reports):
+    columns = ["scenario", "restarts", "events_replayed", "replayed_txns_skipped", "duplicate_writes", "lost_events",
+               "recovery_seconds", "catch_up_eps", "events_per_second"]
+    print("\n" + "  ".join(f"{column:>21}" for column in columns))
+    for report in reports:
+        print("  ".join(f"{'-' if report[column] is None else report[column]:>21}" for column in columns))
+
+
+async def Run(args):
+    transactions = Make_Transactions(args)
+    expected_keys = {Event_Key(event) for _, obj in transactions for event in Normalize_Wal2Json(obj)}
+    print(f"{len(transactions)} transactions, {len(expected_keys)} events, batch size {args.batch_size}, "
+          f"fault after batch {args.crash_after_batches}, dedup {'off' if args.no_dedup else 'on'}")
+
+    reports = []
+    for scenario in args.scenarios.split(","):
+        if scenario not in SCENARIOS:
+            raise ValueError(f"unknown scenario '{scenario}', use {SCENARIOS}")
+        reports.append(await Run_Scenario(scenario, transactions, expected_keys, args))
+
+    Print_Report(reports)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), "results": reports}, f, indent=2)
+
+    if any(report["lost_events"] for report in reports):
+        raise SystemExit("events were lost")
+
+
+def Main():
+    parser = argparse.ArgumentParser(description="crash/restart recovery benchmark with a scripted source and sink")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated, from " + ",".join(SCENARIOS))
+    parser.add_argument("--transactions", type=int, default=5000)
+    parser.add_argument("--mix", default="single=60,bulk=10,large_txn=1,wide=9,hot=20", help="Load_Generator operation weights")
+    parser.add_argument("--bulk-rows", type=int, default=50)
+    parser.add_argument("--large-txn-rows", type=int, default=1000)
+    parser.add_argument("--wide-bytes", type=int, default=2048)
+    parser.add_argument("--hot-keys", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=100, help="transactions per batch, like batch_size in app.env")
+    parser.add_argument("--records-per-read", type=int, default=20, help="transactions per source read")
+    parser.add_argument("--crash-after-batches", type=int, default=10, help="the fault fires on this batch")
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--backoff-seconds", type=float, default=0.01)
+    parser.add_argument("--restart-backoff-seconds", type=float, default=0.01, help="source supervisor backoff")
+    parser.add_argument("--sink-ms-per-batch", type=float, default=2, help="simulated sink round trip per batch")
+    parser.add_argument("--sink-us-per-event", type=float, default=20, help="simulated sink cost per event")
+    parser.add_argument("--dedup-capacity", type=int, default=100000)
+    parser.add_argument("--no-dedup", action="store_true", help="run without Dedup_Filter, like dedup_enabled=false")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", metavar="PATH", help="also write the results as json")
+    args = parser.parse_args()
+
+    asyncio.run(Run(args))
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,106 @@
+import hashlib
+import json
+from psycopg.types.json import Jsonb
+from Sql_Commands import Register_Cdc_Schema_Sql, Get_Cdc_Schema_Id_Sql
+
+
+'''
+schema registry for the sink (payload_mode=registry in app.env)
+
+every wal2json change repeats its table's columnnames and columntypes. for narrow tables that's most of the bytes
+we write to cdc_events.payload. instead each distinct shape (table + column names + column types) is stored once in
+cdc_schemas with a version id, and cdc_events rows only keep schema_id and the values
+
+- shapes are registered in their own committed transaction before the batch insert, so a cached schema_id always
+  points at a row that exists. a new column or type change is just a new shape/version
+- the cdc_events_full view and Rebuild_Payload() put the full payload back together
+- changes without columnnames (deletes only have oldkeys) are stored whole with no schema_id
+'''
+
+schema_ids = {} # (table, column names, column types) -> schema_id. only holds committed registrations
+
+
+# event: a normalized event. returns None if the change has no column list
+def Shape_Key(event):
+    change = event["payload_json"]
+    names = change.get("columnnames")
+    if not names:
+        return None
+
+    return (event["table"], tuple(names), tuple(change.get("columntypes") or ()))
+
+
+def Shape_Hash(key):
+    _, names, types = key
+    return hashlib.md5(json.dumps([names, types]).encode("utf-8")).hexdigest()
+
+
+# shapes in this batch that aren't registered yet, each once
+def Missing_Shapes(events):
+    missing = {}
+    for event in events:
+        key = Shape_Key(event)
+        if key is not None and key not in schema_ids:
+            missing[key] = None
+
+    return list(missing)
+
+
+def Register_Params(key):
+    table, names, types = key
+    return {"table": table, "hash": Shape_Hash(key), "names": Jsonb(list(names)), "types": Jsonb(list(types))}
+
+
+# sync version, used by Apply_Postgres. returns True if it registered anything (caller commits it)
+def Register_Schemas(cur, events):
+    missing = Missing_Shapes(events)
+    for key in missing:
+        cur.execute(Register_Cdc_Schema_Sql(), Register_Params(key))
+        cur.execute(Get_Cdc_Schema_Id_Sql(), (key[0], Shape_Hash(key)))
+        schema_ids[key] = cur.fetchone()[0]
+
+    return len(missing) > 0
+
+
+# async version, used by Apply_Postgres_Async
+async def Register_Schemas_Async(cur, events):
+    missing = Missing_Shapes(events)
+    for key in missing:
+        await cur.execute(Register_Cdc_Schema_Sql(), Register_Params(key))
+        await cur.execute(Get_Cdc_Schema_Id_Sql(), (key[0], Shape_Hash(key)))
+        schema_ids[key] = (await cur.fetchone())[0]
+
+    return len(missing) > 0
+
+
+# ids cached during a transaction that then failed may not exist, forget everything and look them up again
+def Reset_Schema_Cache():
+    schema_ids.clear()
+
+
+# the ids of this batch's shapes, taken right after they're registered. the batch's rows are built from these, so
+# another sink thread resetting schema_ids in between can't make a lookup fail
+def Batch_Schema_Ids(events):
+    ids = {}
+    for event in events:
+        key = Shape_Key(event)
+        if key is not None:
+            ids[key] = schema_ids[key]
+
+    return ids
+
+
+# returns (payload without columnnames/columntypes, schema_id). needs Register_Schemas to have run for the batch
+# ids: the batch's Batch_Schema_Ids
+def Strip_Payload(event, ids):
+    key = Shape_Key(event)
+    if key is None:
+        return event["payload_json"], None
+
+    payload = {k: v for k, v in event["payload_json"].items() if k != "columnnames" and k != "columntypes"}
+    return payload, ids[key]
+
+
+# reverse of Strip_Payload, for reading rows back in python (the cdc_events_full view does the same in sql)
+def Rebuild_Payload(payload, columnnames, columntypes):
+    return {**payload, "columnnames": columnnames, "columntypes": columntypes}
@@ -0,0 +1,240 @@
+import json
+import os
+import time
+from pathlib import Path
+from Value_Converters import Typed_Columns
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # only needed when sink_type=parquet
+    pa = None
+    pq = None
+
+
+'''
+columnar file sink (sink_type=parquet in app.env). needs pyarrow
+
+each batch is grouped by table and column shape, then turned into 1 arrow record batch per group. the rows go through
+the compiled converter for their shape (Value_Converters.py), which also transposes them, and every typed column
+becomes an arrow array in 1 call, using the wal2json columntypes for the arrow type
+
+files
+- 1 open file per table under parquet_dir/<schema.table>/, written as <name>.inprogress
+- when any open file passes parquet_max_file_mb or the oldest is parquet_max_file_seconds old, every open file is
+  closed, fsync'd and renamed to <table>__<first lsn>__<last lsn>.parquet
+- a new column shape for a table closes that table's file early, a parquet file has 1 schema
+
+lsn
+- rows in an open file aren't durable. Batch_Committed(lsn) is called where the lsn would normally be saved, and only
+  returns an lsn once the files holding that batch are closed. Main saves that one
+- after a crash the .inprogress files are garbage and everything after the saved lsn is replayed
+
+each row also gets _commit_lsn, _commit_time and _kind columns
+'''
+
+
+# pg type name (as wal2json writes it) -> arrow type. anything unknown is kept as a string
+# None means let arrow pick from the values (numeric without a precision, the decimals decide it)
+def Arrow_Type(pg_type):
+    base = pg_type.split("(")[0].strip().lower()
+
+    if base.endswith("[]") or base.startswith("_") or base in ("json", "jsonb"):
+        return pa.string() # stored as json text
+    if base in ("smallint", "int2"):
+        return pa.int16()
+    if base in ("integer", "int", "int4", "serial"):
+        return pa.int32()
+    if base in ("bigint", "int8", "bigserial"):
+        return pa.int64()
+    if base in ("real", "float4"):
+        return pa.float32()
+    if base in ("double precision", "float8"):
+        return pa.float64()
+    if base in ("numeric", "decimal"):
+        precision, _, scale = pg_type.partition("(")[2].rstrip(")").partition(",")
+        if precision.strip().isdigit() and int(precision) <= 38:
+            return pa.decimal128(int(precision), int(scale or 0))
+        return None
+    if base in ("boolean", "bool"):
+        return pa.bool_()
+    if base in ("timestamp without time zone", "timestamp"):
+        return pa.timestamp("us")
+    if base in ("timestamp with time zone", "timestamptz"):
+        return pa.timestamp("us", tz="UTC")
+    if base == "date":
+        return pa.date32()
+    if base in ("time without time zone", "time"):
+        return pa.time64("us")
+    if base == "bytea":
+        return pa.binary()
+
+    return pa.string()
+
+
+def Text_Value(value):
+    if value is None or isinstance(value, str):
+        return value
+
+    return json.dumps(value, default=str) if isinstance(value, (list, dict)) else str(value)
+
+
+# builds 1 arrow array from a column of typed python values (see Value_Converters.py)
+# if arrow can't convert a column (ex a value the converter had to leave as text) it's kept as text rather than
+# failing the batch
+def Column_Array(values, arrow_type):
+    try:
+        if arrow_type is not None and pa.types.is_string(arrow_type):
+            return pa.array([Text_Value(v) for v in values], pa.string())
+
+        return pa.array(values, arrow_type)
+
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, OverflowError):
+        return pa.array([Text_Value(v) for v in values], pa.string())
+
+
+# the values of 1 change in column order. deletes only have the key columns, the rest are null
+def Row_Values(change, names):
+    values = change.get("columnvalues")
+    if values is not None:
+        return values
+
+    oldkeys = change.get("oldkeys", {})
+    by_name = dict(zip(oldkeys.get("keynames", []), oldkeys.get("keyvalues", [])))
+    return [by_name.get(name) for name in names]
+
+
+# groups a batch by (table, column names, column types)
+# deletes have no column list, they use the last shape seen for their table in this batch or from earlier batches
+def Group_By_Shape(events, last_shapes):
+    groups = {}
+    for event in events:
+        change = event["payload_json"]
+        names = change.get("columnnames")
+        if names:
+            shape = (tuple(names), tuple(change.get("columntypes") or ("text",) * len(names)))
+            last_shapes[event["table"]] = shape
+        else:
+            shape = last_shapes.get(event["table"])
+            if shape is None:
+                keys = change.get("oldkeys", {})
+                shape = (tuple(keys.get("keynames", [])), tuple(keys.get("keytypes", [])))
+
+        groups.setdefault((event["table"], shape), []).append(event)
+
+    return groups
+
+
+# 1 arrow record batch for 1 group of same shaped events
+def Build_Record_Batch(shape, events):
+    names, types = shape
+    rows = [Row_Values(event["payload_json"], names) for event in events]
+    columns = Typed_Columns(events[0]["table"], names, types, rows)
+
+    arrays = [pa.array([event["commit_lsn"] for event in events], pa.string()),
+              pa.array([event.get("commit_time") for event in events], pa.string()),
+              pa.array([event["type"] for event in events], pa.string())]
+    fields = [pa.field("_commit_lsn", pa.string()), pa.field("_commit_time", pa.string()), pa.field("_kind", pa.string())]
+
+    for name, pg_type, values in zip(names, types, columns):
+        array = Column_Array(values, Arrow_Type(pg_type))
+        arrays.append(array)
+        fields.append(pa.field(name, array.type))
+
+    return pa.RecordBatch.from_arrays(arrays, schema=pa.schema(fields))
+
+
+class Parquet_File_Sink:
+    def __init__(self, directory, max_file_mb, max_file_seconds):
+        if pa is None:
+            raise Exception("sink_type=parquet needs pyarrow (pip install pyarrow)")
+
+        self.directory = Path(directory)
+        self.max_file_bytes = max_file_mb * 1024 * 1024
+        self.max_file_seconds = max_file_seconds
+        self.open_files = {}    # table -> dict(writer, schema, path, first_lsn, last_lsn, opened_at, bytes)
+        self.last_shapes = {}   # table -> last (names, types) seen, used for deletes
+        self.pending_lsn = None # newest batch lsn written to files that aren't closed yet
+
+    # writes 1 batch. called from a worker thread (asyncio.to_thread), it's cpu and disk work
+    def Apply(self, events):
+        for (table, shape), group in Group_By_Shape(events, self.last_shapes).items():
+            record_batch = Build_Record_Batch(shape, group)
+            open_file = self.open_files.get(table)
+
+            if open_file is not None and not open_file["schema"].equals(record_batch.schema):
+                self.Close_File(table)
+                open_file = None
+
+            if open_file is None:
+                open_file = self.Open_File(table, record_batch.schema, group[0]["commit_lsn"])
+
+            open_file["writer"].write_batch(record_batch)
+            open_file["last_lsn"] = group[-1]["commit_lsn"]
+            open_file["bytes"] += record_batch.nbytes
+
+    # called instead of saving the lsn. returns the lsn that's safe to save now, or None
+    def Batch_Committed(self, lsn):
+        self.pending_lsn = lsn
+
+        if not self.open_files:
+            # nothing buffered in open files, everything up to here is already on disk
+            return self.Take_Pending_Lsn()
+
+        oldest = min(f["opened_at"] for f in self.open_files.values())
+        too_big = any(f["bytes"] >= self.max_file_bytes for f in self.open_files.values())
+        if too_big or time.monotonic() - oldest >= self.max_file_seconds:
+            return self.Close()
+
+        return None
+
+    # closes every open file. returns the lsn they cover (or None if there was nothing pending)
+    def Close(self):
+        for table in list(self.open_files):
+            self.Close_File(table)
+
+        return self.Take_Pending_Lsn()
+
+    def Take_Pending_Lsn(self):
+        lsn = self.pending_lsn
+        self.pending_lsn = None
+        return lsn
+
+    def Open_File(self, table, schema, first_lsn):
+        table_dir = self.directory / table
+        table_dir.mkdir(parents=True, exist_ok=True)
+        path = table_dir / f"{table}__{first_lsn.replace('/', '-')}.inprogress"
+
+        open_file = {
+            "writer": pq.ParquetWriter(str(path), schema),
+            "schema": schema,
+            "path": path,
+            "first_lsn": first_lsn,
+            "last_lsn": first_lsn,
+            "opened_at": time.monotonic(),
+            "bytes": 0,
+        }
+        self.open_files[table] = open_file
+        return open_file
+
+    # close, fsync, rename to the final name, fsync the folder so the rename survives a power cut
+    def Close_File(self, table):
+        open_file = self.open_files.pop(table)
+        open_file["writer"].close()
+
+        with open(open_file["path"], "rb") as f:
+            os.fsync(f.fileno())
+
+        first = open_file["first_lsn"].replace("/", "-")
+        last = open_file["last_lsn"].replace("/", "-")
+        final_path = open_file["path"].with_name(f"{table}__{first}__{last}.parquet")
+        os.replace(open_file["path"], final_path)
+
+        if hasattr(os, "O_DIRECTORY"): # windows can't open folders
+            dir_fd = os.open(final_path.parent, os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+        print(f"Closed {final_path.name}")
@@ -1,48 +1,269 @@
 from typing import List, Dict, Any
+import asyncio
+import json
+import threading
 import psycopg
+from psycopg.types.json import Jsonb
 from pathlib import Path
-from Sql_Commands import Insert_Into_Cdc_Events, Create_Cdv_Events_Table
+from Sql_Commands import (Insert_Into_Cdc_Events, Create_Cdv_Events_Table, Create_Partitioned_Cdc_Events_Table,
+                          Insert_Into_Partitioned_Cdc_Events, Get_Cdc_Events_Partitioning_Sql, Create_Cdc_Schemas_Table,
+                          Create_Cdc_Events_Full_View, Create_Cdc_Events_History_Index, Set_Relaxed_Commit_Sql)
+from Offsets import Lsn_To_Int
+from Cdc_Partitions import Ensure_Partitions, Ensure_Partitions_Async, Reset_Known_Partitions
+from Schema_Registry import Register_Schemas, Register_Schemas_Async, Reset_Schema_Cache, Strip_Payload, Batch_Schema_Ids
+from Profiler import Profiled
+from State_Store import (Ensure_State_Tables, Ensure_State_Tables_Async, Upsert_State, Upsert_State_Async,
+                         Reset_Known_State_Tables, Last_Per_Key)
 
+async_sink_conn = None # long lived async connection used by Apply_Postgres_Async
+
+# the sync sink runs in several threads at once (lanes with sink_concurrency > 1, decode shards). the partition, schema
+# and state table caches are module globals, so a thread holds this while it checks/fills them and commits that ddl,
+# and while it resets them. no thread sees another's uncommitted entries, or a cache that's reset half way through
+# its check. the inserts themselves run outside it. reentrant, Ensure_Sink_Objects resets the caches while holding it
+sink_cache_lock = threading.RLock()
+
+
+def Reset_Sink_Caches():
+    with sink_cache_lock:
+        Reset_Known_Partitions()
+        Reset_Schema_Cache()
+        Reset_Known_State_Tables()
 
 
 # create table if it doesn't already exist
-def Create_Cdc_Table(dsn):
-    sql_command = Create_Cdv_Events_Table()
+# partitioned mode refuses to run on top of an old unpartitioned cdc_events, that has to be renamed/migrated first
+def Create_Cdc_Table(dsn, app_config):
+    if app_config.sink_schema_mode == "partitioned":
+        sql_command = Create_Partitioned_Cdc_Events_Table(app_config.lsn_column_type, app_config.partition_by)
+    else:
+        sql_command = Create_Cdv_Events_Table()
     
     try:
         with psycopg.connect(dsn) as cx:
             with cx.cursor() as cur:
+                cur.execute(Get_Cdc_Events_Partitioning_Sql())
+                existing = cur.fetchone()
+                if app_config.sink_schema_mode == "partitioned" and existing and existing[0] != "p":
+                    raise Exception("cdc_events exists but isn't partitioned. rename it before using sink_schema_mode=partitioned")
+
                 cur.execute(sql_command)
+
+                if app_config.payload_mode == "registry":
+                    cur.execute(Create_Cdc_Schemas_Table())
+                    extra_columns = ", e.commit_time" if app_config.sink_schema_mode == "partitioned" else ""
+                    cur.execute(Create_Cdc_Events_Full_View(extra_columns))
+
+                # point in time reads (State_Store.py). partitioned cdc_events already has a sortable lsn in its key
+                if app_config.latest_state and app_config.sink_schema_mode != "partitioned":
+                    cur.execute(Create_Cdc_Events_History_Index())
             cx.commit()
             
     except Exception as e:
         raise Exception(f"Failed to create CDC table: {e}")
 
 
+def Keep_Text(text):
+    return text
+
+
+# jsonb parameter for text that's already json (payload_mode=passthrough), psycopg sends it as it is
+def Raw_Jsonb(text):
+    return Jsonb(text, dumps=Keep_Text)
+
+
+# turns 1 normalized event into the parameters for the cdc_events insert
+# pk is usually a list of key values, it's stored as json text so it fits the TEXT column
+# payload_mode=registry stores the payload without column names/types, plus the schema_id that has them
+# payload_mode=passthrough events carry the change text wal2json sent, it goes in as it is
+# schema_ids: the batch's Batch_Schema_Ids in registry mode
+def Build_Cdc_Row(event, app_config, schema_ids=None):
+    pk = event["pk"] if isinstance(event["pk"], str) else json.dumps(event["pk"])
+
+    if app_config.payload_mode == "registry":
+        payload, schema_id = Strip_Payload(event, schema_ids)
+        payload = Jsonb(payload)
+        extra = (schema_id,)
+    elif "payload_raw" in event:
+        payload = Raw_Jsonb(event["payload_raw"])
+        extra = ()
+    else:
+        payload = Jsonb(event["payload_json"])
+        extra = ()
+
+    if app_config.sink_schema_mode != "partitioned":
+        return (event["table"], pk, event["commit_lsn"], payload) + extra
+
+    if app_config.lsn_column_type == "bigint":
+        commit_lsn = Lsn_To_Int(event["commit_lsn"])
+    else:
+        commit_lsn = event["commit_lsn"]
+
+    return (event["table"], pk, commit_lsn, event.get("commit_time"), payload) + extra
+
+
+def Get_Insert_Sql(app_config):
+    with_schema_id = app_config.payload_mode == "registry"
+
+    if app_config.sink_schema_mode == "partitioned":
+        return Insert_Into_Partitioned_Cdc_Events(app_config.partition_by, with_schema_id, app_config.latest_state)
+
+    return Insert_Into_Cdc_Events(with_schema_id, app_config.latest_state)
+
+
+# the events that go into cdc_events. normally only inserts, with latest_state every kind (1 per key and lsn) so the
+# history can be read back at any point (State_Store.py)
+def Stored_Events(data, app_config):
+    if app_config.latest_state:
+        return Last_Per_Key(data)
+
+    return [event for event in data if event["type"] == "insert"]
+
+
+# partitions, schema registrations and state tables the batch needs, each committed in its own transaction first.
+# runs under sink_cache_lock, and a failure resets the caches before letting go of it, so the entries it added before
+# the failed commit are never seen by another thread. returns the batch's schema ids in registry mode
+def Ensure_Sink_Objects(cx, cur, app_config, inserts):
+    schema_ids = None
+    with sink_cache_lock:
+        try:
+            if app_config.sink_schema_mode == "partitioned":
+                if Ensure_Partitions(cur, app_config, inserts):
+                    cx.commit()
+
+            if app_config.payload_mode == "registry":
+                if Register_Schemas(cur, inserts):
+                    cx.commit()
+                schema_ids = Batch_Schema_Ids(inserts)
+
+            if app_config.latest_state:
+                if Ensure_State_Tables(cur, inserts):
+                    cx.commit()
+        except BaseException:
+            Reset_Sink_Caches()
+            raise
+
+    return schema_ids
+
+
 # example: upsert into a pg server, keyed by (table, primary_key, commit_lsn)
 # data should already be formatted, and this transforms the wal data into insert statements
 # data: List[Dict[str, Any]]
 # sql uses "ON CONFLICT DO NOTHING"
 # this is basically a staging table, I'll need to choose if I handle each event myself but they'll all be there
-def Apply_Postgres(dsn, data):
-    insert_sql = Insert_Into_Cdc_Events()
+# in partitioned mode missing partitions are created (and old ones expired) in their own transaction first
+# with latest_state the state tables are upserted in the same transaction as the insert
+# with sink_durability=fenced the commit doesn't wait for the sink's wal flush (Durability_Fence.py)
+@Profiled("Apply_Postgres")
+def Apply_Postgres(dsn, data, app_config):
+    insert_sql = Get_Insert_Sql(app_config)
+    inserts = Stored_Events(data, app_config)
 
     #print(f"DEBUG: Connecting to Sink DB with DSN: {dsn.replace(dsn.split('password=')[1].split()[0], '*****') if 'password=' in dsn else dsn}")
     try:
         # Use synchronous connection to avoid ProactorEventLoop issues on Windows
         with psycopg.connect(dsn, connect_timeout=5) as cx:
             with cx.cursor() as cur:
-                for event in data:
-                    if event["type"] == "insert":
-                        # example upsert; adapt to your schema
-                        cur.execute(insert_sql,
-                                         (event["table"], event["pk"], event["commit_lsn"], event["payload_json"]))
+                schema_ids = Ensure_Sink_Objects(cx, cur, app_config, inserts)
+
+                # example upsert; adapt to your schema
+                if app_config.sink_durability == "fenced":
+                    cur.execute(Set_Relaxed_Commit_Sql())
+                rows = [Build_Cdc_Row(event, app_config, schema_ids) for event in inserts]
+                cur.executemany(insert_sql, rows)
+                if app_config.latest_state:
+                    Upsert_State(cur, inserts)
                 cx.commit()
 
     except psycopg.OperationalError as e:
+        Reset_Sink_Caches()
         print(f"ERROR: Failed to connect to Sink DB: {e}")
         raise e
 
     except Exception as e:
+        Reset_Sink_Caches()
         print(f"ERROR: Unexpected error in Apply_Postgres: {e}")
         raise e
+
+
+# tells Process_Batch whether a failed batch is the data's fault (poison, retrying won't help) or anything else, which
+# retries and then halts
+# only sqlstates about the rows themselves count: class 22 (bad values), class 23 (constraint violations) and 54000
+# (a value too big to index). everything else the sink reports is the sink's problem, not the data's: a dropped
+# cdc_events (42P01), a revoked grant (42501), a column that drifted (42703). bisecting those would dead letter the
+# whole stream while the lsn moves on. python errors (TypeError, KeyError, ...) are bugs in this code, same thing
+POISON_SQLSTATE_CLASSES = ("22", "23")
+POISON_SQLSTATES = ("54000",)
+
+
+def Is_Poison_Error(exc):
+    if not isinstance(exc, psycopg.Error):
+        return False
+
+    sqlstate = getattr(exc, "sqlstate", None) or ""
+    return sqlstate[:2] in POISON_SQLSTATE_CLASSES or sqlstate in POISON_SQLSTATES
+
+
+# opens the async sink connection the first time, and again after a failure closed it
+async def Get_Async_Sink_Conn(dsn):
+    global async_sink_conn
+
+    if async_sink_conn is None or async_sink_conn.closed:
+        async_sink_conn = await psycopg.AsyncConnection.connect(dsn, connect_timeout=5)
+
+    return async_sink_conn
+
+
+async def Close_Async_Sink_Conn():
+    global async_sink_conn
+
+    if async_sink_conn is not None:
+        await async_sink_conn.close()
+        async_sink_conn = None
+
+
+''' async version of Apply_Postgres (sink_mode=async). same rows and sql, but it runs on the event loop
+- keeps 1 connection open instead of connecting per batch
+- pipeline mode sends all the inserts without waiting for each reply, so a batch is a few network round trips
+- the whole batch is bounded by sink_timeout_seconds. on a timeout, cancel or any error the connection is closed,
+  which makes the sink roll back the transaction, and the next batch reconnects. Process_Batch does the retrying
+'''
+@Profiled("Apply_Postgres_Async")
+async def Apply_Postgres_Async(dsn, data, app_config):
+    insert_sql = Get_Insert_Sql(app_config)
+    inserts = Stored_Events(data, app_config)
+
+    try:
+        async with asyncio.timeout(app_config.sink_timeout_seconds):
+            cx = await Get_Async_Sink_Conn(dsn)
+            async with cx.cursor() as cur:
+                if app_config.sink_schema_mode == "partitioned":
+                    if await Ensure_Partitions_Async(cur, app_config, inserts):
+                        await cx.commit()
+
+                schema_ids = None
+                if app_config.payload_mode == "registry":
+                    if await Register_Schemas_Async(cur, inserts):
+                        await cx.commit()
+                    schema_ids = Batch_Schema_Ids(inserts)
+
+                if app_config.latest_state:
+                    if await Ensure_State_Tables_Async(cur, inserts):
+                        await cx.commit()
+
+                if app_config.sink_durability == "fenced":
+                    await cur.execute(Set_Relaxed_Commit_Sql())
+                rows = [Build_Cdc_Row(event, app_config, schema_ids) for event in inserts]
+                async with cx.pipeline():
+                    await cur.executemany(insert_sql, rows)
+                    if app_config.latest_state:
+                        await Upsert_State_Async(cur, inserts)
+                await cx.commit()
+
+    except BaseException as e:
+        # BaseException so a cancelled task also drops its half finished transaction
+        Reset_Sink_Caches()
+        await Close_Async_Sink_Conn()
+        if not isinstance(e, asyncio.CancelledError):
+            print(f"ERROR: Apply_Postgres_Async failed: {e!r}")
+        raise
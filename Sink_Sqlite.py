@@ -0,0 +1,138 @@
+import asyncio
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from Offsets import Lsn_To_Int
+from Sql_Commands import (Create_LSN_Offset_Table, Set_Last_Applied_Lsn_Sql, Create_Sqlite_Cdc_Events_Table,
+                          Create_Sqlite_Cdc_Events_Lsn_Index, Insert_Into_Sqlite_Cdc_Events)
+
+
+'''
+embedded local sink (sink_type=sqlite in app.env). for edge nodes that just need a local, queryable copy of the change
+stream, no server involved
+
+the database (sqlite_path) holds cdc_events and the Lsn_Offsets table, Main reads the resume lsn from it instead of
+offsets_path. so the batch and the lsn that covers it commit in the same sqlite transaction, there's no window where
+one is saved and the other isn't
+
+per batch
+- Apply opens the transaction if there isn't one, and writes the batch with 1 executemany inside a savepoint. if it
+  fails only that savepoint is rolled back, so a retry or a bisect half starts clean
+- Batch_Committed(lsn) is called where the lsn would normally be saved. it upserts the Lsn_Offsets row and commits,
+  in a worker thread like Apply (with synchronous=full the commit is an fsync), 1 commit at a time so the lsn's are
+  saved in order. lsn's that come in while a commit is running go out together in the next one. chunks of a staged
+  transaction have no lsn to save yet, they stay in the open transaction until its last chunk commits it
+- a batch that's applied while its lsn's commit is still waiting goes into that commit too. it's replayed after a
+  crash, the insert is an upsert so that's harmless
+- a failed commit is raised by the next Batch_Committed (or Close), so the apply loop halts instead of moving on
+
+settings
+- journal_mode=WAL so readers don't block the writer (or the other way round), and commits are appends to the -wal file
+- synchronous (sqlite_synchronous, normal by default). in WAL mode 'normal' only fsyncs on checkpoints, a power cut can
+  lose the last few commits but never corrupts the file, and the lost lsn's go with them so they're replayed.
+  'full' fsyncs every commit
+- a 64MB page cache and temp tables in memory
+
+cdc_events keeps every change kind (insert, update, delete) with the payload as json text, ex)
+    SELECT json_extract(payload, '$.columnvalues') FROM cdc_events WHERE table_fqn = 'public.orders' ORDER BY commit_lsn_int
+'''
+
+BUSY_TIMEOUT_MS = 5000
+CACHE_KB = 65536
+
+
+# 1 event -> the insert parameters
+def Sqlite_Row(event):
+    pk = event["pk"] if isinstance(event["pk"], str) else json.dumps(event["pk"])
+    payload = json.dumps(event["payload_json"], separators=(",", ":"), default=str)
+    return (event["table"], pk, event["commit_lsn"], Lsn_To_Int(event["commit_lsn"]), event.get("commit_time"),
+            event["type"], payload)
+
+
+class Sqlite_Sink:
+    def __init__(self, path, synchronous, slot_name):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.slot_name = slot_name
+        self.lock = threading.Lock() # Apply and the lsn commits run in worker threads
+        self.pending = {}            # slots -> (newest lsn waiting for a commit, on_committed)
+        self.committing = None       # the commit task in flight
+        self.error = None            # a commit that failed, raised on the next call
+
+        # isolation_level=None, transactions are opened/committed here instead of by the sqlite3 module
+        self.cx = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.cx.execute("PRAGMA journal_mode=WAL")
+        self.cx.execute(f"PRAGMA synchronous={synchronous.upper()}")
+        self.cx.execute("PRAGMA temp_store=MEMORY")
+        self.cx.execute(f"PRAGMA cache_size=-{CACHE_KB}")
+        self.cx.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+
+        self.cx.execute(Create_Sqlite_Cdc_Events_Table())
+        self.cx.execute(Create_Sqlite_Cdc_Events_Lsn_Index())
+        self.cx.execute(Create_LSN_Offset_Table())
+        self.insert_sql = Insert_Into_Sqlite_Cdc_Events()
+
+    # writes 1 batch into the open transaction. called from a worker thread (asyncio.to_thread)
+    def Apply(self, events):
+        rows = [Sqlite_Row(event) for event in events]
+
+        with self.lock:
+            if not self.cx.in_transaction:
+                self.cx.execute("BEGIN")
+
+            self.cx.execute("SAVEPOINT batch")
+            try:
+                self.cx.executemany(self.insert_sql, rows)
+            except Exception:
+                self.cx.execute("ROLLBACK TO batch")
+                self.cx.execute("RELEASE batch")
+                raise
+            self.cx.execute("RELEASE batch")
+
+    # saves the lsn with the batches written since the last commit, on the event loop. the commit runs in the background
+    # slots: the slots the lsn is saved for (ordered decode shards save several), slot_name if it's not passed
+    # on_committed(lsn): called once it's committed
+    def Batch_Committed(self, lsn, slots=None, on_committed=None):
+        if self.error is not None:
+            raise self.error
+
+        self.pending[tuple(slots or [self.slot_name])] = (lsn, on_committed)
+        if self.committing is None:
+            self.committing = asyncio.get_running_loop().create_task(self.Commit_Pending())
+
+    async def Commit_Pending(self):
+        try:
+            while self.pending:
+                pending, self.pending = self.pending, {}
+                await asyncio.to_thread(self.Commit, [(slot, lsn) for slots, (lsn, _) in pending.items() for slot in slots])
+                for lsn, on_committed in pending.values():
+                    if on_committed is not None:
+                        on_committed(lsn)
+        except Exception as e:
+            print(f"ERROR: sqlite sink commit failed: {e}")
+            self.error = e
+        finally:
+            self.committing = None
+
+    # runs in a worker thread
+    def Commit(self, rows):
+        with self.lock:
+            if not self.cx.in_transaction:
+                self.cx.execute("BEGIN")
+
+            self.cx.executemany(Set_Last_Applied_Lsn_Sql(), rows)
+            self.cx.execute("COMMIT")
+
+    # waits for the commit in flight. anything still open after it never had its lsn saved, it's replayed next time
+    async def Close(self):
+        if self.committing is not None:
+            await self.committing
+        await asyncio.to_thread(self.Close_Conn)
+        if self.error is not None:
+            raise self.error
+
+    def Close_Conn(self):
+        with self.lock:
+            if self.cx.in_transaction:
+                self.cx.execute("ROLLBACK")
+            self.cx.close()
@@ -0,0 +1,153 @@
+import asyncio
+import collections
+import json
+import re
+from dataclasses import dataclass, field
+from typing import List
+from Offsets import Lsn_To_Int
+
+
+'''
+table sharded decoding (shards_config_path in app.env). splits 1 database's tables into groups, each with its own
+replication slot, pg_recvlogical and apply loop, all running at the same time
+
+logical decoding of 1 slot is 1 backend on the primary. on a busy database that backend (wal2json turning every change
+into json) is the bottleneck, not python. with K shards there are K walsenders, and each one's wal2json only formats
+the changes of its own tables (add-tables), so the formatting work is split across K cores. each walsender still reads
+the whole wal, that part isn't split
+- shard slots are named <slot_name>_<shard name> and created at startup like the main slot
+- the shard with "*" gets every table no other shard lists (filter-tables), if nothing has "*" the last shard does.
+  so every table belongs to exactly 1 shard. patterns use wal2json's syntax ("public.orders", "public.*", "*.audit")
+  and overlapping patterns aren't checked
+- each shard saves its own lsn in Lsn_Offsets under its slot name, and restarts/dedups from it
+- wal2json reads table filters from its own options, not from publications. publication_name is still the 1 FOR ALL
+  TABLES publication the standby subscribes to, shards don't touch it
+
+ordered=false (default): K independent apply loops. changes to 1 table always come in commit order (1 table = 1 shard),
+but 2 tables in different shards can reach the sink in any order, and a transaction touching both is applied in parts
+
+ordered=true: the K streams are merged back into 1 in commit lsn order (Merge_By_Commit_Lsn) and go through 1 apply
+loop, for sinks that need a global order. the pieces of a transaction from different shards are put back together, and
+every shard slot saves the same lsn. wal2json v1 sends every transaction (with an empty change list when none of its
+tables changed), so each stream moves forward with the database and the merge doesn't wait long on a quiet shard.
+a shard that's restarting holds the merge up. needs source_format=v1 and a payload_mode other than passthrough
+
+changing the grouping of a running pipeline: a table that moves to another shard picks up from that shard's saved lsn.
+if it's ahead of the old shard's, the table's changes in between are skipped, so stop with both slots drained first
+
+shards file (json)
+{
+    "ordered": false,
+    "shards": [
+        {"name": "orders", "tables": ["public.orders", "public.order_items"]},
+        {"name": "events", "tables": ["public.events"]},
+        {"name": "rest", "tables": ["*"]}
+    ]
+}
+'''
+
+SLOT_NAME = re.compile(r"^[a-z0-9_]{1,63}$") # what pg allows in a replication slot name
+
+
+@dataclass
+class Shard:
+    name: str
+    slot: str
+    add_tables: List[str] = field(default_factory=list)    # wal2json add-tables, empty for the catch all shard
+    filter_tables: List[str] = field(default_factory=list) # the catch all shard skips every other shard's tables
+
+
+# returns ([Shard], ordered)
+def Load_Shards_Config(path, slot_name):
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    entries = config.get("shards", [])
+    if len(entries) < 2:
+        raise Exception(f"{path} needs at least 2 shards")
+
+    catch_all = [entry for entry in entries if "*" in entry.get("tables", [])]
+    if len(catch_all) > 1:
+        raise Exception(f"{path}: only 1 shard can have \"*\"")
+    default = catch_all[0] if catch_all else entries[-1]
+
+    shards = []
+    listed = set()
+    for entry in entries:
+        slot = f"{slot_name}_{entry['name']}"
+        if not SLOT_NAME.match(slot):
+            raise Exception(f"{path}: slot name {slot} can only have lower case letters, digits and _ (max 63)")
+        if entry is default:
+            continue
+
+        tables = entry.get("tables", [])
+        if not tables:
+            raise Exception(f"{path}: shard {entry['name']} doesn't list any tables")
+        repeated = listed.intersection(tables)
+        if repeated:
+            raise Exception(f"{path}: {sorted(repeated)} are in more than 1 shard")
+        listed.update(tables)
+        shards.append(Shard(entry["name"], slot, add_tables=list(tables)))
+
+    # same position as in the file, the order doesn't matter for anything else
+    shards.insert(entries.index(default), Shard(default["name"], f"{slot_name}_{default['name']}",
+                                                filter_tables=sorted(listed)))
+
+    return shards, bool(config.get("ordered", False))
+
+
+# the pieces of 1 transaction from different shards, as 1 v1 transaction
+def Merge_Transaction(objs):
+    if len(objs) == 1:
+        return objs[0]
+
+    return dict(objs[0], change=[change for obj in objs for change in obj.get("change", [])])
+
+
+''' merges the shard sources into 1 source in commit lsn order (ordered=true)
+each shard's stream is already in commit order, so the smallest lsn at the front of all the streams is safe to hand
+over once every stream has something waiting: nothing smaller can come from any of them later. equal lsn's are the
+same transaction, their changes are joined
+- only shards with nothing waiting are read from, so a shard that's far ahead doesn't pile up in memory
+- yields lists of (lsn, obj) like the sources. ends when any shard's source ends (the supervised sources only end when
+  they're stopping or gave up)
+'''
+async def Merge_By_Commit_Lsn(sources):
+    iterators = [source.__aiter__() for source in sources]
+    waiting = [collections.deque() for _ in sources] # (lsn as int, lsn, obj) per shard
+    reads = [None] * len(sources)
+
+    try:
+        while True:
+            for i, queue in enumerate(waiting):
+                if not queue and reads[i] is None:
+                    reads[i] = asyncio.ensure_future(iterators[i].__anext__())
+
+            await asyncio.wait([read for read in reads if read is not None], return_when=asyncio.FIRST_COMPLETED)
+
+            for i, read in enumerate(reads):
+                if read is None or not read.done():
+                    continue
+                reads[i] = None
+                try:
+                    records = read.result()
+                except StopAsyncIteration:
+                    return
+                waiting[i].extend((Lsn_To_Int(lsn), lsn, obj) for lsn, obj in records)
+
+            merged = []
+            while all(waiting):
+                low = min(queue[0][0] for queue in waiting)
+                parts = [queue.popleft() for queue in waiting if queue[0][0] == low]
+                merged.append((parts[0][1], Merge_Transaction([obj for _, _, obj in parts])))
+
+            if merged:
+                yield merged
+
+    finally:
+        pending = [read for read in reads if read is not None]
+        for read in pending:
+            read.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for iterator in iterators:
+            await iterator.aclose()
@@ -1,8 +1,11 @@
 import asyncio
+import collections
 import json
 import os
-from typing import AsyncIterator, Dict, Any, Tuple, Optional
+from typing import AsyncIterator, Dict, Any, List, Tuple, Optional
 import psycopg
+from Txn_Staging import Txn_Assembler
+from Wal2Json_Scanner import Scan_Transaction
 
 '''
 This is the logical replication source aka the WAL reader. it connects to pg and streams change events
@@ -16,6 +19,46 @@ Main.py calls Wal2Json_Via_Pg_Recvlogical() to get an async iterator of WAL even
 data flow of this file
 pg -> WAL -> logical decoding plugin -> pg_recvlogical -> stdout JSON -> Python yields event
 '''
+READ_BYTES = 1024 * 1024                  # bytes asked of the pipe per read
+MAX_RECORD_BYTES = 1024 * 1024 * 1024     # longest pg_recvlogical output line we'll hold
+
+
+''' frames pg_recvlogical's newline delimited output in bulk
+"async for raw in proc.stdout" is 1 readline (and 1 await) per line, and readline gives up on lines longer than the
+stream's limit. here the pipe is read read_bytes at a time and every complete line in the chunk is split out in 1 go
+- yields List[bytes], the complete lines of 1 read (blank lines dropped)
+- a line that's cut off at the end of a read waits in 1 bytearray that's reused for the whole stream, so a big v1
+  transaction is appended to as it arrives instead of being copied again on every read
+- max_record_bytes guards against a runaway line, the stream fails instead of eating all the memory
+'''
+async def Read_Records(stream, read_bytes=READ_BYTES, max_record_bytes=MAX_RECORD_BYTES):
+    partial = bytearray() # start of a line that hasn't ended yet
+
+    while True:
+        chunk = await stream.read(read_bytes)
+        if not chunk:
+            break
+
+        lines = chunk.split(b"\n")
+        if len(lines) == 1: # no line ends in this read
+            partial += chunk
+            if len(partial) > max_record_bytes:
+                raise Exception(f"pg_recvlogical output line is over {max_record_bytes} bytes (max_record_mb in app.env)")
+            continue
+
+        if partial:
+            partial += lines[0]
+            lines[0] = bytes(partial)
+            partial.clear()
+        partial += lines.pop()
+
+        records = [line for line in lines if line and not line.isspace()]
+        if records:
+            yield records
+
+    if partial and not partial.isspace():
+        yield [bytes(partial)] # pg_recvlogical exited without a last newline
+
 
 # asks pg for its current WAL position 
 # use with this the last_applied_lsn to figure out where I should move to
@@ -103,17 +146,36 @@ def Check_Subscription(standby_dsn, primary_config, app_config):
 ''' 
 - decoder: launch a subprocess using pg_recvlogical to stream transformed WAL output that's readable
 - the messages are produced by wal2json over pg_recvlogical
-- this is a asynchronous generator that yields (lsn, event_json) pairs
+- this is a asynchronous generator that yields lists of (lsn, event_json) pairs
 - since args is a command line command, this is basically running a subprocess that does a command line prompt 
   to get wal data continuously. it's called in the main data loop
 
 - how the generator fits into the whole system. the generator gets a continuous wal data stream, when it gets data it
-  yields (lsn, data) which returns and is batched. when the batch reaches it's max size it's processed, sent to the 
+  yields [(lsn, data), ...] which returns and is batched. when the batch reaches it's max size it's processed, sent to the 
   sink, and the lsn is saved (if it worked), then it returns to the yield here and continues the loop
 
+- when the generator is closed or cancelled early (graceful shutdown) pg_recvlogical is terminated, and killed if it's
+  still running after shutdown_deadline_seconds
+- exit_info is an optional dict. when the stream ends it gets "returncode" and "stderr" (the last stderr lines) so
+  Source_Supervisor.py can tell why pg_recvlogical stopped
+- source_format 'v2' asks wal2json for 1 line per change and rebuilds the transactions with Txn_Staging.py, which
+  stages big ones on disk and yields them in chunks (chunks before the last one have lsn None). 'v1' is 1 line per
+  transaction
+- passthrough (v1 only) skips json.loads, Wal2Json_Scanner.py cuts the line into raw change strings instead
+- output is read in bulk by Read_Records, and everything 1 read completes is yielded together as a list, so the apply
+  loop pays 1 await per read instead of 1 per transaction. chunks of a staged v2 transaction are the exception, each
+  goes out in its own list as soon as it's read back. the apply loop flushes on every chunk and the lanes count
+  queued changes, so only about 1 chunk of a staged transaction is held at a time
+- add_tables / filter_tables are lists of wal2json table patterns ("public.orders", "public.*"). decode shards use them
+  so each slot only formats its own tables
+
 paras: dsn_params: Dict[str, Any] | start_lsn: Optional[str]
-returns: AsyncIterator[Tuple[str, Dict[str, Any]]] '''
-async def Wal2Json_Via_Pg_Recvlogical(dsn_params, slot, publication, start_lsn, status_interval_seconds):
+returns: AsyncIterator[List[Tuple[str, Dict[str, Any]]]] '''
+async def Wal2Json_Via_Pg_Recvlogical(dsn_params, slot, publication, start_lsn, status_interval_seconds,
+                                      shutdown_deadline_seconds=10.0, exit_info=None, source_format="v1",
+                                      staging_dir="txn_staging", spill_rows=10000, chunk_rows=5000, passthrough=False,
+                                      include_pk=False, read_bytes=READ_BYTES, max_record_bytes=MAX_RECORD_BYTES,
+                                      add_tables=None, filter_tables=None):
     # args is a command line command that's done in a subprocess
     args = [
         "pg_recvlogical",
@@ -135,6 +197,19 @@ async def Wal2Json_Via_Pg_Recvlogical(dsn_params, slot, publication, start_lsn,
         "--status-interval", str(int(status_interval_seconds)),
     ]
 
+    if source_format == "v2":
+        args += ["-o", "format-version=2"]
+
+    # primary key column names on every change, so a row's inserts/updates/deletes share 1 key (State_Store.py)
+    if include_pk:
+        args += ["-o", "include-pk=1"]
+
+    # decode shards (Slot_Shards.py). wal2json only formats the changes of these tables (or skips these ones)
+    if add_tables:
+        args += ["-o", "add-tables=" + ",".join(add_tables)]
+    if filter_tables:
+        args += ["-o", "filter-tables=" + ",".join(filter_tables)]
+
     if start_lsn:
         args += ["--startpos", start_lsn]
     
@@ -149,11 +224,13 @@ async def Wal2Json_Via_Pg_Recvlogical(dsn_params, slot, publication, start_lsn,
     env = os.environ.copy()
     env["PGPASSWORD"] = dsn_params["password"]
     
+    # stdout is read in chunks by Read_Records, so limit is only how much the pipe buffers before it pauses
     proc = await asyncio.create_subprocess_exec(
         *args,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
-        env=env
+        env=env,
+        limit=read_bytes
     )
 
     # make sure proc exists. assert will make the code fail very noticably
@@ -161,38 +238,76 @@ async def Wal2Json_Via_Pg_Recvlogical(dsn_params, slot, publication, start_lsn,
     assert proc.stderr is not None
     
     # Read stderr in a separate task to see errors
+    recent_stderr = collections.deque(maxlen=20)
     async def log_stderr():
         async for line in proc.stderr:
             error_msg = line.decode("utf-8").strip()
             if error_msg:
+                recent_stderr.append(error_msg)
                 print(f"pg_recvlogical STDERR: {error_msg}")
     
     stderr_task = asyncio.create_task(log_stderr())
+    assembler = Txn_Assembler(staging_dir, spill_rows, chunk_rows) if source_format == "v2" else None
     
-    # "async for" does await internally. the slow parts is waiting for the data to arrive from pg from the subprocess
-    async for raw in proc.stdout:
-        line = raw.decode("utf-8").strip()
-        if not line:
-            continue
+    try:
+        # "async for" does await internally. the slow parts is waiting for the data to arrive from pg from the subprocess
+        async for lines in Read_Records(proc.stdout, read_bytes, max_record_bytes):
+            records = [] # List[Tuple[str, Dict[str, Any]]]
+            for raw in lines:
+                if passthrough:
+                    scanned = Scan_Transaction(raw.decode("utf-8").strip())
+                    if scanned is not None:
+                        records.append(scanned)
+                    continue
+                try:
+                    obj = json.loads(raw) # json takes the utf-8 bytes as they are
+                except json.JSONDecodeError:
+                    continue
+
+                if assembler is not None:
+                    # a staged transaction's chunks are handed over 1 at a time as they're read back, the apply loop
+                    # sends each one before taking the next
+                    for lsn, txn in assembler.Feed(obj):
+                        records.append((lsn, txn))
+                        if "change_offset" in txn:
+                            yield records
+                            records = []
+                    continue
+
+                # wal2json emits objects with an array of changes and metadata including lsn
+                lsn = obj.get("lsn") or obj.get("nextlsn") or obj.get("last_lsn")
+                if not lsn:
+                    # if missing per-chunk lsn, you can emit the commit lsn after collecting
+                    lsn = obj.get("commit_lsn") or obj.get("xid")  # fallback, not preferred
+
+                records.append((lsn, obj))
+
+            if records:
+                yield records
+
+    finally:
+        # wait for subprocess to finish
+        # this'll wait for the subprocess to finish which means 1) when I close the program, 
+        # 2) the wal stream ends, 3) it gets an error
+        # if we're the ones stopping early, ask pg_recvlogical to exit first (it sends its final status to pg on SIGTERM)
+        if proc.returncode is None and not proc.stdout.at_eof():
+            proc.terminate()
         try:
-            obj = json.loads(line)
-        except json.JSONDecodeError:
-            continue
+            await asyncio.wait_for(proc.wait(), timeout=shutdown_deadline_seconds)
+        except asyncio.TimeoutError:
+            print("pg_recvlogical didn't exit in time, killing it")
+            proc.kill()
+            await proc.wait()
 
-        # wal2json emits objects with an array of changes and metadata including lsn
-        lsn = obj.get("lsn") or obj.get("nextlsn") or obj.get("last_lsn")
-        if not lsn:
-            # if missing per-chunk lsn, you can emit the commit lsn after collecting
-            lsn = obj.get("commit_lsn") or obj.get("xid")  # fallback, not preferred
+        # give stderr a moment to hand over the last lines, they usually say why it stopped
+        try:
+            await asyncio.wait_for(stderr_task, timeout=1.0)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
 
-        yield lsn, obj
+        if assembler is not None:
+            assembler.Discard() # a half read transaction comes again after a restart
 
-    # Cancel stderr task and wait for subprocess to finish
-    # this'll wait for the subprocess to finish which means 1) when I close the program, 
-    # 2) the wal stream ends, 3) it gets an error
-    stderr_task.cancel()
-    try:
-        await stderr_task
-    except asyncio.CancelledError:
-        pass
-    await proc.wait() 
+        if exit_info is not None:
+            exit_info["returncode"] = proc.returncode
+            exit_info["stderr"] = list(recent_stderr)
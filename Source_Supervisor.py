@@ -0,0 +1,125 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+
+'''
+keeps the wal source running (source_restart=true in app.env)
+
+without this, when pg_recvlogical exits (network blip, primary restart, replication error) the source generator just
+ends, Run_Apply_Loop thinks the wal is finished and the program stops. Supervised_Source wraps the source so the apply
+loop sees 1 endless stream:
+- when the stream ends it looks at pg_recvlogical's exit code and last stderr lines to work out why
+- auth failures and a missing slot won't fix themselves, those are raised. everything else is restarted
+- restarts wait a jittered exponential backoff (random between 0 and base * 2^attempt, capped) so a fleet of readers
+  doesn't hammer a primary that just came back. the backoff resets once data flows again
+- the new stream starts right after the last transaction this stream handed to the apply loop. those transactions
+  are still in the apply loop's buffer, so nothing is skipped. if nothing was read yet it uses get_resume_lsn()
+  (the last saved lsn)
+- the sink connections and the apply loop are never touched
+
+restart counts, downtime and reasons are kept in a Source_Stats
+'''
+
+# reasons that a restart can't fix
+FATAL_REASONS = {"auth", "slot_missing"}
+
+# (reason, text to look for in pg_recvlogical's stderr), first match wins
+STDERR_REASONS = [
+    ("auth", "password authentication failed"),
+    ("auth", "no pg_hba.conf entry"),
+    ("slot_missing", "does not exist"),
+    ("slot_busy", "is active for pid"),
+    ("server_restart", "terminating connection due to administrator command"),
+    ("server_restart", "the database system is shutting down"),
+    ("server_restart", "the database system is starting up"),
+    ("server_restart", "the database system is in recovery mode"),
+    ("network", "could not connect"),
+    ("network", "connection refused"),
+    ("network", "server closed the connection unexpectedly"),
+    ("network", "could not receive data"),
+    ("network", "connection reset"),
+    ("network", "timeout"),
+    ("replication_error", "unexpected termination of replication stream"),
+    ("replication_error", "could not send"),
+]
+
+
+@dataclass
+class Source_Stats:
+    restarts: int = 0
+    downtime_seconds: float = 0.0               # time between a stream ending and its replacement being started
+    last_reason: Optional[str] = None
+    last_exit_code: Optional[int] = None
+    reasons: Dict[str, int] = field(default_factory=dict)
+
+
+# exit_info: the dict Wal2Json_Via_Pg_Recvlogical fills in. returns a reason from STDERR_REASONS, or
+# 'ended' (clean exit, nothing on stderr) or 'unknown'
+def Classify_Exit(exit_info):
+    text = "\n".join(exit_info.get("stderr", [])).lower()
+    for reason, needle in STDERR_REASONS:
+        if needle in text:
+            return reason
+
+    if exit_info.get("returncode") == 0 and not text:
+        return "ended"
+
+    return "unknown"
+
+
+''' async generator that yields the same lists of (lsn, obj) pairs as the source it wraps
+paras: make_source(start_lsn, exit_info) -> a new source generator | get_resume_lsn() -> last saved lsn or None
+       stop_event: once it's set a finished stream isn't restarted
+'''
+async def Supervised_Source(make_source, get_resume_lsn, stats, max_restarts=0, backoff_seconds=1.0,
+                            backoff_max_seconds=60.0, stop_event=None):
+    last_lsn = None     # lsn of the last transaction we yielded
+    attempt = 0         # restarts since data last flowed
+    source = None
+
+    try:
+        while True:
+            exit_info = {}
+            start_lsn = last_lsn or get_resume_lsn()
+            source = make_source(start_lsn, exit_info)
+
+            async for records in source:
+                attempt = 0
+                for lsn, _ in records:
+                    if lsn:
+                        last_lsn = lsn
+                yield records
+
+            source = None
+            down_since = time.monotonic()
+            reason = Classify_Exit(exit_info)
+            stats.last_reason = reason
+            stats.last_exit_code = exit_info.get("returncode")
+            stats.reasons[reason] = stats.reasons.get(reason, 0) + 1
+
+            if stop_event is not None and stop_event.is_set():
+                return
+
+            if reason in FATAL_REASONS:
+                raise Exception(f"pg_recvlogical stopped ({reason}), restarting won't fix this: {exit_info.get('stderr')}")
+
+            if max_restarts and stats.restarts >= max_restarts:
+                raise Exception(f"pg_recvlogical stopped ({reason}) and the restart limit ({max_restarts}) was reached")
+
+            delay = random.uniform(0, min(backoff_max_seconds, backoff_seconds * 2 ** attempt))
+            attempt += 1
+            print(f"WAL source stopped ({reason}, exit code {stats.last_exit_code}). "
+                  f"Restarting from {last_lsn or 'the last saved lsn'} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+            stats.restarts += 1
+            stats.downtime_seconds += time.monotonic() - down_since
+            print(f"WAL source restart #{stats.restarts}, total downtime {stats.downtime_seconds:.1f}s")
+
+    finally:
+        # closed early (shutdown) while a stream is open, let it stop its subprocess
+        if source is not None:
+            await source.aclose()
@@ -42,7 +42,7 @@ def Get_Last_Applied_Lsn_Sql():
     return f"SELECT last_applied_lsn FROM {lsn_offset_table} WHERE slot_name = ?"
 
 
-def Set_Last_Applied_Lsn():
+def Set_Last_Applied_Lsn_Sql():
     return f"""
             INSERT INTO {lsn_offset_table}(slot_name, last_applied_lsn)
             VALUES(?, ?)
@@ -50,6 +50,35 @@ def Set_Last_Applied_Lsn():
             """
 
 
+# sink_type=sqlite (Sink_Sqlite.py). every change kind is kept, commit_lsn_int sorts where the text lsn doesn't
+def Create_Sqlite_Cdc_Events_Table():
+    return """
+            CREATE TABLE IF NOT EXISTS cdc_events (
+                table_fqn TEXT NOT NULL,
+                pk TEXT NOT NULL,
+                commit_lsn TEXT NOT NULL,
+                commit_lsn_int INTEGER NOT NULL,
+                commit_time TEXT,
+                kind TEXT NOT NULL,
+                payload TEXT,
+                PRIMARY KEY (table_fqn, pk, commit_lsn))
+           """
+
+
+def Create_Sqlite_Cdc_Events_Lsn_Index():
+    return "CREATE INDEX IF NOT EXISTS cdc_events_commit_lsn_int ON cdc_events (commit_lsn_int)"
+
+
+# a row changed twice in 1 transaction keeps its last change, replays overwrite with the same values
+def Insert_Into_Sqlite_Cdc_Events():
+    return """
+            INSERT INTO cdc_events(table_fqn, pk, commit_lsn, commit_lsn_int, commit_time, kind, payload)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (table_fqn, pk, commit_lsn) DO UPDATE SET
+                commit_time = excluded.commit_time, kind = excluded.kind, payload = excluded.payload
+            """
+
+
 def Create_Cdv_Events_Table():
     return """
             CREATE TABLE IF NOT EXISTS cdc_events (
@@ -61,16 +90,330 @@ def Create_Cdv_Events_Table():
            """
 
 
-def Insert_Into_Cdc_Events():
-    return """
+# with_schema_id: payload_mode=registry, the payload has its column names/types stripped out
+# keep_last: latest_state=true, a row changed twice in 1 transaction keeps its last change (a staged transaction can
+# reach the sink in several batches), so a point in time lookup sees the row as the transaction left it
+def Insert_Into_Cdc_Events(with_schema_id=False, keep_last=False):
+    if with_schema_id:
+        return f"""
+               INSERT INTO cdc_events(table_fqn, pk, commit_lsn, payload, schema_id)
+               VALUES (%s, %s, %s, %s, %s)
+               ON CONFLICT (table_fqn, pk, commit_lsn) {Cdc_Events_Conflict_Action(with_schema_id, keep_last)}
+               """
+
+    return f"""
            INSERT INTO cdc_events(table_fqn, pk, commit_lsn, payload)
            VALUES (%s, %s, %s, %s)
-           ON CONFLICT (table_fqn, pk, commit_lsn) DO NOTHING
+           ON CONFLICT (table_fqn, pk, commit_lsn) {Cdc_Events_Conflict_Action(with_schema_id, keep_last)}
+           """
+
+
+def Cdc_Events_Conflict_Action(with_schema_id, keep_last):
+    if not keep_last:
+        return "DO NOTHING"
+    if with_schema_id:
+        return "DO UPDATE SET payload = excluded.payload, schema_id = excluded.schema_id"
+
+    return "DO UPDATE SET payload = excluded.payload"
+
+
+# partitioned cdc_events. lsn's are stored as pg_lsn or bigint so they sort and range scan correctly
+# the partition key has to be part of the primary key, so time partitioning adds commit_time to it
+def Create_Partitioned_Cdc_Events_Table(lsn_column_type, partition_by):
+    if partition_by == "time":
+        primary_key = "table_fqn, pk, commit_lsn, commit_time"
+        partition_key = "commit_time"
+    else:
+        primary_key = "table_fqn, pk, commit_lsn"
+        partition_key = "commit_lsn"
+
+    return f"""
+            CREATE TABLE IF NOT EXISTS cdc_events (
+                table_fqn TEXT NOT NULL,
+                pk TEXT NOT NULL,
+                commit_lsn {lsn_column_type.upper()} NOT NULL,
+                commit_time TIMESTAMPTZ NOT NULL,
+                payload JSONB,
+                PRIMARY KEY ({primary_key}))
+            PARTITION BY RANGE ({partition_key});
+           """
+
+
+def Insert_Into_Partitioned_Cdc_Events(partition_by, with_schema_id=False, keep_last=False):
+    conflict_columns = "table_fqn, pk, commit_lsn, commit_time" if partition_by == "time" else "table_fqn, pk, commit_lsn"
+    schema_column = ", schema_id" if with_schema_id else ""
+    schema_value = ", %s" if with_schema_id else ""
+
+    return f"""
+           INSERT INTO cdc_events(table_fqn, pk, commit_lsn, commit_time, payload{schema_column})
+           VALUES (%s, %s, %s, COALESCE(%s::timestamptz, now()), %s{schema_value})
+           ON CONFLICT ({conflict_columns}) {Cdc_Events_Conflict_Action(with_schema_id, keep_last)}
+           """
+
+
+# returns a row if cdc_events exists and is partitioned. used to catch a legacy table in partitioned mode
+def Get_Cdc_Events_Partitioning_Sql():
+    return """
+           SELECT c.relkind
+           FROM pg_class c
+           WHERE c.relname = 'cdc_events' AND c.relnamespace = 'public'::regnamespace
+           """
+
+
+# partition names and bounds are made by Cdc_Partitions.py, not by users, so formatting them in is safe
+def Create_Cdc_Events_Partition(partition_name, lower_bound, upper_bound):
+    return f"""
+           CREATE TABLE IF NOT EXISTS {partition_name}
+           PARTITION OF cdc_events FOR VALUES FROM ({lower_bound}) TO ({upper_bound})
+           """
+
+
+def List_Cdc_Events_Partitions_Sql():
+    return """
+           SELECT child.relname
+           FROM pg_inherits i
+           JOIN pg_class child ON child.oid = i.inhrelid
+           JOIN pg_class parent ON parent.oid = i.inhparent
+           WHERE parent.relname = 'cdc_events'
+           """
+
+
+def Detach_Cdc_Events_Partition(partition_name):
+    return f"ALTER TABLE cdc_events DETACH PARTITION {partition_name}"
+
+
+def Drop_Cdc_Events_Partition(partition_name):
+    return f"DROP TABLE IF EXISTS {partition_name}"
+
+
+# poison events that failure_policy=bisect pulled out of a batch
+def Create_Dead_Letter_Table():
+    return """
+            CREATE TABLE IF NOT EXISTS cdc_dead_letters (
+                id BIGSERIAL PRIMARY KEY,
+                table_fqn TEXT,
+                pk TEXT,
+                commit_lsn TEXT,
+                error TEXT NOT NULL,
+                payload JSONB,
+                failed_at TIMESTAMPTZ NOT NULL DEFAULT now());
+           """
+
+
+def Insert_Into_Dead_Letters():
+    return """
+           INSERT INTO cdc_dead_letters(table_fqn, pk, commit_lsn, error, payload)
+           VALUES (%s, %s, %s, %s, %s)
+           """
+
+
+# schema registry (payload_mode=registry). each distinct column names/types shape of a table is stored once here,
+# cdc_events rows point at it with schema_id instead of repeating the names and types in every payload
+def Create_Cdc_Schemas_Table():
+    return """
+            CREATE TABLE IF NOT EXISTS cdc_schemas (
+                schema_id BIGSERIAL PRIMARY KEY,
+                table_fqn TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                shape_hash TEXT NOT NULL,
+                columnnames JSONB NOT NULL,
+                columntypes JSONB NOT NULL,
+                first_seen TIMESTAMPTZ NOT NULL DEFAULT now(),
+                UNIQUE (table_fqn, shape_hash));
+
+            ALTER TABLE cdc_events ADD COLUMN IF NOT EXISTS schema_id BIGINT;
+           """
+
+
+# version counts up per table, so the 3rd shape public.orders ever had is version 3
+def Register_Cdc_Schema_Sql():
+    return """
+           INSERT INTO cdc_schemas(table_fqn, version, shape_hash, columnnames, columntypes)
+           SELECT %(table)s, COALESCE(MAX(version), 0) + 1, %(hash)s, %(names)s, %(types)s
+           FROM cdc_schemas WHERE table_fqn = %(table)s
+           ON CONFLICT (table_fqn, shape_hash) DO NOTHING
+           """
+
+
+def Get_Cdc_Schema_Id_Sql():
+    return "SELECT schema_id FROM cdc_schemas WHERE table_fqn = %s AND shape_hash = %s"
+
+
+# cdc_events with the full wal2json payload put back together. rows written without a schema_id are unchanged
+def Create_Cdc_Events_Full_View(extra_columns=""):
+    return f"""
+            CREATE OR REPLACE VIEW cdc_events_full AS
+            SELECT e.table_fqn, e.pk, e.commit_lsn{extra_columns}, e.schema_id,
+                   CASE WHEN s.schema_id IS NULL THEN e.payload
+                        ELSE e.payload || jsonb_build_object('columnnames', s.columnnames, 'columntypes', s.columntypes)
+                   END AS payload
+            FROM cdc_events e
+            LEFT JOIN cdc_schemas s ON s.schema_id = e.schema_id;
+           """
+
+
+# consistency checker (Consistency_Checker.py) ---------------
+# key ranges are lower inclusive, upper exclusive, a missing bound is open. (a, b) >= (%s, %s) compares keys as rows
+def Key_Range_Where(key_columns, has_lower, has_upper):
+    keys = ", ".join(key_columns)
+    params = ", ".join(["%s"] * len(key_columns))
+    conditions = []
+    if has_lower:
+        conditions.append(f"({keys}) >= ({params})")
+    if has_upper:
+        conditions.append(f"({keys}) < ({params})")
+
+    return " AND ".join(conditions) or "TRUE"
+
+
+# the table's primary key columns in key order
+def Get_Primary_Key_Columns_Sql():
+    return """
+           SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+           FROM pg_index i
+           JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+           WHERE i.indrelid = %s::regclass AND i.indisprimary
+           ORDER BY array_position(i.indkey, a.attnum)
+           """
+
+
+# rows and an order independent hash of them (sum of the first 64 bits of each row's md5) for 1 key range
+def Key_Range_Hash_Sql(table, key_columns, has_lower, has_upper):
+    return f"""
+            SELECT count(*), COALESCE(sum(('x' || left(md5(t::text), 16))::bit(64)::bigint), 0)::text
+            FROM {table} AS t
+            WHERE {Key_Range_Where(key_columns, has_lower, has_upper)}
            """
 
 
+# every row's key and md5 in 1 key range, for ranges small enough to compare row by row
+def Key_Range_Row_Hashes_Sql(table, key_columns, has_lower, has_upper):
+    return f"""
+            SELECT {", ".join(key_columns)}, md5(t::text)
+            FROM {table} AS t
+            WHERE {Key_Range_Where(key_columns, has_lower, has_upper)}
+           """
+
+
+def Integer_Key_Bounds_Sql(table, key_column):
+    return f"SELECT min({key_column}), max({key_column}) FROM {table}"
+
+
+# a few % of the table's pages, only used to pick range bounds for keys that aren't integers
+def Sample_Keys_Sql(table, key_columns):
+    keys = ", ".join(key_columns)
+    return f"SELECT {keys} FROM {table} TABLESAMPLE SYSTEM (%s) ORDER BY {keys}"
+
+
+# the key n rows into a range, used to split a range whose keys aren't integers
+def Key_At_Offset_Sql(table, key_columns, has_lower, has_upper):
+    keys = ", ".join(key_columns)
+    return f"""
+            SELECT {keys}
+            FROM {table}
+            WHERE {Key_Range_Where(key_columns, has_lower, has_upper)}
+            ORDER BY {keys}
+            OFFSET %s LIMIT 1
+           """
+
+
+# key + md5 of 1 row, used to recheck reported differences
+def Key_Row_Hash_Sql(table, key_columns):
+    return f"""
+            SELECT {", ".join(key_columns)}, md5(t::text)
+            FROM {table} AS t
+            WHERE ({", ".join(key_columns)}) = ({", ".join(["%s"] * len(key_columns))})
+           """
+
+
+# heartbeat (Heartbeat.py) ---------------
+def Create_Heartbeat_Table_Sql():
+    return """
+            CREATE TABLE IF NOT EXISTS public.cdc_heartbeat (
+                id INTEGER PRIMARY KEY,
+                beat_at TIMESTAMPTZ NOT NULL
+            )
+           """
+
+
+def Touch_Heartbeat_Sql():
+    return """
+            INSERT INTO public.cdc_heartbeat(id, beat_at) VALUES (1, now())
+            ON CONFLICT (id) DO UPDATE SET beat_at = excluded.beat_at
+           """
+
+
+# transactional so it comes through with a commit and an lsn like any other transaction
+def Emit_Heartbeat_Message_Sql():
+    return "SELECT pg_logical_emit_message(true, %s, now()::text)"
+
+
+# latest state (State_Store.py) ---------------
+# 1 table per source table. state table names are made by State_Store.py ([a-z0-9_] only), formatting them in is safe
+def Create_State_Table(state_table):
+    return f"""
+            CREATE TABLE IF NOT EXISTS {state_table} (
+                pk TEXT PRIMARY KEY,
+                commit_lsn PG_LSN NOT NULL,
+                deleted BOOLEAN NOT NULL DEFAULT false,
+                row JSONB,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now());
+           """
+
+
+# a replayed (older) change never overwrites a newer one. deletes stay as tombstones so a late replay can't revive them
+def Upsert_State_Row(state_table):
+    return f"""
+           INSERT INTO {state_table} AS s (pk, commit_lsn, deleted, row)
+           VALUES (%s, %s::pg_lsn, %s, %s)
+           ON CONFLICT (pk) DO UPDATE
+           SET commit_lsn = excluded.commit_lsn, deleted = excluded.deleted, row = excluded.row, updated_at = now()
+           WHERE s.commit_lsn <= excluded.commit_lsn
+           """
+
+
+def Get_State_Row_Sql(state_table):
+    return f"SELECT commit_lsn::text, deleted, row FROM {state_table} WHERE pk = %s"
+
+
+def List_State_Rows_Sql(state_table):
+    return f"SELECT pk, commit_lsn::text, row FROM {state_table} WHERE NOT deleted ORDER BY pk"
+
+
+# legacy cdc_events keeps lsn's as text, which don't sort. point in time lookups go through this index instead
+def Create_Cdc_Events_History_Index():
+    return "CREATE INDEX IF NOT EXISTS cdc_events_history_idx ON cdc_events (table_fqn, pk, (commit_lsn::pg_lsn))"
+
+
+# source is cdc_events, or cdc_events_full in registry mode. lsn_column/lsn_param come from State_Store.History_Lsn
+def Get_Row_As_Of_Sql(source, lsn_column, lsn_param):
+    return f"""
+           SELECT commit_lsn, payload FROM {source}
+           WHERE table_fqn = %s AND pk = %s AND {lsn_column} <= {lsn_param}
+           ORDER BY {lsn_column} DESC
+           LIMIT 1
+           """
+
+
+def List_Rows_As_Of_Sql(source, lsn_column, lsn_param):
+    return f"""
+           SELECT DISTINCT ON (pk) pk, commit_lsn, payload FROM {source}
+           WHERE table_fqn = %s AND {lsn_column} <= {lsn_param}
+           ORDER BY pk, {lsn_column} DESC
+           """
+
 
+# durability fences (Durability_Fence.py) ---------------
+# sink_durability=fenced. the batch's commit returns without waiting for the sink to flush its wal
+def Set_Relaxed_Commit_Sql():
+    return "SET LOCAL synchronous_commit = off"
 
 
+def Set_Durable_Commit_Sql():
+    return "SET LOCAL synchronous_commit = on"
 
 
+# gives the fence transaction an xid, so its commit writes a commit record and waits for the wal to be flushed up to it.
+# the wal is flushed in order, so that covers every relaxed commit before it
+def Durability_Fence_Sql():
+    return "SELECT txid_current()"
@@ -29,6 +29,62 @@ class App_Config:
     backoff_seconds: float
     status_interval_seconds: float
     offsets_path: str            # ex) "offsets.sqlite"
+    # sink schema. these are optional in app.env
+    sink_schema_mode: str = "legacy"       # 'legacy' (1 table, text lsn) or 'partitioned'
+    lsn_column_type: str = "pg_lsn"        # 'pg_lsn' or 'bigint' (partitioned mode only)
+    partition_by: str = "lsn"              # 'lsn' or 'time'
+    partition_lsn_span_mb: int = 1024      # mb of wal per partition when partition_by=lsn
+    partition_interval_hours: int = 24     # hours per partition when partition_by=time
+    partitions_ahead: int = 2              # future partitions to create before they're needed
+    retention_partitions: int = 0          # partitions to keep. 0 = keep everything
+    retention_action: str = "detach"       # 'detach' or 'drop' expired partitions
+    # adaptive batch sizing (Batch_Controller.py)
+    adaptive_batching: bool = False
+    batch_size_min: int = 10
+    batch_size_max: int = 5000
+    target_batch_latency_ms: float = 500.0
+    sink_mode: str = "async"               # 'async' (psycopg async + pipeline) or 'sync' (thread per batch)
+    sink_timeout_seconds: float = 30.0     # max time for 1 batch in async mode
+    sink_durability: str = "sync"          # 'sync' or 'fenced' (relaxed commits + periodic durable fences, Durability_Fence.py)
+    fence_every_batches: int = 20
+    fence_interval_ms: float = 1000.0
+    failure_policy: str = "halt"           # 'halt' or 'bisect' (find poison events and dead letter them)
+    dead_letter_target: str = "file"       # 'file' or 'table' (cdc_dead_letters on the sink)
+    dead_letter_path: str = "dead_letters.jsonl"
+    payload_mode: str = "full"             # 'full', 'registry' (names/types stored once in cdc_schemas) or 'passthrough'
+    sink_type: str = "postgres"            # 'postgres' (cdc_events), 'parquet' (columnar files) or 'sqlite' (local database)
+    parquet_dir: str = "parquet_out"
+    parquet_max_file_mb: int = 128
+    parquet_max_file_seconds: float = 300.0
+    sqlite_path: str = "cdc_sink.sqlite"   # sink_type=sqlite, also holds the saved lsn
+    sqlite_synchronous: str = "normal"     # 'off', 'normal' or 'full'
+    shutdown_deadline_seconds: float = 10.0 # time allowed to drain and stop pg_recvlogical on ctrl+c/SIGTERM
+    source_restart: bool = True            # restart pg_recvlogical when it exits (Source_Supervisor.py)
+    source_max_restarts: int = 0           # 0 = no limit
+    source_backoff_seconds: float = 1.0
+    source_backoff_max_seconds: float = 60.0
+    dedup_enabled: bool = True             # skip replayed transactions/events before the sink (Dedup_Filter.py)
+    dedup_capacity: int = 100000           # max (table, pk, commit_lsn) keys remembered
+    lanes_config_path: str = ""            # json lane file for Lane_Scheduler.py, blank = 1 fifo buffer
+    source_format: str = "v1"              # wal2json format-version. 'v2' stages big transactions on disk (Txn_Staging.py)
+    staging_dir: str = "txn_staging"
+    large_txn_spill_rows: int = 10000      # changes held in memory before a transaction is staged on disk
+    large_txn_chunk_rows: int = 5000       # changes per chunk when a staged transaction is handed to the apply loop
+    source_read_kb: int = 1024             # pg_recvlogical output read per call (Source_Pg.Read_Records)
+    max_record_mb: int = 1024              # longest output line (1 v1 transaction) the source will hold
+    heartbeat_mode: str = "off"            # 'off', 'table' or 'message' (Heartbeat.py)
+    heartbeat_interval_seconds: float = 10.0
+    rules_config_path: str = ""            # json filter/projection/masking rules (Event_Rules.py), blank = none
+    control_port: int = 0                  # local http control api (Control_Api.py), 0 = off
+    control_host: str = "127.0.0.1"
+    max_events_per_second: float = 0.0     # sink write rate cap, 0 = none. the control api can change it live
+    shards_config_path: str = ""           # json file of table groups decoded by separate slots (Slot_Shards.py), blank = 1 slot
+    latest_state: bool = False             # keep latest state tables + full history for point in time reads (State_Store.py)
+    profiling: bool = False                # start with the profiler on (Profiler.py). SIGUSR1 toggles it
+    profile_dir: str = "profiles"
+    profile_interval_seconds: float = 60.0
+    profile_sample_ms: float = 10.0
+    profile_top_n: int = 25
 
 
 # load database connection info from the .env files
@@ -68,6 +124,15 @@ def Load_Docker_Env_Config(env_file):
         return conn_info
 
 
+# optional app.env setting. returns the default if it's missing or blank
+def Get_Optional_Env(name, default):
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+
+    return value.strip()
+
+
 # load app settings .env files
 def Load_App_Env_Config(env_file, primary_config):
     # Load the specific .env file
@@ -84,13 +149,103 @@ def Load_App_Env_Config(env_file, primary_config):
         max_retries = int(os.getenv("max_retries").strip()),
         backoff_seconds = float(os.getenv("backoff_seconds").strip()),
         status_interval_seconds = float(os.getenv("status_interval_seconds").strip()),
-        offsets_path = os.getenv("offsets_path").strip()
+        offsets_path = os.getenv("offsets_path").strip(),
+        sink_schema_mode = Get_Optional_Env("sink_schema_mode", "legacy").lower(),
+        lsn_column_type = Get_Optional_Env("lsn_column_type", "pg_lsn").lower(),
+        partition_by = Get_Optional_Env("partition_by", "lsn").lower(),
+        partition_lsn_span_mb = int(Get_Optional_Env("partition_lsn_span_mb", "1024")),
+        partition_interval_hours = int(Get_Optional_Env("partition_interval_hours", "24")),
+        partitions_ahead = int(Get_Optional_Env("partitions_ahead", "2")),
+        retention_partitions = int(Get_Optional_Env("retention_partitions", "0")),
+        retention_action = Get_Optional_Env("retention_action", "detach").lower(),
+        adaptive_batching = Get_Optional_Env("adaptive_batching", "false").lower() == "true",
+        batch_size_min = int(Get_Optional_Env("batch_size_min", "10")),
+        batch_size_max = int(Get_Optional_Env("batch_size_max", "5000")),
+        target_batch_latency_ms = float(Get_Optional_Env("target_batch_latency_ms", "500")),
+        sink_mode = Get_Optional_Env("sink_mode", "async").lower(),
+        sink_timeout_seconds = float(Get_Optional_Env("sink_timeout_seconds", "30")),
+        sink_durability = Get_Optional_Env("sink_durability", "sync").lower(),
+        fence_every_batches = int(Get_Optional_Env("fence_every_batches", "20")),
+        fence_interval_ms = float(Get_Optional_Env("fence_interval_ms", "1000")),
+        failure_policy = Get_Optional_Env("failure_policy", "halt").lower(),
+        dead_letter_target = Get_Optional_Env("dead_letter_target", "file").lower(),
+        dead_letter_path = Get_Optional_Env("dead_letter_path", "dead_letters.jsonl"),
+        payload_mode = Get_Optional_Env("payload_mode", "full").lower(),
+        sink_type = Get_Optional_Env("sink_type", "postgres").lower(),
+        parquet_dir = Get_Optional_Env("parquet_dir", "parquet_out"),
+        parquet_max_file_mb = int(Get_Optional_Env("parquet_max_file_mb", "128")),
+        parquet_max_file_seconds = float(Get_Optional_Env("parquet_max_file_seconds", "300")),
+        sqlite_path = Get_Optional_Env("sqlite_path", "cdc_sink.sqlite"),
+        sqlite_synchronous = Get_Optional_Env("sqlite_synchronous", "normal").lower(),
+        shutdown_deadline_seconds = float(Get_Optional_Env("shutdown_deadline_seconds", "10")),
+        source_restart = Get_Optional_Env("source_restart", "true").lower() == "true",
+        source_max_restarts = int(Get_Optional_Env("source_max_restarts", "0")),
+        source_backoff_seconds = float(Get_Optional_Env("source_backoff_seconds", "1")),
+        source_backoff_max_seconds = float(Get_Optional_Env("source_backoff_max_seconds", "60")),
+        dedup_enabled = Get_Optional_Env("dedup_enabled", "true").lower() == "true",
+        dedup_capacity = int(Get_Optional_Env("dedup_capacity", "100000")),
+        lanes_config_path = Get_Optional_Env("lanes_config_path", ""),
+        source_format = Get_Optional_Env("source_format", "v1").lower(),
+        staging_dir = Get_Optional_Env("staging_dir", "txn_staging"),
+        large_txn_spill_rows = int(Get_Optional_Env("large_txn_spill_rows", "10000")),
+        large_txn_chunk_rows = int(Get_Optional_Env("large_txn_chunk_rows", "5000")),
+        source_read_kb = int(Get_Optional_Env("source_read_kb", "1024")),
+        max_record_mb = int(Get_Optional_Env("max_record_mb", "1024")),
+        heartbeat_mode = Get_Optional_Env("heartbeat_mode", "off").lower(),
+        heartbeat_interval_seconds = float(Get_Optional_Env("heartbeat_interval_seconds", "10")),
+        profiling = Get_Optional_Env("profiling", "false").lower() == "true",
+        profile_dir = Get_Optional_Env("profile_dir", "profiles"),
+        profile_interval_seconds = float(Get_Optional_Env("profile_interval_seconds", "60")),
+        profile_sample_ms = float(Get_Optional_Env("profile_sample_ms", "10")),
+        profile_top_n = int(Get_Optional_Env("profile_top_n", "25")),
+        rules_config_path = Get_Optional_Env("rules_config_path", ""),
+        shards_config_path = Get_Optional_Env("shards_config_path", ""),
+        latest_state = Get_Optional_Env("latest_state", "false").lower() == "true",
+        control_port = int(Get_Optional_Env("control_port", "0")),
+        control_host = Get_Optional_Env("control_host", "127.0.0.1"),
+        max_events_per_second = float(Get_Optional_Env("max_events_per_second", "0"))
     )
     if (app_info.start_from_beginning == "false"):
         app_info.start_from_beginning = False
     else:
         app_info.start_from_beginning = True
 
+    if (app_info.sink_schema_mode not in ("legacy", "partitioned") or app_info.lsn_column_type not in ("pg_lsn", "bigint") or
+        app_info.partition_by not in ("lsn", "time") or app_info.retention_action not in ("detach", "drop") or
+        app_info.sink_mode not in ("async", "sync") or app_info.failure_policy not in ("halt", "bisect") or
+        app_info.dead_letter_target not in ("file", "table") or app_info.payload_mode not in ("full", "registry", "passthrough") or
+        app_info.sink_type not in ("postgres", "parquet", "sqlite") or
+        app_info.sqlite_synchronous not in ("off", "normal", "full") or app_info.sink_durability not in ("sync", "fenced") or app_info.source_format not in ("v1", "v2") or
+        app_info.heartbeat_mode not in ("off", "table", "message")):
+        print(f"Error: invalid sink settings in file: {env_file}")
+        sys.exit(1)
+
+    # passthrough never parses the changes, so it only works with 1 transaction per line and the jsonb sink
+    if app_info.payload_mode == "passthrough" and (app_info.source_format != "v1" or app_info.sink_type != "postgres"):
+        print(f"Error: payload_mode=passthrough needs source_format=v1 and sink_type=postgres in file: {env_file}")
+        sys.exit(1)
+
+    # the state tables are built from parsed changes in the cdc_events transaction
+    if app_info.latest_state and (app_info.sink_type != "postgres" or app_info.payload_mode == "passthrough"):
+        print(f"Error: latest_state=true needs sink_type=postgres and a payload_mode other than passthrough in file: {env_file}")
+        sys.exit(1)
+
+    # only the postgres sink can tell bad data from its own errors (Is_Poison_Error). without that bisect would dead letter
+    # a full disk or a locked database file like bad rows
+    if app_info.failure_policy == "bisect" and app_info.sink_type != "postgres":
+        print(f"Error: failure_policy=bisect needs sink_type=postgres in file: {env_file}")
+        sys.exit(1)
+
+    # fences flush the postgres sink's wal, the file sinks have their own durability
+    if app_info.sink_durability == "fenced" and app_info.sink_type != "postgres":
+        print(f"Error: sink_durability=fenced needs sink_type=postgres in file: {env_file}")
+        sys.exit(1)
+
+    # each shard saves its own slot's lsn, the parquet sink holds 1 pending lsn. lanes have their own loop
+    if app_info.shards_config_path and (app_info.sink_type == "parquet" or app_info.lanes_config_path):
+        print(f"Error: shards_config_path doesn't work with sink_type=parquet or lanes_config_path in file: {env_file}")
+        sys.exit(1)
+
     # if any memeber variable is None
     if any(value is None for value in vars(app_info).values()):
         print(f"Error: missing environment variables in file: {env_file}")
@@ -0,0 +1,233 @@
+import hashlib
+import json
+import re
+import psycopg
+from psycopg.types.json import Jsonb
+from Offsets import Lsn_To_Int, Int_To_Lsn
+from Sql_Commands import (Create_State_Table, Upsert_State_Row, Get_State_Row_Sql, List_State_Rows_Sql,
+                          Get_Row_As_Of_Sql, List_Rows_As_Of_Sql)
+
+
+'''
+latest state tables and point in time reads over cdc_events (latest_state=true in app.env)
+
+cdc_events is append only history. "what does row X look like now" or "what did it look like at lsn Y" used to mean a
+window function over every change the table ever had, sorting text lsn's, on the same server the sink is writing to
+
+write side, in the same transaction as the cdc_events insert (Sink_Postgres.py):
+- every change kind is stored in cdc_events, not just inserts, so the history is complete
+- each source table gets a state table, cdc_state__<schema>__<table> (pk, commit_lsn, deleted, row). the batch is
+  collapsed to the last change per key and upserted. a change only wins if its lsn is >= the stored one, so replays
+  after a restart can't move a row backwards. deletes leave a tombstone (deleted=true)
+- an update that changes the key tombstones the old key
+- state tables are created the first time their source table shows up, in their own committed transaction first
+  (same as partitions and schema registrations)
+
+the key is the table's primary key from wal2json's include-pk option, so inserts, updates and deletes of 1 row all
+land on the same pk. tables without a primary key fall back to the old pk (replica identity keys or the whole row)
+
+read side, State_Reader
+- Latest_Row / Latest_Rows read the state tables, 1 index lookup per row
+- Row_As_Of / Rows_As_Of read cdc_events through its (table_fqn, pk, lsn) index: the newest change at or below the lsn.
+  legacy cdc_events gets an expression index on commit_lsn::pg_lsn for this, partitioned cdc_events already has it
+rows come back as {column: value} dicts, None if the row doesn't exist (or was deleted) at that point
+'''
+
+MAX_IDENTIFIER = 63 # postgres truncates longer names
+SIMPLE_NAME = re.compile(r"^[a-z0-9]+(_[a-z0-9]+)*$") # a schema/table name that maps to itself (State_Table_Name)
+
+known_state_tables = set() # state tables that exist on the sink (or are created in the open transaction)
+
+
+# "public.orders" -> cdc_state__public__orders. a name only maps to itself when both parts are plain lower case words
+# joined by single _'s. anything else gets a hash of the full name, or 2 tables would share 1 state table:
+# public.Orders and public.orders both lower to orders, a_.b and a._b both join to a___b. names too long for postgres
+# are cut and hashed the same way
+def State_Table_Name(table_fqn):
+    schema, _, table = table_fqn.partition(".")
+    name = "cdc_state__" + re.sub(r"[^a-z0-9_]", "_", table_fqn.lower().replace(".", "__", 1))
+    if not (SIMPLE_NAME.match(schema) and SIMPLE_NAME.match(table)) or len(name) > MAX_IDENTIFIER:
+        name = name[:MAX_IDENTIFIER - 9] + "_" + hashlib.md5(table_fqn.encode("utf-8")).hexdigest()[:8]
+
+    return name
+
+
+# same text the cdc_events pk column holds
+def Pk_Text(pk):
+    return pk if isinstance(pk, str) else json.dumps(pk)
+
+
+# the row a change leaves behind as {column: value}, None for deletes
+def Row_Image(change):
+    if change.get("kind") == "delete" or change.get("columnvalues") is None:
+        return None
+
+    return dict(zip(change["columnnames"], change["columnvalues"]))
+
+
+# the key an update moved away from, or None if the key didn't change. only known when wal2json sent the primary key
+# columns (include-pk) and they're part of oldkeys
+def Old_Key(change):
+    pk, oldkeys = change.get("pk"), change.get("oldkeys")
+    if change.get("kind") != "update" or not pk or not oldkeys:
+        return None
+
+    position = {name: i for i, name in enumerate(oldkeys["keynames"])}
+    if not all(name in position for name in pk["pknames"]):
+        return None
+
+    return [oldkeys["keyvalues"][position[name]] for name in pk["pknames"]]
+
+
+# the last event per (table, pk, commit_lsn), in batch order. what goes into cdc_events when every kind is stored
+def Last_Per_Key(events):
+    last = {}
+    for event in events:
+        last[(event["table"], Pk_Text(event["pk"]), event["commit_lsn"])] = event
+
+    return list(last.values())
+
+
+# table -> [(pk, commit_lsn, deleted, row)] with 1 entry per key, its last change in the batch
+def State_Rows(events):
+    latest = {} # (table, pk text) -> (commit_lsn, deleted, row)
+    for event in events:
+        change = event["payload_json"]
+        pk = Pk_Text(event["pk"])
+
+        old_key = Old_Key(change)
+        if old_key is not None and Pk_Text(old_key) != pk:
+            latest[(event["table"], Pk_Text(old_key))] = (event["commit_lsn"], True, None)
+
+        row = Row_Image(change)
+        latest[(event["table"], pk)] = (event["commit_lsn"], row is None, row)
+
+    by_table = {}
+    for (table, pk), (commit_lsn, deleted, row) in latest.items():
+        by_table.setdefault(table, []).append((pk, commit_lsn, deleted, None if row is None else Jsonb(row)))
+
+    return by_table
+
+
+def Missing_State_Tables(events):
+    return sorted({State_Table_Name(event["table"]) for event in events} - known_state_tables)
+
+
+# sync version, used by Apply_Postgres. returns True if it created anything (caller commits it)
+def Ensure_State_Tables(cur, events):
+    missing = Missing_State_Tables(events)
+    for state_table in missing:
+        cur.execute(Create_State_Table(state_table))
+        known_state_tables.add(state_table)
+
+    return len(missing) > 0
+
+
+async def Ensure_State_Tables_Async(cur, events):
+    missing = Missing_State_Tables(events)
+    for state_table in missing:
+        await cur.execute(Create_State_Table(state_table))
+        known_state_tables.add(state_table)
+
+    return len(missing) > 0
+
+
+# runs in the sink's open transaction, after the cdc_events insert
+def Upsert_State(cur, events):
+    for table, rows in State_Rows(events).items():
+        cur.executemany(Upsert_State_Row(State_Table_Name(table)), rows)
+
+
+async def Upsert_State_Async(cur, events):
+    for table, rows in State_Rows(events).items():
+        await cur.executemany(Upsert_State_Row(State_Table_Name(table)), rows)
+
+
+# a failed transaction may have rolled back a create, look them up again
+def Reset_Known_State_Tables():
+    known_state_tables.clear()
+
+
+# (lsn column expression, parameter placeholder, parameter conversion) for comparing cdc_events lsn's
+def History_Lsn(app_config):
+    if app_config.sink_schema_mode != "partitioned":
+        return "commit_lsn::pg_lsn", "%s::pg_lsn", str
+    if app_config.lsn_column_type == "bigint":
+        return "commit_lsn", "%s", Lsn_To_Int
+
+    return "commit_lsn", "%s::pg_lsn", str
+
+
+# cdc_events.commit_lsn back to 'X/Y' text whatever type it's stored as
+def Lsn_Text(value):
+    return Int_To_Lsn(value) if isinstance(value, int) else str(value)
+
+
+# the row a cdc_events payload describes, None for deletes
+def Payload_Row(payload):
+    if isinstance(payload, str):
+        payload = json.loads(payload)
+
+    return Row_Image(payload)
+
+
+''' read api for consumers. 1 connection per reader, use it as a context manager
+    with State_Reader(sink_dsn, app_config) as reader:
+        reader.Latest_Row("public.orders", [42])
+        reader.Row_As_Of("public.orders", [42], "0/16B3748")
+key: the primary key values as a list ([42], [1, "eu"])
+'''
+class State_Reader:
+    def __init__(self, dsn, app_config):
+        self.cx = psycopg.connect(dsn, autocommit=True)
+        self.source = "cdc_events_full" if app_config.payload_mode == "registry" else "cdc_events"
+        self.lsn_column, self.lsn_param, self.lsn_value = History_Lsn(app_config)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+
+    def Close(self):
+        self.cx.close()
+
+    def Latest_Row(self, table_fqn, key):
+        with self.cx.cursor() as cur:
+            cur.execute(Get_State_Row_Sql(State_Table_Name(table_fqn)), (Pk_Text(key),))
+            found = cur.fetchone()
+
+        if found is None or found[1]:
+            return None
+
+        return found[2]
+
+    # yields (pk, commit_lsn, row) for every live row of the table, streamed with a server side cursor
+    def Latest_Rows(self, table_fqn):
+        with self.cx.transaction():
+            with self.cx.cursor(name="state_rows") as cur:
+                cur.execute(List_State_Rows_Sql(State_Table_Name(table_fqn)))
+                for pk, commit_lsn, row in cur:
+                    yield json.loads(pk), commit_lsn, row
+
+    def Row_As_Of(self, table_fqn, key, lsn):
+        with self.cx.cursor() as cur:
+            cur.execute(Get_Row_As_Of_Sql(self.source, self.lsn_column, self.lsn_param),
+                        (table_fqn, Pk_Text(key), self.lsn_value(lsn)))
+            found = cur.fetchone()
+
+        if found is None:
+            return None
+
+        return Payload_Row(found[1])
+
+    # yields (pk, commit_lsn, row) for every row that existed at lsn
+    def Rows_As_Of(self, table_fqn, lsn):
+        with self.cx.transaction():
+            with self.cx.cursor(name="rows_as_of") as cur:
+                cur.execute(List_Rows_As_Of_Sql(self.source, self.lsn_column, self.lsn_param),
+                            (table_fqn, self.lsn_value(lsn)))
+                for pk, commit_lsn, payload in cur:
+                    row = Payload_Row(payload)
+                    if row is not None:
+                        yield json.loads(pk), Lsn_Text(commit_lsn), row
@@ -0,0 +1,152 @@
+import json
+import os
+from pathlib import Path
+
+
+'''
+wal2json format-version 2 reader with disk staging for large transactions (source_format=v2 in app.env)
+
+with format-version 1 every transaction is 1 json document, so a batch job that changes a million rows is 1 giant
+line: pg_recvlogical's output, the json parse and the dict it makes all have to fit in memory at once, and nothing
+moves until it's all parsed. format-version 2 writes 1 line per change between a "B" (begin) and "C" (commit) line
+
+Txn_Assembler turns those lines back into the v1 shaped transactions the rest of the pipeline expects:
+- small transactions are collected in memory and handed over whole at "C", same as v1
+- once a transaction passes spill_rows changes, its changes go to a staging file (staging_dir/txn_<xid>.jsonl) instead,
+  so memory stays bounded by spill_rows no matter how big the transaction is
+- at "C" a staged transaction is read back and handed over in chunks of chunk_rows changes. every chunk but the last
+  is yielded with lsn None, so the apply loop never saves an lsn in the middle of a transaction. if we crash halfway
+  the whole transaction is replayed and the idempotent sink/dedup filter drop what was already applied
+- a transaction with no "C" (pg_recvlogical restarted mid transaction) is thrown away with its staging file, it comes
+  again from the start
+
+wal2json only decodes a transaction once it has committed (it has no in-progress streaming callbacks), so nothing
+staged here is ever rolled back, the staging only bounds memory and smooths the hand-off
+'''
+
+KINDS = {"I": "insert", "U": "update", "D": "delete"}
+
+
+# 1 v2 change line -> the v1 change dict (columnnames/columntypes/columnvalues, oldkeys)
+def V2_Change_To_V1(record):
+    change = {"kind": KINDS[record["action"]], "schema": record.get("schema"), "table": record.get("table")}
+
+    columns = record.get("columns")
+    if columns:
+        change["columnnames"] = [c["name"] for c in columns]
+        change["columntypes"] = [c.get("type", "text") for c in columns]
+        change["columnvalues"] = [c.get("value") for c in columns]
+
+    identity = record.get("identity")
+    if identity:
+        change["oldkeys"] = {
+            "keynames": [c["name"] for c in identity],
+            "keytypes": [c.get("type", "text") for c in identity],
+            "keyvalues": [c.get("value") for c in identity],
+        }
+
+    pk = record.get("pk") # include-pk=1
+    if pk:
+        change["pk"] = {"pknames": [c["name"] for c in pk], "pktypes": [c.get("type", "text") for c in pk]}
+
+    return change
+
+
+class Txn_Assembler:
+    def __init__(self, staging_dir, spill_rows, chunk_rows):
+        self.staging_dir = Path(staging_dir)
+        self.spill_rows = spill_rows
+        self.chunk_rows = chunk_rows
+        self.header = None      # xid/timestamp of the open transaction
+        self.changes = []       # changes not staged yet
+        self.staged_path = None
+        self.staged_file = None
+        self.staged_rows = 0
+        self.staged_transactions = 0
+
+    # takes 1 parsed v2 line, yields the (lsn, v1 transaction) pairs it completes
+    def Feed(self, record):
+        action = record.get("action")
+
+        if action == "B":
+            self.Discard() # a "B" with a transaction still open means the last one never got its "C"
+            self.header = {"xid": record.get("xid"), "timestamp": record.get("timestamp")}
+
+        elif action in KINDS:
+            if self.header is None:
+                return # started reading mid transaction
+            self.changes.append(V2_Change_To_V1(record))
+            if len(self.changes) >= self.spill_rows:
+                self.Spill()
+
+        elif action == "C" and self.header is not None:
+            lsn = record.get("nextlsn") or record.get("lsn")
+            yield from self.Finish(lsn, record.get("timestamp") or self.header["timestamp"])
+
+        elif action == "M" and self.header is not None:
+            # logical messages ride along as v1 style message changes (heartbeats use them, see Heartbeat.py)
+            self.changes.append({"kind": "message", "transactional": record.get("transactional"),
+                                 "prefix": record.get("prefix"), "content": record.get("content")})
+
+        # "T" (truncate) isn't handled by the pipeline, v1 skipped it too
+
+    def Finish(self, lsn, timestamp):
+        transaction = {"xid": self.header["xid"], "timestamp": timestamp, "nextlsn": lsn}
+
+        if self.staged_file is None:
+            yield lsn, {**transaction, "change": self.changes}
+            self.header = None
+            self.changes = []
+            return
+
+        self.Spill()
+        self.staged_file.close()
+        self.staged_file = None
+        self.staged_transactions += 1
+        print(f"Replaying staged transaction {transaction['xid']}: {self.staged_rows} changes in chunks of {self.chunk_rows}")
+
+        # change_offset: where the chunk's first change sits in the transaction, so every change keeps its position
+        try:
+            chunk = []
+            offset = 0
+            with open(self.staged_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if len(chunk) >= self.chunk_rows:
+                        yield None, {**transaction, "change": chunk, "change_offset": offset} # not the end, no lsn
+                        offset += len(chunk)
+                        chunk = []
+                    chunk.append(json.loads(line))
+
+            yield lsn, {**transaction, "change": chunk, "change_offset": offset}
+        finally:
+            self.Discard()
+
+    def Spill(self):
+        if self.staged_file is None:
+            self.staging_dir.mkdir(parents=True, exist_ok=True)
+            self.staged_path = self.staging_dir / f"txn_{self.header['xid']}.jsonl"
+            self.staged_file = open(self.staged_path, "w", encoding="utf-8")
+            self.staged_rows = 0
+
+        for change in self.changes:
+            self.staged_file.write(json.dumps(change, separators=(",", ":")))
+            self.staged_file.write("\n")
+
+        self.staged_rows += len(self.changes)
+        self.changes = []
+
+    # drops the open transaction and its staging file
+    def Discard(self):
+        if self.staged_file is not None:
+            self.staged_file.close()
+            self.staged_file = None
+        if self.staged_path is not None:
+            try:
+                os.remove(self.staged_path)
+            except FileNotFoundError:
+                pass
+            self.staged_path = None
+
+        self.header = None
+        self.changes = []
+        self.staged_rows = 0
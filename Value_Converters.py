@@ -0,0 +1,253 @@
+import json
+from collections import OrderedDict
+from datetime import date, datetime, time
+from decimal import Decimal, InvalidOperation
+
+
+'''
+typed values from wal2json's columntypes
+
+wal2json writes every value as json: numerics come as floats (or strings with numeric-data-types-as-string), timestamps,
+dates, arrays and bytea as text. before this every consumer had to look at columntypes and parse each value itself
+
+here 1 conversion function is compiled per shape (table + column names + column types) the first time that shape is
+seen, and cached:
+- the function is generated python source with the right converter inlined for each column, columns that are already
+  the right python type (text, int, bool...) are passed through untouched. so there's no per value type lookup
+- a table that shows up with a new shape (ddl) gets a new function, its oldest shapes fall out of the cache
+- a value the compiled function can't convert (ex 'infinity' timestamps, odd array text) sends just that row through a
+  slow path that converts value by value and keeps the raw value for anything that fails
+
+Typed_Rows() and Typed_Columns() do whole batches of 1 shape. Group_Shapes() splits a batch into shapes
+'''
+
+MAX_CACHED_TABLES = 10000
+MAX_SHAPES_PER_TABLE = 4
+CONVERSION_ERRORS = (ValueError, TypeError, AttributeError, InvalidOperation, IndexError)  # JSONDecodeError is a ValueError
+
+compiled = {} # table -> OrderedDict((names, types) -> Compiled_Shape), newest shape last
+
+
+def To_Decimal(value):
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+
+def To_Float(value):
+    return float(value) # also handles 'NaN', 'Infinity' as text
+
+
+def To_Int(value):
+    return value if isinstance(value, int) else int(value)
+
+
+def To_Bool(value):
+    if isinstance(value, bool):
+        return value
+
+    return value in ("t", "true", "1", 1)
+
+
+def To_Datetime(value):
+    return datetime.fromisoformat(value)
+
+
+def To_Date(value):
+    return date.fromisoformat(value)
+
+
+def To_Time(value):
+    return time.fromisoformat(value)
+
+
+def To_Json(value):
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def To_Bytes(value):
+    return bytes.fromhex(value[2:]) if value.startswith("\\x") else value.encode("utf-8")
+
+
+# pg array text '{1,2,NULL}' / '{"a b","c"}' / '{{1,2},{3,4}}' -> nested python lists, elements still text
+def Parse_Pg_Array(text):
+    position = 0
+
+    def Parse_List():
+        nonlocal position
+        position += 1 # past '{'
+        items = []
+        while text[position] != "}":
+            if text[position] == "{":
+                items.append(Parse_List())
+            elif text[position] == '"':
+                position += 1
+                chars = []
+                while text[position] != '"':
+                    if text[position] == "\\":
+                        position += 1
+                    chars.append(text[position])
+                    position += 1
+                position += 1
+                items.append("".join(chars))
+            else:
+                end = position
+                while text[end] not in ",}":
+                    end += 1
+                item = text[position:end]
+                items.append(None if item == "NULL" else item)
+                position = end
+
+            if text[position] == ",":
+                position += 1
+
+        position += 1 # past '}'
+        return items
+
+    if text.startswith("["): # '[0:1]={1,2}' has explicit bounds, drop them
+        text = text[text.index("=") + 1:]
+
+    return Parse_List()
+
+
+def Array_Converter(element):
+    def Convert_Elements(items):
+        return [None if item is None else Convert_Elements(item) if isinstance(item, list) else element(item) for item in items]
+
+    def To_Array(value):
+        return Convert_Elements(Parse_Pg_Array(value)) if isinstance(value, str) else value
+
+    return To_Array
+
+
+# pg type name (as wal2json writes it) -> converter name, or None if the json value is already the right type
+SCALAR_CONVERTERS = {
+    "smallint": "To_Int", "int2": "To_Int", "integer": "To_Int", "int": "To_Int", "int4": "To_Int",
+    "bigint": "To_Int", "int8": "To_Int", "serial": "To_Int", "bigserial": "To_Int", "oid": "To_Int",
+    "real": "To_Float", "float4": "To_Float", "double precision": "To_Float", "float8": "To_Float",
+    "numeric": "To_Decimal", "decimal": "To_Decimal",
+    "boolean": "To_Bool", "bool": "To_Bool",
+    "timestamp without time zone": "To_Datetime", "timestamp": "To_Datetime",
+    "timestamp with time zone": "To_Datetime", "timestamptz": "To_Datetime",
+    "date": "To_Date", "time without time zone": "To_Time", "time": "To_Time",
+    "json": "To_Json", "jsonb": "To_Json", "bytea": "To_Bytes",
+}
+
+CONVERTER_FUNCTIONS = {
+    "To_Int": To_Int, "To_Float": To_Float, "To_Decimal": To_Decimal, "To_Bool": To_Bool, "To_Datetime": To_Datetime,
+    "To_Date": To_Date, "To_Time": To_Time, "To_Json": To_Json, "To_Bytes": To_Bytes,
+}
+
+
+def Base_Type(pg_type):
+    return pg_type.split("(")[0].strip().lower()
+
+
+# returns a converter function for 1 pg type, or None for pass through
+def Converter_For(pg_type):
+    base = Base_Type(pg_type)
+    if base.endswith("[]"):
+        element = CONVERTER_FUNCTIONS.get(SCALAR_CONVERTERS.get(base[:-2].strip()))
+        return Array_Converter(element or (lambda item: item))
+    if base.startswith("_"): # some versions write int4[] as _int4
+        element = CONVERTER_FUNCTIONS.get(SCALAR_CONVERTERS.get(base[1:]))
+        return Array_Converter(element or (lambda item: item))
+
+    return CONVERTER_FUNCTIONS.get(SCALAR_CONVERTERS.get(base))
+
+
+class Compiled_Shape:
+    def __init__(self, names, types):
+        self.names = names
+        self.types = types
+        self.converters = [Converter_For(pg_type) for pg_type in types]
+        self.Convert_Fast = self.Compile()
+
+    # builds 'def Convert(v): return [v[0], c1(v[1]) if v[1] is not None else None, ...]' for this exact shape
+    def Compile(self):
+        namespace = {}
+        parts = []
+        for i, converter in enumerate(self.converters):
+            if converter is None:
+                parts.append(f"v[{i}]")
+            else:
+                namespace[f"c{i}"] = converter
+                parts.append(f"(None if v[{i}] is None else c{i}(v[{i}]))")
+
+        source = f"def Convert(v):\n    return [{', '.join(parts)}]\n"
+        exec(compile(source, f"<converter {len(self.names)} columns>", "exec"), namespace)
+        return namespace["Convert"]
+
+    # 1 row of raw values -> typed values. a value that won't convert is kept as it came
+    def Convert(self, values):
+        try:
+            return self.Convert_Fast(values)
+        except CONVERSION_ERRORS:
+            return self.Convert_Slow(values)
+
+    def Convert_Slow(self, values):
+        out = []
+        for value, converter in zip(values, self.converters):
+            if value is None or converter is None:
+                out.append(value)
+                continue
+            try:
+                out.append(converter(value))
+            except CONVERSION_ERRORS:
+                out.append(value)
+
+        return out
+
+
+# the compiled converter for this shape. compiles on first sight, a table keeps its MAX_SHAPES_PER_TABLE newest shapes
+# (the full row shape plus the key only shape of its deletes, and room for a ddl change) so older ones get dropped
+def Get_Converter(table, names, types):
+    shapes = compiled.get(table)
+    if shapes is None:
+        if len(compiled) >= MAX_CACHED_TABLES:
+            compiled.pop(next(iter(compiled))) # oldest table out
+        shapes = compiled[table] = OrderedDict()
+
+    key = (names, types)
+    shape = shapes.get(key)
+    if shape is None:
+        shape = shapes[key] = Compiled_Shape(names, types)
+        while len(shapes) > MAX_SHAPES_PER_TABLE:
+            shapes.popitem(last=False)
+    else:
+        shapes.move_to_end(key)
+
+    return shape
+
+
+def Reset_Converters():
+    compiled.clear()
+
+
+# splits normalized events into {(table, names, types): [changes]}. deletes (no columnnames) use their oldkeys
+def Group_Shapes(events):
+    groups = {}
+    for event in events:
+        change = event["payload_json"]
+        names = change.get("columnnames")
+        if names:
+            types = change.get("columntypes") or ["text"] * len(names)
+        else:
+            keys = change.get("oldkeys", {})
+            names, types = keys.get("keynames", []), keys.get("keytypes", [])
+
+        groups.setdefault((event["table"], tuple(names), tuple(types)), []).append(event)
+
+    return groups
+
+
+# typed rows for a list of raw value lists that all have this shape
+def Typed_Rows(table, names, types, rows):
+    convert = Get_Converter(table, tuple(names), tuple(types)).Convert
+    return [convert(row) for row in rows]
+
+
+# same, but transposed: 1 typed list per column
+def Typed_Columns(table, names, types, rows):
+    if not rows:
+        return [[] for _ in names]
+
+    return [list(column) for column in zip(*Typed_Rows(table, names, types, rows))]
@@ -0,0 +1,107 @@
+import json
+import re
+from Heartbeat import HEARTBEAT_SCHEMA, HEARTBEAT_TABLE
+from Event_Rules import Rule_For
+
+
+'''
+passthrough mode (payload_mode=passthrough in app.env). stores wal2json changes without parsing them
+
+for a cdc_events staging sink the full path is json.loads of the whole transaction in Source_Pg, a walk over it in
+Normalize_Wal2Json, then json.dumps of every payload again in the sink's Jsonb adapter. the stored json is the same
+text wal2json sent. here only what the pipeline needs is pulled out of the text:
+- Scan_Transaction reads xid/nextlsn/timestamp from the line's header and cuts the "change" array into 1 string per
+  change. with pretty-print=0 every change starts with {"kind":" and inside a json string that would be escaped as
+  {\\"kind\\":\\", so splitting on ,{"kind":" is safe
+- Normalize_Raw reads kind/schema/table from the start of each change with 1 regex, and the key from the end:
+  oldkeys (small, the only part that's parsed) for updates/deletes, the columnvalues text as it is for inserts
+- the change string goes to the sink as the jsonb parameter untouched (Sink_Postgres.Raw_Jsonb)
+
+only the v1 format from Source_Pg (1 transaction per line) and the postgres sink use this. changes of tables with
+event rules are still parsed, they can't be shaped as text. the insert pk is the
+columnvalues text exactly as wal2json wrote it, where full mode stores json.dumps of the parsed list
+'''
+
+HEADER_FIELD = re.compile(r'"(xid|nextlsn|timestamp)":("(?:[^"\\]|\\.)*"|\d+)')
+CHANGE_START = re.compile(r'\{"kind":"(\w+)","schema":"((?:[^"\\]|\\.)*)","table":"((?:[^"\\]|\\.)*)"')
+CHANGE_MARKER = ',{"kind":"'
+
+
+def Json_Text(text):
+    return json.loads(f'"{text}"') if "\\" in text else text
+
+
+# 1 v1 line -> (lsn, transaction). the transaction has "raw_changes" (List[str]) instead of "change"
+# returns None for lines that aren't a transaction
+def Scan_Transaction(line):
+    start = line.find('"change":[')
+    if start < 0:
+        return None
+
+    transaction = {}
+    for name, value in HEADER_FIELD.findall(line, 0, start):
+        transaction[name] = Json_Text(value[1:-1]) if value.startswith('"') else int(value)
+
+    body = line[start + len('"change":['):line.rindex("]")]
+    if not body:
+        raw_changes = []
+    else:
+        parts = body.split(CHANGE_MARKER)
+        raw_changes = [parts[0]] + ['{"kind":"' + part for part in parts[1:]]
+
+    transaction["raw_changes"] = raw_changes
+    return transaction.get("nextlsn") or transaction.get("xid"), transaction
+
+
+# the key of 1 raw change, in the same place Normalize_Wal2Json takes it from
+def Raw_Pk(change):
+    oldkeys = change.rfind('"oldkeys":')
+    if oldkeys >= 0:
+        return json.loads(change[oldkeys + len('"oldkeys":'):-1]).get("keyvalues")
+
+    values = change.find('"columnvalues":')
+    if values >= 0:
+        return change[values + len('"columnvalues":'):-1]
+
+    return None
+
+
+# Normalize_Wal2Json for a scanned transaction. events get "payload_raw" (the change text) instead of "payload_json"
+def Normalize_Raw(obj):
+    commit_lsn = obj.get("lsn") or obj.get("commit_lsn") or obj.get("nextlsn")
+    out = []
+    for position, change in enumerate(obj["raw_changes"]):
+        match = CHANGE_START.match(change)
+        if match is None:
+            continue
+        kind, schema, table = match.groups()
+        if schema == HEARTBEAT_SCHEMA and table == HEARTBEAT_TABLE:
+            continue
+
+        # tables with rules (Event_Rules.py) have to be parsed to be shaped, they go on as payload_json
+        rule = Rule_For(Json_Text(schema), Json_Text(table))
+        if rule is not None:
+            shaped = rule.Apply(json.loads(change))
+            if shaped is not None:
+                out.append({
+                    "commit_lsn": commit_lsn,
+                    "commit_time": obj.get("timestamp"),
+                    "type": kind,
+                    "table": f"{Json_Text(schema)}.{Json_Text(table)}",
+                    "pk": shaped.get("oldkeys", {}).get("keyvalues") or shaped.get("columnvalues"),
+                    "position": position,
+                    "payload_json": shaped,
+                })
+            continue
+
+        out.append({
+            "commit_lsn": commit_lsn,
+            "commit_time": obj.get("timestamp"),
+            "type": kind,
+            "table": f"{Json_Text(schema)}.{Json_Text(table)}",
+            "pk": Raw_Pk(change),
+            "position": position,
+            "payload_raw": change,
+        })
+
+    return out
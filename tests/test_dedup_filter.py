@@ -0,0 +1,68 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Dedup_Filter import Dedup_Filter
+
+
+def Change(kind, position, value, lsn="0/16B3748"):
+    return {"commit_lsn": lsn, "commit_time": None, "type": kind, "table": "public.orders", "pk": [1],
+            "position": position, "payload_json": {"kind": kind, "columnvalues": [1, value]}}
+
+
+# include-pk gives an insert and an update of 1 row the same (table, pk, commit_lsn), both have to reach the sink
+def test_insert_then_update_of_one_key_in_one_transaction():
+    dedup = Dedup_Filter(100)
+    events = [Change("insert", 0, "new"), Change("update", 1, "paid")]
+
+    assert dedup.Filter(events) == events
+    assert dedup.skipped_events == 0
+
+
+# the same row in 2 chunks of a staged transaction, the second chunk's change isn't a repeat of the first
+def test_later_chunk_of_one_transaction_is_not_a_repeat():
+    dedup = Dedup_Filter(100)
+    first_chunk = [Change("insert", 0, "new")]
+    dedup.Mark_Applied(first_chunk, None)
+
+    second_chunk = [Change("update", 5000, "paid")]
+    assert dedup.Filter(second_chunk) == second_chunk
+
+
+def test_replayed_change_is_still_dropped():
+    dedup = Dedup_Filter(100)
+    events = [Change("insert", 0, "new"), Change("update", 1, "paid")]
+    dedup.Mark_Applied(events, None)
+
+    assert dedup.Filter([Change("insert", 0, "new"), Change("update", 1, "paid")]) == []
+    assert dedup.skipped_events == 2
+
+
+# the positions come from normalization, 1 per change in the transaction
+def test_normalized_changes_of_one_key_keep_apart():
+    Apply_Manager = pytest.importorskip("Apply_Manager")
+    obj = {"nextlsn": "0/16B3748", "timestamp": None, "change": [
+        {"kind": "insert", "schema": "public", "table": "orders", "columnnames": ["id", "status"],
+         "columnvalues": [1, "new"], "pk": {"pknames": ["id"]}},
+        {"kind": "update", "schema": "public", "table": "orders", "columnnames": ["id", "status"],
+         "columnvalues": [1, "paid"], "pk": {"pknames": ["id"]}, "oldkeys": {"keynames": ["id"], "keyvalues": [1]}},
+    ]}
+    events = Apply_Manager.Normalize_Wal2Json(obj)
+
+    assert [event["type"] for event in Dedup_Filter(100).Filter(events)] == ["insert", "update"]
+
+
+# the capacity evicts the least recently seen key, a key that keeps getting replayed stays
+def test_eviction_is_least_recently_seen():
+    dedup = Dedup_Filter(2)
+    first, second, third = Change("insert", 0, "a"), Change("insert", 1, "b"), Change("insert", 2, "c")
+    dedup.Mark_Applied([first, second], None)
+
+    assert dedup.Filter([first]) == [] # replayed again, first is now the most recent
+    dedup.Mark_Applied([third], None)
+
+    assert dedup.Filter([first]) == []
+    assert dedup.Filter([second]) == [second] # evicted instead of first
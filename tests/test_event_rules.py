@@ -0,0 +1,76 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Apply_Manager import Normalize_Wal2Json
+from Event_Rules import Table_Rule, table_rules
+
+
+def Insert(value, column_type="integer"):
+    return {"kind": "insert", "schema": "public", "table": "users", "columnnames": ["id", "age"],
+            "columntypes": ["integer", column_type], "columnvalues": [1, value]}
+
+
+def test_ordering_compare_of_another_type_is_no_match():
+    rule = Table_Rule("public.users", {"where": [["age", ">=", 18]]}, "")
+
+    assert rule.Apply(Insert(20))["columnvalues"] == [1, 20]
+    assert rule.Apply(Insert(10)) is None
+    assert rule.Apply(Insert("20", "text")) is None # int vs str used to raise TypeError
+    assert rule.Apply(Insert(None)) is None
+
+
+def test_string_compare_still_works():
+    rule = Table_Rule("public.users", {"where": [["age", "<", "m"]]}, "")
+
+    assert rule.Apply(Insert("a", "text")) is not None
+    assert rule.Apply(Insert("z", "text")) is None
+    assert rule.Apply(Insert(5)) is None
+
+
+@pytest.mark.parametrize("condition", [["age", ">", True], ["age", "<=", [1]], ["age", "in", 5], ["age", "="],
+                                       ["age", "=", {"a": 1}], "age"])
+def test_bad_literals_are_rejected_when_the_rule_loads(condition):
+    with pytest.raises(Exception):
+        Table_Rule("public.users", {"where": [condition]}, "")
+
+
+def Update(status, oldkeys=None):
+    change = {"kind": "update", "schema": "public", "table": "users", "columnnames": ["id", "status"],
+              "columntypes": ["integer", "text"], "columnvalues": [1, status],
+              "pk": {"pknames": ["id"], "pktypes": ["integer"]}}
+    if oldkeys is not None:
+        change["oldkeys"] = {"keynames": ["id", "status"], "keytypes": ["integer", "text"], "keyvalues": oldkeys}
+    return change
+
+
+# the sink has the row from when it matched, a dropped update would leave it there forever
+def test_update_leaving_the_filter_becomes_a_delete_of_its_key():
+    rule = Table_Rule("public.users", {"where": [["status", "=", "active"]], "rename": {"id": "user_id"}}, "")
+
+    shaped = rule.Apply(Update("closed"))
+
+    assert shaped["kind"] == "delete"
+    assert shaped["oldkeys"]["keynames"] == ["user_id"] and shaped["oldkeys"]["keyvalues"] == [1]
+    assert "columnvalues" not in shaped
+    assert rule.Apply(Update("active"))["kind"] == "update"
+
+
+def test_update_that_never_matched_is_dropped_with_replica_identity_full():
+    rule = Table_Rule("public.users", {"where": [["status", "=", "active"]]}, "")
+
+    assert rule.Apply(Update("closed", oldkeys=[1, "pending"])) is None
+    assert rule.Apply(Update("closed", oldkeys=[1, "active"]))["kind"] == "delete"
+
+
+def test_tombstone_is_keyed_by_the_primary_key():
+    table_rules["public.users"] = Table_Rule("public.users", {"where": [["status", "=", "active"]]}, "")
+    try:
+        events = Normalize_Wal2Json({"nextlsn": "0/10", "change": [Update("closed", oldkeys=[1, "active"])]})
+    finally:
+        table_rules.clear()
+
+    assert [(event["type"], event["pk"]) for event in events] == [("delete", [1])]
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Apply_Manager import Apply_Events, Bisect_Batch
+
+
+class Bad_Row(Exception):
+    pass
+
+
+class Sink_Down(Exception):
+    pass
+
+
+def Is_Bad_Row(exc):
+    return isinstance(exc, Bad_Row)
+
+
+# a sink that rejects any batch holding one of the bad ids
+def Sink(bad_ids, calls):
+    async def Apply(events):
+        calls.append(len(events))
+        if any(event["id"] in bad_ids for event in events):
+            raise Bad_Row("bad value")
+    return Apply
+
+
+def Events(n):
+    return [{"id": i} for i in range(n)]
+
+
+def test_bisect_dead_letters_only_the_bad_events():
+    calls, dead = [], []
+
+    async def Dead_Letter(poison):
+        dead.extend(poison)
+
+    asyncio.run(Bisect_Batch(Events(16), Sink({3, 11}, calls), Dead_Letter, Is_Bad_Row))
+
+    assert [event["id"] for event, _ in dead] == [3, 11]
+    assert all(isinstance(exc, Bad_Row) for _, exc in dead)
+    assert len(calls) < 16 # found by splitting, not 1 call per event
+
+
+def test_bisect_halts_on_an_error_that_isnt_poison():
+    async def Apply(events):
+        raise Sink_Down("connection refused")
+
+    async def Dead_Letter(poison):
+        raise AssertionError("nothing should be dead lettered")
+
+    with pytest.raises(Sink_Down):
+        asyncio.run(Bisect_Batch(Events(4), Apply, Dead_Letter, Is_Bad_Row))
+
+
+def test_bisect_without_a_dead_letter_store_raises():
+    with pytest.raises(Exception, match="no dead letter store"):
+        asyncio.run(Bisect_Batch(Events(4), Sink({2}, []), None, Is_Bad_Row))
+
+
+# parquet/sqlite have no classifier: a full disk must not be dead lettered like bad rows
+def test_apply_events_without_a_classifier_halts_instead_of_bisecting():
+    calls, dead = [], []
+
+    async def Apply(events):
+        calls.append(len(events))
+        raise OSError("No space left on device")
+
+    async def Dead_Letter(poison):
+        dead.extend(poison)
+
+    with pytest.raises(OSError):
+        asyncio.run(Apply_Events(Events(8), Apply, 2, 0, "bisect", Dead_Letter, None))
+
+    assert calls == [8, 8, 8] # the whole batch, retried, never split
+    assert dead == []
+
+
+def test_apply_events_bisects_a_poison_batch_right_away():
+    calls, dead = [], []
+
+    async def Dead_Letter(poison):
+        dead.extend(poison)
+
+    asyncio.run(Apply_Events(Events(8), Sink({5}, calls), 3, 0, "bisect", Dead_Letter, Is_Bad_Row))
+
+    assert [event["id"] for event, _ in dead] == [5]
+    assert calls[0] == 8 and calls[1] == 4 # no retries before the split
+
+
+@pytest.mark.parametrize("sqlstate, poison", [
+    ("22P02", True),   # invalid_text_representation
+    ("22001", True),   # string_data_right_truncation
+    ("23505", True),   # unique_violation
+    ("23502", True),   # not_null_violation
+    ("54000", True),   # program_limit_exceeded (index row too big)
+    ("42P01", False),  # undefined_table, cdc_events was dropped
+    ("42501", False),  # insufficient_privilege, a revoked grant
+    ("42703", False),  # undefined_column, the table drifted
+    ("57014", False),  # query_canceled
+    ("08006", False),  # connection_failure
+])
+def test_only_data_sqlstates_are_poison(sqlstate, poison):
+    errors = pytest.importorskip("psycopg.errors")
+    Sink_Postgres = pytest.importorskip("Sink_Postgres")
+
+    assert Sink_Postgres.Is_Poison_Error(errors.lookup(sqlstate)("from the server")) is poison
+
+
+def test_python_and_client_errors_are_not_poison():
+    psycopg = pytest.importorskip("psycopg")
+    Sink_Postgres = pytest.importorskip("Sink_Postgres")
+
+    assert not Sink_Postgres.Is_Poison_Error(TypeError("bug"))
+    assert not Sink_Postgres.Is_Poison_Error(psycopg.ProgrammingError("client side, no sqlstate"))
+    assert not Sink_Postgres.Is_Poison_Error(psycopg.OperationalError("server closed the connection"))
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Sink_Sqlite import Sqlite_Sink
+
+
+def Event(i, lsn="0/100", table="public.orders"):
+    return {"table": table, "pk": [i], "commit_lsn": lsn, "commit_time": None, "type": "insert",
+            "payload_json": {"kind": "insert", "columnvalues": [i]}}
+
+
+# what another connection sees, only committed data
+def Committed(path):
+    cx = sqlite3.connect(path)
+    try:
+        pks = [row[0] for row in cx.execute("SELECT pk FROM cdc_events ORDER BY pk")]
+        lsns = dict(cx.execute("SELECT slot_name, last_applied_lsn FROM Lsn_Offsets"))
+    finally:
+        cx.close()
+    return pks, lsns
+
+
+async def Commit(sink, lsn, slots=None):
+    sink.Batch_Committed(lsn, slots)
+    await sink.committing
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "sink.db")
+
+
+def test_failed_batch_only_rolls_back_its_savepoint(path):
+    async def Run():
+        sink = Sqlite_Sink(path, "normal", "slot")
+        sink.Apply([Event(1)])
+        with pytest.raises(sqlite3.IntegrityError):
+            sink.Apply([Event(2), Event(3, table=None)]) # table_fqn is NOT NULL, fails after 2 went in
+        await Commit(sink, "0/100")
+        await sink.Close()
+
+    asyncio.run(Run())
+
+    assert Committed(path) == (["[1]"], {"slot": "0/100"})
+
+
+def test_batch_and_lsn_commit_together(path):
+    async def Run():
+        sink = Sqlite_Sink(path, "full", "slot")
+        await asyncio.to_thread(sink.Apply, [Event(1), Event(2)])
+        before = Committed(path)
+        await Commit(sink, "0/100", ["shard_a", "shard_b"])
+        after = Committed(path)
+        await sink.Close()
+        return before, after
+
+    before, after = asyncio.run(Run())
+
+    assert before == ([], {})
+    assert after == (["[1]", "[2]"], {"shard_a": "0/100", "shard_b": "0/100"})
+
+
+def test_close_rolls_back_chunks_without_an_lsn(path):
+    async def Run():
+        sink = Sqlite_Sink(path, "normal", "slot")
+        sink.Apply([Event(1)])
+        await Commit(sink, "0/100")
+        sink.Apply([Event(2, lsn="0/200")]) # chunks of a staged transaction, its last chunk never came
+        sink.Apply([Event(3, lsn="0/200")])
+        await sink.Close()
+
+    asyncio.run(Run())
+
+    assert Committed(path) == (["[1]"], {"slot": "0/100"})
+
+
+def test_a_failed_commit_is_raised_on_the_next_call(path):
+    async def Run():
+        sink = Sqlite_Sink(path, "normal", "slot")
+        sink.Apply([Event(1)])
+        sink.cx.execute("DROP TABLE Lsn_Offsets") # inside the open transaction, the lsn upsert fails
+        await Commit(sink, "0/100")
+        with pytest.raises(sqlite3.OperationalError):
+            sink.Batch_Committed("0/200")
+        sink.Close_Conn()
+
+    asyncio.run(Run())
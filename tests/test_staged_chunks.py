@@ -0,0 +1,62 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Apply_Manager import Run_Apply_Loop
+from Lane_Scheduler import Lane, Run_Lane_Apply_Loop
+
+
+def Change(i):
+    return {"kind": "insert", "schema": "public", "table": "orders", "columnnames": ["id"],
+            "columntypes": ["integer"], "columnvalues": [i]}
+
+
+def Transaction(lsn, ids, offset=None):
+    obj = {"xid": 700, "nextlsn": "0/500", "change": [Change(i) for i in ids]}
+    if offset is not None:
+        obj["change_offset"] = offset
+    return lsn, obj
+
+
+# 1 small transaction, then a staged one handed over in 3 chunks the way Source_Pg does it: 1 list per chunk,
+# chunks before the last one have lsn None
+async def Staged_Source():
+    yield [Transaction("0/100", [0])]
+    yield [Transaction(None, [1, 2, 3], offset=0)]
+    yield [Transaction(None, [4, 5, 6], offset=3)]
+    yield [Transaction("0/500", [7, 8], offset=6)]
+
+
+def test_apply_loop_sends_every_chunk_before_buffering_the_next():
+    batches, saved = [], []
+
+    async def Apply(events):
+        batches.append(len(events))
+
+    # batch_size counts transactions, a big one would let every chunk of the staged transaction pile up
+    asyncio.run(Run_Apply_Loop(Staged_Source(), 1000, Apply, saved.append, 1, 0.01))
+
+    assert batches == [4, 3, 2]
+    assert saved == ["0/100", "0/500"]
+
+
+def test_lane_queue_is_bounded_in_changes():
+    lane = Lane("bulk", ["*"], batch_size=1, linger_seconds=0, max_queued=4)
+    queued, applied = [], []
+
+    async def Source():
+        for n in range(6):
+            yield [Transaction(None, [3 * n, 3 * n + 1, 3 * n + 2], offset=3 * n)]
+        yield [Transaction("0/500", [18], offset=18)]
+
+    async def Apply(events):
+        queued.append(lane.queued)
+        applied.extend(event["payload_json"]["columnvalues"][0] for event in events)
+        await asyncio.sleep(0.01) # slow sink, the reader has to wait on the lane
+
+    asyncio.run(Run_Lane_Apply_Loop(Source(), [lane], 1, Apply, lambda lsn: None, 1, 0.01))
+
+    assert max(queued) <= 4 # 1 chunk of 3 waiting, never all 6
+    assert applied == list(range(19))
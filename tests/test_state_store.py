@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+State_Store = pytest.importorskip("State_Store") # needs psycopg
+
+
+def test_plain_names_map_to_themselves():
+    assert State_Store.State_Table_Name("public.orders") == "cdc_state__public__orders"
+    assert State_Store.State_Table_Name("sales.order_items") == "cdc_state__sales__order_items"
+
+
+@pytest.mark.parametrize("first, second", [
+    ("public.Orders", "public.orders"),
+    ("a_.b", "a._b"),
+    ("a__b.c", "a.b__c"),
+    ("public.order-items", "public.order_items"),
+])
+def test_tables_that_sanitize_alike_get_their_own_state_table(first, second):
+    assert State_Store.State_Table_Name(first) != State_Store.State_Table_Name(second)
+
+
+def test_long_names_fit_postgres():
+    name = State_Store.State_Table_Name("public." + "x" * 100)
+    assert len(name) <= State_Store.MAX_IDENTIFIER
+    assert name != State_Store.State_Table_Name("public." + "x" * 101)